@@ -0,0 +1,261 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .sdapi_v1 import SDAPI
+
+class Backend():
+    # One WebUI host in a BackendPool
+    def __init__(self, api:SDAPI):
+        self.api = api
+        self.healthy = None # None until the first health check
+        self.server_jobs = 0 # Jobs the server says it's working on, from /progress
+        self.active = 0 # Jobs this plugin has sent and is waiting on
+        self.models = [] # Checkpoint titles and names available on this host
+        self.last_checked = 0
+        self.check_lock = threading.Lock() # So jobs starting together don't all connect to the same host at once
+
+    def host(self):
+        return self.api.host
+
+    def load(self):
+        return self.active + self.server_jobs
+
+    def has_model(self, model):
+        if model is None or len(model) == 0 or model.lower() == 'none' or len(self.models) == 0:
+            return True # Server default, or the model list isn't known yet
+        return model in self.models
+
+class BackendPool():
+    # Spreads generation jobs across several WebUI hosts. The first backend is always the SDAPI the UI was built from,
+    # the rest come from the 'server.extra_hosts' setting. Jobs go to the least loaded healthy host that has the
+    # requested checkpoint, and move to another host if the one they were sent to stops responding.
+    HEALTH_CHECK_SECONDS = 15.0 # How old a health check can be before it's done again
+    GENERATION_ENDPOINTS = {
+        'txt2img': 'txt2img',
+        'img2img': 'img2img',
+        'inpaint': 'img2img',
+        'extra': 'extra',
+        'interrogate': 'interrogate',
+        'rembg': 'rembg',
+    }
+
+    def __init__(self, api:SDAPI, hosts=[]):
+        self.api = api
+        self.lock = threading.Lock()
+        self.backends = [Backend(api)]
+        self.set_hosts(hosts)
+
+    @staticmethod
+    def parse_hosts(text:str):
+        # Comma, space or newline separated list from the settings page
+        return [host.strip().rstrip('/') for host in text.replace(',', ' ').split() if len(host.strip()) > 0]
+
+    def set_hosts(self, hosts):
+        # hosts are the extra hosts. The primary one is self.api.host.
+        with self.lock:
+            existing = {backend.host(): backend for backend in self.backends[1:]}
+            backends = [self.backends[0]]
+            for host in hosts:
+                if host == self.api.host or host in [backend.host() for backend in backends]:
+                    continue
+                if host in existing:
+                    backends.append(existing[host])
+                    continue
+                api = SDAPI(host, connect=False, result_cache=self.api.result_cache)
+                api.set_timeouts(self.api.connect_timeout, self.api.read_timeout)
+                backends.append(Backend(api))
+            self.backends = backends
+
+    def capacity(self):
+        # How many jobs can run at once, one per host that isn't known to be down
+        with self.lock:
+            return max(1, len([backend for backend in self.backends if backend.healthy is not False]))
+
+    def check(self, backend:Backend):
+        with backend.check_lock:
+            models = None
+            if backend.api is not self.api and not backend.api.connected:
+                # Extra hosts are made with connect=False. Until init_api() has read the host's options, cleanup_data()
+                # would treat an SD.Next host like A1111, so a host gets no work before it's connected.
+                backend.api.init_api()
+                if backend.api.connected:
+                    models = backend.api.models
+            connected = backend.api is self.api or backend.api.connected
+            status = backend.api.get_status() if connected else None
+            progress = backend.api.get_progress(skip_current_image=True) if status is not None else None
+            healthy = status is not None and progress is not None
+            server_jobs = 0
+            if healthy:
+                state = progress.get('state') or {}
+                server_jobs = state.get('job_count', 0) or 0
+                if 'queue_size' in status:
+                    server_jobs = max(server_jobs, status['queue_size'] or 0)
+                if backend.api is self.api:
+                    models = self.api.models # Already fetched for the UI
+                elif models is None and (len(backend.models) == 0 or backend.healthy is not True):
+                    models = backend.api.get_models() # The host just came back
+            with self.lock:
+                backend.healthy = healthy
+                backend.server_jobs = server_jobs
+                backend.last_checked = time.monotonic()
+                if healthy and models is not None:
+                    backend.models = [*[model['title'] for model in models], *[model['model_name'] for model in models]]
+            return healthy
+
+    def check_all(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            due = [backend for backend in self.backends if force or now - backend.last_checked > BackendPool.HEALTH_CHECK_SECONDS]
+        if len(due) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=len(due)) as executor:
+            [*executor.map(self.check, due)]
+
+    def choose(self, model=None, exclude=[], claim=False):
+        # Least loaded healthy backend with the model. Hosts without the model are only used if no host has it,
+        # in which case the server will load it (or fall back to its default).
+        # claim counts a job against the backend in the same step, so jobs starting together don't all pick the same host.
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend.healthy is not False and backend not in exclude]
+            if len(candidates) == 0:
+                return None
+            with_model = [backend for backend in candidates if backend.has_model(model)]
+            if len(with_model) > 0:
+                candidates = with_model
+            # Ties go to the earlier host, so the primary is preferred
+            backend = min(candidates, key=lambda backend: backend.load())
+            if claim:
+                backend.active += 1
+            return backend
+
+    def run(self, mode, data, on_backend=None, on_image=None):
+        # Runs the job on the best backend, failing over to the next best until one returns results or none are left.
+        # on_backend(backend) is called each time a backend is picked, so callers can follow progress on the right host.
+        # on_image(b64_str) is passed on to txt2img/img2img/extra, see SDAPI.post_streaming().
+        # Returns (results, backend). Safe to call from several worker threads at once.
+        self.check_all()
+        model = data.get('model', None)
+        tried = []
+        while True:
+            backend = self.choose(model, tried, claim=True)
+            if backend is None:
+                return None, None
+            tried.append(backend)
+            if on_backend is not None:
+                on_backend(backend)
+            results = None
+            try:
+                # cleanup_data() changes the dict it's given, so every attempt gets its own copy
+                endpoint = getattr(backend.api, BackendPool.GENERATION_ENDPOINTS[mode])
+                if on_image is not None:
+                    results = endpoint(dict(data), on_image=on_image)
+                else:
+                    results = endpoint(dict(data))
+            except Exception as e:
+                results = None
+            finally:
+                with self.lock:
+                    backend.active -= 1
+            if results is not None:
+                return results, backend
+            if self.check(backend):
+                # The host is up, so the request itself failed (bad parameters, out of memory, interrupted). Another host won't do better.
+                return None, backend
+
+    @staticmethod
+    def is_random_seed(seed):
+        # The seed widgets send '' or -1 for random
+        try:
+            return int(seed) == -1
+        except (TypeError, ValueError):
+            return True
+
+    @staticmethod
+    def fixed_seed(seed):
+        # Picking a random seed here (the same range A1111 uses) lets shards continue one sequence.
+        if BackendPool.is_random_seed(seed):
+            return int(random.randrange(4294967294))
+        return int(seed)
+
+    @staticmethod
+    def mark_random(original, data):
+        # Once fixed_seed() has picked a seed the request looks repeatable, but nobody will ask for that seed again.
+        # The 'CYANIC' no_cache flag keeps it out of the ResultCache, see SDAPI.post_cached().
+        if BackendPool.is_random_seed(original.get('seed', -1)) or (original.get('subseed_strength', 0) and BackendPool.is_random_seed(original.get('subseed', -1))):
+            data['CYANIC'] = dict(data.get('CYANIC', {}), no_cache=True)
+        return data
+
+    @staticmethod
+    def plan_shards(data, hosts):
+        # Splits n_iter (batch_count) into one request per host. Each shard starts at the seed the single-server run would've
+        # reached by then (A1111 gives image i of a batch seed + i), so the merged results match one server running everything.
+        batch_count = data.get('batch_count', data.get('n_iter', 1))
+        batch_size = data.get('batch_size', 1)
+        shard_count = max(1, min(batch_count, hosts))
+        seed = BackendPool.fixed_seed(data.get('seed', -1))
+        subseed = BackendPool.fixed_seed(data.get('subseed', -1))
+        shards = []
+        offset = 0
+        for i in range(0, shard_count):
+            count = batch_count // shard_count + (1 if i < batch_count % shard_count else 0)
+            shard = dict(data)
+            shard.pop('n_iter', None)
+            shard['batch_count'] = count
+            shard['seed'] = seed + offset
+            shard['subseed'] = subseed + offset
+            shards.append(BackendPool.mark_random(data, shard))
+            offset += count * batch_size
+        return shards
+
+    @staticmethod
+    def merge_results(shard_results):
+        # shard_results are in seed order, already pruned to just the generated images. Failed shards are None and skipped.
+        shard_results = [results for results in shard_results if results is not None]
+        if len(shard_results) == 0:
+            return None
+        merged = dict(shard_results[0])
+        merged['images'] = []
+        info = dict(merged['info']) if type(merged.get('info', None)) is dict else None
+        list_keys = ['all_prompts', 'all_negative_prompts', 'all_seeds', 'all_subseeds', 'infotexts']
+        if info is not None:
+            for key in list_keys:
+                if key in info:
+                    info[key] = []
+        iterations = 0
+        for results in shard_results:
+            merged['images'].extend(results.get('images', []))
+            iterations += results.get('parameters', {}).get('n_iter', 0)
+            if info is not None and type(results.get('info', None)) is dict:
+                for key in list_keys:
+                    if key in info:
+                        info[key].extend(results['info'].get(key, []))
+        if info is not None:
+            merged['info'] = info
+        if 'parameters' in merged:
+            merged['parameters'] = dict(merged['parameters'])
+            merged['parameters']['n_iter'] = iterations
+        return merged
+
+    def run_sharded(self, mode, data, on_backend=None, prune=None, on_image=None):
+        # Like run(), but batch_count is split across every healthy host and the results come back as one set, in seed order.
+        # prune(results) is applied to each shard before merging, so grids and ControlNet previews don't end up in the middle.
+        self.check_all()
+        with self.lock:
+            hosts = len([backend for backend in self.backends if backend.healthy is not False])
+        shards = BackendPool.plan_shards(data, hosts)
+        if len(shards) == 1:
+            results, backend = self.run(mode, shards[0], on_backend, on_image)
+            return results, backend
+
+        def run_shard(shard):
+            results, backend = self.run(mode, shard, on_backend, on_image)
+            if results is not None and prune is not None:
+                results = prune(results)
+            return results, backend
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            shard_results = [*executor.map(run_shard, shards)]
+        # Hosts are picked by load, and each shard takes the least loaded one at the time, so they spread out on their own
+        backends = [backend for results, backend in shard_results if backend is not None]
+        return BackendPool.merge_results([results for results, backend in shard_results]), (backends[0] if len(backends) > 0 else None)
@@ -0,0 +1,60 @@
+import json
+import hashlib
+import os.path
+import threading
+import time
+
+class CatalogCache():
+    # Saves what SDAPI.init_api fetches (models, loras, options, etc.) so the next launch can fill the UI
+    # straight from disk while a background refresh checks the server for changes.
+    def __init__(self):
+        self.plugin_dir = os.path.dirname(os.path.realpath(__file__))
+        self.cache_file = os.path.join(self.plugin_dir, 'catalog_cache.json') # Lives next to user_settings.json
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.entries = json.load(f)
+        except Exception as e:
+            # A corrupt cache just means a slower startup, the server is the source of truth
+            self.entries = {}
+
+    def save(self):
+        try:
+            with open(self.cache_file, 'w') as f:
+                f.write(json.dumps(self.entries))
+        except Exception as e:
+            # Only costs the next launch its head start, the catalog in memory is still good
+            print('Cyanic SD - Error saving catalog cache: %s' % e)
+
+    @staticmethod
+    def fingerprint(options):
+        # Any change to the server's settings (new default model, different backend, etc.) changes the fingerprint
+        if options is None or len(options) == 0:
+            return ''
+        return hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, host):
+        # Returns {'fingerprint': str, 'saved': float, 'catalog': dict} or None
+        with self.lock:
+            return self.entries.get(host, None)
+
+    def set(self, host, catalog):
+        with self.lock:
+            self.entries[host] = {
+                'fingerprint': CatalogCache.fingerprint(catalog.get('default_settings', {})),
+                'saved': time.time(),
+                'catalog': catalog,
+            }
+            self.save()
+
+    def remove(self, host):
+        with self.lock:
+            if host in self.entries:
+                self.entries.pop(host)
+                self.save()
@@ -1,6 +1,10 @@
 from PyQt5.QtWidgets import *
 from krita import *
+from collections import OrderedDict
 from .sdapi_v1 import SDAPI
+from .catalog_cache import CatalogCache
+from .result_cache import ResultCache
+from .krita_controller import KritaController
 from .widgets import *
 from .pages import *
 from .settings_controller import SettingsController
@@ -11,16 +15,22 @@ class CyanicDocker(DockWidget):
     def __init__(self):
         super().__init__()
         self.settings_controller = SettingsController()
-        self.api = SDAPI(self.settings_controller.get('server.host') if self.settings_controller.has_key('server.host') else DEFAULT_HOST)
+        # Separate controllers, because each one can only own one running thread at a time
+        self.connect_kc = KritaController()
+        self.refresh_kc = KritaController()
+        self.connection_attempts = 0
+        # Don't connect here, a host that's offline or rebooting would hang Krita's startup
+        self.api = SDAPI(self.settings_controller.get('server.host') if self.settings_controller.has_key('server.host') else DEFAULT_HOST, CatalogCache(), connect=False, result_cache=ResultCache(self.settings_controller))
+        self.api.set_timeouts(self.settings_controller.get('server.connect_timeout'), self.settings_controller.get('server.read_timeout'))
 
         self.setWindowTitle("Cyanic SD")
         self.main_widget = QWidget(self)
         self.main_widget.setLayout(QVBoxLayout())
         self.setWidget(self.main_widget)        
         
-        # NOTE: This page setup creates a new page each time the select is changed, which would clear prompts/settings.
-        # A better design might be to re-use the pages.
-        # However my attempts to reuse the page have gotten "object of type <pagename> has been deleted" when switching back
+        # NOTE: Pages are kept alive in a QStackedWidget and re-used, so switching pages keeps prompts/settings and doesn't
+        # rebuild every widget. (QScrollArea.setWidget() deletes the old widget, which is why the stack sits inside it.)
+        # Settings and Simplify UI are always rebuilt, since they read/write the settings the other pages are built from.
 
         # Set up the page select
         self.page_combobox = QComboBox()
@@ -40,19 +50,64 @@ class CyanicDocker(DockWidget):
         self.page_combobox.activated.connect(self.change_page)
         self.main_widget.layout().addWidget(self.page_combobox)
 
-        # Resume the last page it was on ONLY if the API is running. Otherwise the pages try to pull defaults and it becomes a big mess...
-        if self.api.connected:
-            last_page = self.settings_controller.get('pages.last')
-            if last_page and last_page in list(map(lambda x: x['name'], self.pages)):
-                self.page_combobox.setCurrentText(last_page)
+        self.connection_label = QLabel()
+        self.connection_label.setWordWrap(True)
+        self.main_widget.layout().addWidget(self.connection_label)
 
         # Initialize contentWidget
         self.content_area = QScrollArea()
         self.content_area.setWidgetResizable(True)
         self.main_widget.layout().addWidget(self.content_area)
-
-        # Set the initial page
-        self.change_page() 
+        self.page_stack = QStackedWidget()
+        self.content_area.setWidget(self.page_stack)
+        self.page_cache = OrderedDict() # page name: page widget, least recently used first
+        self.uncached_page = None # Settings/Simplify UI page currently in the stack
+        self.api.add_catalog_listener(self.on_catalog_changed)
+
+        # Pages are built once the connection attempt finishes
+        self.page_combobox.setDisabled(True)
+        self.connect_to_host()
+
+    def connect_to_host(self):
+        self.connection_attempts += 1
+        self.connection_label.setText('Connecting to %s...' % self.api.host)
+        self.connection_label.setHidden(False)
+        self.connect_kc.run_as_thread(self.api.init_api, self.on_connection_attempt)
+
+    def on_connection_attempt(self):
+        if self.api.connected:
+            self.connection_label.setHidden(True)
+            self.page_combobox.setDisabled(False)
+            # Resume the last page it was on ONLY if the API is running. Otherwise the pages try to pull defaults and it becomes a big mess...
+            last_page = self.settings_controller.get('pages.last')
+            if last_page and last_page in list(map(lambda x: x['name'], self.pages)):
+                self.page_combobox.setCurrentText(last_page)
+            self.clear_page_cache() # Anything built while offline has empty lists
+            self.change_page()
+
+            # The pages were filled from the cached catalog, check the server for anything new without blocking the GUI
+            if self.api.catalog_stale:
+                self.refresh_kc.run_as_thread(self.api.refresh_catalog, self.api.notify_catalog_listeners)
+            return
+
+        self.connection_label.setText('Unable to connect to %s, retrying...' % self.api.host)
+        if self.connection_attempts == 1:
+            # Show the pages anyway, so the host can be changed in Settings
+            self.page_combobox.setDisabled(False)
+            self.change_page()
+        retry_seconds = self.settings_controller.get('server.reconnect_seconds')
+        if retry_seconds is not None and retry_seconds > 0:
+            QTimer.singleShot(int(retry_seconds * 1000), self.retry_connection)
+
+    def retry_connection(self):
+        try:
+            if self.api.connected:
+                # Connected through the Settings page in the meantime
+                self.on_connection_attempt()
+                return
+            self.connect_to_host()
+        except RuntimeError:
+            pass # The docker was closed
 
     # This was part of the template, might be relevant later
     def canvasChanged(self, canvas):
@@ -68,38 +123,94 @@ class CyanicDocker(DockWidget):
         self.update()
 
 
+    def show_page(self, name, build_page, cacheable=True):
+        if self.uncached_page is not None:
+            self.page_stack.removeWidget(self.uncached_page)
+            self.uncached_page.deleteLater()
+            self.uncached_page = None
+            # Hidden UI settings may have changed, so the cached pages could be out of date
+            self.clear_page_cache()
+
+        if not cacheable:
+            page = build_page()
+            self.uncached_page = page
+            self.page_stack.addWidget(page)
+        elif name in self.page_cache:
+            page = self.page_cache[name]
+            self.page_cache.move_to_end(name)
+        else:
+            page = build_page()
+            self.page_cache[name] = page
+            self.page_stack.addWidget(page)
+            self.evict_pages()
+        self.page_stack.setCurrentWidget(page)
+
+        # QStackedWidget sizes itself to the largest page. Ignore the hidden ones so the scroll area fits the visible page.
+        for index in range(self.page_stack.count()):
+            widget = self.page_stack.widget(index)
+            if widget is page:
+                widget.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred)
+            else:
+                widget.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        page.adjustSize()
+
+    def evict_pages(self):
+        cache_size = self.settings_controller.get('pages.cache_size')
+        if cache_size is None or cache_size < 1:
+            cache_size = 1
+        while len(self.page_cache) > cache_size:
+            name, page = self.page_cache.popitem(last=False)
+            self.page_stack.removeWidget(page)
+            page.deleteLater()
+
+    def clear_page_cache(self):
+        for page in self.page_cache.values():
+            self.page_stack.removeWidget(page)
+            page.deleteLater()
+        self.page_cache = OrderedDict()
+
+    def on_catalog_changed(self, changed_keys):
+        # Widgets update these lists in place, and ModelsWidget picks up the server's selected model/VAE from default_settings.
+        # Anything else (scripts, extensions, a different backend) changes how pages are built.
+        in_place = ['models', 'vaes', 'samplers', 'upscalers', 'styles', 'loras', 'embeddings', 'hypernetworks', 'default_settings']
+        if all(key in in_place for key in changed_keys):
+            return
+        self.clear_page_cache()
+        if self.uncached_page is None:
+            self.change_page()
+
     def show_settings(self):
-        self.content_area.setWidget(SettingsPage(self.settings_controller, self.api))
+        self.show_page('Settings', lambda: SettingsPage(self.settings_controller, self.api), cacheable=False)
 
     def show_simplify(self):
-        self.content_area.setWidget(SimplifyPage(self.settings_controller, self.api))
+        self.show_page('Simplify UI', lambda: SimplifyPage(self.settings_controller, self.api), cacheable=False)
 
     def show_txt2img(self):
-        self.content_area.setWidget(Txt2ImgPage(self.settings_controller, self.api))
+        self.show_page('Txt2Img', lambda: Txt2ImgPage(self.settings_controller, self.api))
 
     def show_img2img(self):
-        self.content_area.setWidget(Img2ImgPage(self.settings_controller, self.api))
+        self.show_page('Img2Img', lambda: Img2ImgPage(self.settings_controller, self.api))
 
     def show_inpaint(self):
-        self.content_area.setWidget(InpaintPage(self.settings_controller, self.api))
+        self.show_page('Inpaint', lambda: InpaintPage(self.settings_controller, self.api))
 
     def show_interrogate(self):
-        self.content_area.setWidget(InterrogatePage(self.settings_controller, self.api))
+        self.show_page('Interrogate', lambda: InterrogatePage(self.settings_controller, self.api))
 
     def show_upscale(self):
-        self.content_area.setWidget(UpscalePage(self.settings_controller, self.api))
+        self.show_page('Upscale', lambda: UpscalePage(self.settings_controller, self.api))
 
     def show_rembg(self):
-        self.content_area.setWidget(RemBGPage(self.settings_controller, self.api))
+        self.show_page('Remove Background', lambda: RemBGPage(self.settings_controller, self.api))
 
     def show_segmap(self):
-        self.content_area.setWidget(SegmentationMapPage(self.settings_controller))
+        self.show_page('Segmentation Map', lambda: SegmentationMapPage(self.settings_controller))
 
     def showOther(self, text):
         contentWidget = QWidget()
         contentWidget.setLayout(QVBoxLayout())
         contentWidget.layout().addWidget(QLabel(text))
-        self.content_area.setWidget(contentWidget)
+        self.show_page(text, lambda: contentWidget, cacheable=False)
 
 
 Krita.instance().addDockWidgetFactory(
@@ -94,7 +94,7 @@ class ControlNetUnit(QWidget):
         self.layout().addWidget(self.img_in)
         self.img_in.setVisible(not self.use_mask.isChecked())
 
-        self.mask_in = MaskWidget(self.settings_controller, self.api, self.size_dict)
+        self.mask_in = MaskWidget(self.settings_controller, self.api, self.size_dict, allow_crop=False)
         self.layout().addWidget(self.mask_in)
         self.mask_in.setVisible(self.use_mask.isChecked())
 
@@ -539,9 +539,15 @@ class ControlNetAPI():
     def get_models_for_control_type(self, control_type):
         return self.control_types[control_type]['model_list']
 
+    def _get(self, key, url):
+        # Use the catalog SDAPI already has (possibly from the on-disk cache) before asking the server
+        if self.api.controlnet and key in self.api.controlnet:
+            return self.api.controlnet[key]
+        return self.api.get(url)
+
     def get_version(self):
         # Forge doesn't have this API call, but ControlNet may make breaking changes in the future, so it's important to have them.
-        version = self.api.get('/controlnet/version')
+        version = self._get('version', '/controlnet/version')
         try:
             if version:
                 return version['version']
@@ -550,10 +556,10 @@ class ControlNetAPI():
         return 3 # The latest version as of writing this - May 20, 2024
     
     def get_models(self):
-        self.models = self.api.get('/controlnet/model_list?update=true')['model_list']
+        self.models = self._get('model_list', '/controlnet/model_list?update=true')['model_list']
     
     def get_modules(self):
-        results = self.api.get('/controlnet/module_list?alias_names=true')
+        results = self._get('module_list', '/controlnet/module_list?alias_names=true')
         try:
             self.module_list = results['module_list']
             self.module_details = results['module_detail']
@@ -562,7 +568,7 @@ class ControlNetAPI():
 
     def get_control_types(self):
         try:
-            self.control_types = self.api.get('/controlnet/control_types')['control_types']
+            self.control_types = self._get('control_types', '/controlnet/control_types')['control_types']
         except:
             # Treat everything as if it's part of 'All'
             control_types = {
@@ -576,7 +582,7 @@ class ControlNetAPI():
             self.control_types = control_types
 
     def get_settings(self):
-        self.settings = self.api.get('/controlnet/settings')
+        self.settings = self._get('settings', '/controlnet/settings')
         try:
             self.tabs = self.settings['control_net_unit_count'] # Version 2
         except:
@@ -592,5 +598,5 @@ class ControlNetAPI():
             'controlnet_threshold_a': threshold_a,
             'controlnet_threshold_b': threshold_b,
         }
-        results = self.api.post('/controlnet/detect', data)
+        results = self.api.post('/controlnet/detect', data, self.api.generation_timeout)
         return results
@@ -0,0 +1,95 @@
+import os
+import time
+from PyQt5.QtGui import QImage, qAlpha, qRgb, qRgba
+from cyanic.krita_controller import KritaController
+
+# Timing checks for the slow paths in KritaController.
+# Run from Krita's Scripter (Tools > Scripts > Scripter), since KritaController needs the krita module.
+
+def random_argb_image(width, height):
+    # Random bytes give every alpha value, so the mask conversion is checked against all 256 of them
+    raw = os.urandom(width * height * 4)
+    return QImage(raw, width, height, width * 4, QImage.Format_ARGB32).copy() # copy() so the image owns its memory
+
+def image_bytes(image:QImage):
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    return bits.asstring()
+
+def reference_grayscale_mask(image, width, height):
+    # The per-pixel loop KritaController used before the whole-image version
+    for pixel_x in range(0, width):
+        for pixel_y in range(0, height):
+            pixel = image.pixel(pixel_x, pixel_y)
+            alpha = qAlpha(pixel)
+            newPixel = qRgb(alpha, alpha, alpha)
+            image.setPixel(pixel_x, pixel_y, newPixel)
+    return image
+
+def benchmark_mask_conversion(sizes=[256, 512, 1024, 2048], reference_max_size=2048):
+    # The reference loop takes minutes at 4096, so sizes above reference_max_size only time the new version
+    kc = KritaController()
+    print('Mask conversion (alpha to grayscale)')
+    print('%10s %12s %12s %10s %10s' % ('size', 'loop (s)', 'bulk (s)', 'speedup', 'identical'))
+    for size in sizes:
+        image = random_argb_image(size, size)
+
+        start = time.perf_counter()
+        bulk = kc.convert_qimage_to_grayscale_mask(image.copy(), size, size)
+        bulk_time = time.perf_counter() - start
+
+        if size > reference_max_size:
+            print('%10s %12s %12.4f %10s %10s' % ('%sx%s' % (size, size), '-', bulk_time, '-', '-'))
+            continue
+
+        start = time.perf_counter()
+        loop = reference_grayscale_mask(image.copy(), size, size)
+        loop_time = time.perf_counter() - start
+
+        identical = bulk.format() == loop.format() and image_bytes(bulk) == image_bytes(loop)
+        speedup = loop_time / bulk_time if bulk_time > 0 else float('inf')
+        print('%10s %12.4f %12.4f %9.0fx %10s' % ('%sx%s' % (size, size), loop_time, bulk_time, speedup, identical))
+
+def gradient_image(width, height):
+    # Random noise doesn't compress, so the upload benchmark uses something closer to a real render
+    image = QImage(width, height, QImage.Format_ARGB32)
+    for y in range(0, height):
+        for x in range(0, width):
+            image.setPixel(x, y, qRgb(x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)))
+    return image
+
+def circle_selection(width, height):
+    # A filled circle on a transparent background, like a typical inpaint selection
+    image = QImage(width, height, QImage.Format_ARGB32)
+    image.fill(0)
+    radius = min(width, height) // 3
+    for y in range(0, height):
+        for x in range(0, width):
+            if (x - width // 2) ** 2 + (y - height // 2) ** 2 < radius ** 2:
+                image.setPixel(x, y, qRgba(255, 255, 255, 255))
+    return image
+
+def benchmark_upload_encoding(size=1024, quality=95, repeat=3):
+    # Compares encode time against the base64 payload size for every KritaController.UPLOAD_FORMATS option
+    kc = KritaController()
+    images = {
+        'image': gradient_image(size, size),
+        'mask': kc.convert_qimage_to_grayscale_mask(circle_selection(size, size), size, size),
+    }
+    print('Upload encoding at %sx%s, JPEG/WebP quality %s' % (size, size, quality))
+    print('%8s %18s %12s %12s' % ('input', 'format', 'encode (s)', 'size (KB)'))
+    for kind, image in images.items():
+        for upload_format in KritaController.UPLOAD_FORMATS.keys():
+            encode_time = None
+            for i in range(0, repeat):
+                KritaController.encoded_images.clear() # Otherwise every run after the first just times a cache hit
+                start = time.perf_counter()
+                b64_str = kc.qimage_to_b64_str(image, upload_format, quality)
+                elapsed = time.perf_counter() - start
+                encode_time = elapsed if encode_time is None else min(encode_time, elapsed)
+            print('%8s %18s %12.4f %12.1f' % (kind, upload_format, encode_time, len(b64_str) / 1024))
+
+
+if __name__ == '__main__':
+    benchmark_mask_conversion()
+    benchmark_upload_encoding()
@@ -0,0 +1,127 @@
+import http.client
+import select
+import ssl
+import threading
+import urllib.parse
+
+# Exceptions that mean a kept-alive socket was closed by the server (or a proxy) while it sat in the pool.
+# When one of these happens on a reused connection it's safe to reconnect and try again, as long as the server
+# can't have started on the request: either it wasn't all sent yet, or sending it twice does no harm (IDEMPOTENT_METHODS).
+# A txt2img POST the server dropped partway through a job must not be sent again.
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+class HTTPConnectionPool():
+    # Keeps a small number of persistent HTTP/1.1 connections per host.
+    # urllib.request.urlopen opens a new TCP (and TLS) connection for every request, which adds a handshake
+    # to every progress poll and every generation when the server isn't on the local machine.
+    MAX_IDLE_PER_HOST = 8
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {} # (scheme, hostname, port): [HTTPConnection, ...]
+        self.lock = threading.Lock()
+
+    def _split_url(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme.lower() if parsed.scheme else 'http'
+        port = parsed.port
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+        path = parsed.path if len(parsed.path) > 0 else '/'
+        if len(parsed.query) > 0:
+            path = '%s?%s' % (path, parsed.query)
+        return (scheme, parsed.hostname, port), path
+
+    def _new_connection(self, key):
+        scheme, hostname, port = key
+        if scheme == 'https':
+            # Use whatever context urllib would've used, so the self-signed cert switch at the top of sdapi_v1.py still works
+            context = ssl._create_default_https_context()
+            return http.client.HTTPSConnection(hostname, port, context=context)
+        return http.client.HTTPConnection(hostname, port)
+
+    @staticmethod
+    def _closed_by_server(connection):
+        # An idle keep-alive socket only becomes readable when the server has closed it (or sent something it shouldn't have)
+        try:
+            readable, writable, errored = select.select([connection.sock], [], [], 0)
+            return len(readable) > 0
+        except Exception as e:
+            return True
+
+    def _acquire(self, key):
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while len(connections) > 0:
+                connection = connections.pop()
+                if connection.sock is not None and not HTTPConnectionPool._closed_by_server(connection):
+                    return connection, True
+                connection.close() # Cheaper to find out now than after sending a request that can't be retried
+        return self._new_connection(key), False
+
+    def _release(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+    def _send(self, connection, method, path, body, headers, connect_timeout, read_timeout):
+        if connection.sock is None:
+            # Only the connect uses connect_timeout, so a dead host fails fast without cutting off slow generations
+            connection.timeout = connect_timeout
+            connection.connect()
+        connection.sock.settimeout(read_timeout)
+        connection.request(method, path, body=body, headers=headers)
+
+    def request(self, method, url, body=None, headers={}, connect_timeout=None, read_timeout=None, read_body=None):
+        # Returns (status, body bytes). Raises the same sort of exceptions http.client would on connection failures.
+        # Timeouts are in seconds, None waits forever.
+        # read_body(response) reads the body some other way (like JSONImageStream) and its result is returned instead of the bytes.
+        key, path = self._split_url(url)
+        connection, reused = self._acquire(key)
+        try:
+            sent = False
+            try:
+                self._send(connection, method, path, body, headers, connect_timeout, read_timeout)
+                sent = True
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if not reused or (sent and method.upper() not in IDEMPOTENT_METHODS):
+                    raise # The server may have the whole request, and be working on it
+                # The pooled socket went stale, reconnect once
+                connection = self._new_connection(key)
+                self._send(connection, method, path, body, headers, connect_timeout, read_timeout)
+                response = connection.getresponse()
+            if read_body is None:
+                data = response.read()
+            else:
+                data = read_body(response)
+                response.read() # Whatever the reader didn't need, so the connection can be reused
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        except Exception:
+            connection.close() # read_body failed partway, there's no telling where the socket is
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return response.status, data
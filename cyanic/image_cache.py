@@ -0,0 +1,55 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from PyQt5.QtGui import QImage
+
+class EncodedImageCache():
+    # Remembers the base64 strings KritaController.qimage_to_b64_str() has already made.
+    # One generation can encode the same canvas for img2img, the inpaint widget, and every ControlNet unit set to "canvas",
+    # and regenerating an unchanged canvas would encode it all over again. Hashing the pixels is much faster than PNG compression.
+    MAX_ENTRIES = 16
+    MAX_BYTES = 128 * 1024 * 1024 # Base64 strings, not the images. Roughly a dozen 2048x2048 PNGs.
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key: b64 str, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_key(image:QImage, *encoding):
+        # The pixel hash plus anything that changes what the pixels look like, or how they'd be encoded
+        bits = image.constBits()
+        if bits is None:
+            return None # Null image
+        bits.setsize(image.byteCount())
+        digest = hashlib.blake2b(bits, digest_size=16).hexdigest() # Hashes the buffer in place, no copy
+        return (digest, image.width(), image.height(), image.bytesPerLine(), int(image.format()), *encoding)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def set(self, key, b64_str:str):
+        if len(b64_str) > self.max_bytes:
+            return # Would push everything else out, and probably won't be sent twice
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key))
+            self.entries[key] = b64_str
+            self.total_bytes += len(b64_str)
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                old_key, old_str = self.entries.popitem(last=False)
+                self.total_bytes -= len(old_str)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.total_bytes = 0
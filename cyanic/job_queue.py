@@ -0,0 +1,467 @@
+import base64
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, pyqtSignal
+from .sdapi_v1 import SDAPI
+from .settings_controller import SettingsController
+from .krita_controller import KritaController
+from .progress_poller import ProgressPoller
+from .backend_pool import BackendPool
+from .model_grouping import ModelGrouping
+
+class GenerationJob():
+    QUEUED = 'Queued'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    CANCELLED = 'Cancelled'
+    FAILED = 'Failed'
+    _ids = itertools.count(1)
+
+    def __init__(self, mode:str, data:dict, x, y, w, h, processing_instructions={}, doc=None, priority=0):
+        # Everything needed to run the job and put the results back, so nothing depends on the page that made it still existing
+        self.id = next(GenerationJob._ids)
+        self.order = self.id # Position among jobs with the same priority, changed by JobQueue.move()
+        self.mode = mode # 'txt2img', 'img2img', 'inpaint', 'extra' (upscaling), 'rembg' or 'interrogate'
+        self.data = data
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.processing_instructions = processing_instructions
+        self.doc = doc # The document to put the results in
+        self.priority = priority # Higher runs first
+        self.status = GenerationJob.QUEUED
+        self.results = None
+        self.progress = 0.0
+        self.iteration = 0 # For progressive jobs, which of the batch count's requests is running
+        self.iterations = 1
+        self.images_delivered = 0
+        self.group = None # "Results" group progressive jobs add their images to
+        self.layer = None # Layer tiled jobs blend their tiles into
+        self.placed_tiles = [] # Tiles already on self.layer
+        self.errors = [] # Results that came back but couldn't be put on the canvas
+        self.backend = None # The BackendPool host running the job
+        self.backends = [] # Every backend the job was sent to. Sharded and tiled jobs run on several at once.
+        self.followed_backend = None # The one progress and previews come from
+        self.kc = None # Owns the job's worker thread and preview layer
+        self.prompt = data.get('prompt', '') # data is dropped once the job is done, keep enough to label it
+        self.swaps = [] # 'model'/'VAE' the server will have to load for this job, from SDAPI.swaps_needed()
+        # (model, VAE, refiner) the job needs loaded, or None for jobs that don't use a checkpoint (upscaling, RemBG...)
+        self.model_key = (data.get('model', None), data.get('vae', None), data.get('refiner', None)) if mode in ['txt2img', 'img2img', 'inpaint'] else None
+        self.skipped = 0 # Times a later job with the loaded model was started ahead of this one
+        self.pinned = False # Moved by the user, so it isn't passed over for model grouping
+
+    def label(self):
+        prompt = self.prompt
+        if len(prompt) > 40:
+            prompt = '%s...' % prompt[:40]
+        size = '%sx%s' % (self.w, self.h)
+        if 'tiles' in self.processing_instructions.keys():
+            size = '%s in %s tiles' % (size, len(self.processing_instructions['tiles']))
+        label = '#%s %s %s - %s' % (self.id, self.mode, size, prompt if len(prompt) > 0 else '(no prompt)')
+        if len(self.swaps) > 0 and self.status == GenerationJob.QUEUED:
+            label = '%s [loads %s]' % (label, ' and '.join(self.swaps))
+        if len(self.errors) > 0:
+            label = '%s [%s]' % (label, self.errors[-1])
+        return label
+
+    def preview_size(self):
+        # (x, y, w, h) to draw previews at, which is the size the results will end up at.
+        # None for tiled jobs, since a preview is one tile. The finished tiles show up on the canvas instead.
+        if 'tiles' in self.processing_instructions.keys():
+            return None
+        w, h = self.w, self.h
+        if 'resize' in self.processing_instructions.keys():
+            w = self.processing_instructions['resize']['width']
+            h = self.processing_instructions['resize']['height']
+        return (self.x, self.y, w, h)
+
+class JobQueue(QObject):
+    # Runs generation jobs for the whole plugin. Pages only submit jobs, so switching pages (or documents)
+    # mid-generation doesn't lose the results, and jobs can be stacked up while the server works through them.
+    # With extra hosts in the BackendPool, one job runs per host at a time.
+    changed = pyqtSignal() # Jobs were added, started, finished, cancelled or reordered
+    job_finished = pyqtSignal(object) # GenerationJob, after its results are on the canvas
+    progress_changed = pyqtSignal(object) # GenerationJob whose progress was updated
+    backend_chosen = pyqtSignal(object, object) # (GenerationJob, Backend), emitted from worker threads
+    partial_results = pyqtSignal(object, object) # (GenerationJob, results) for one iteration of a progressive job, emitted from worker threads
+    tile_results = pyqtSignal(object, object, object) # (GenerationJob, Tile, results) for one tile of a tiled job, emitted from worker threads
+    MAX_HISTORY = 20
+    STREAMING_MODES = ['txt2img', 'img2img', 'inpaint', 'extra'] # Modes whose SDAPI endpoint takes on_image
+    MAX_SKIPS = 3 # How many times a job can be passed over for jobs using the loaded model before it runs regardless
+    _shared = None
+
+    @classmethod
+    def shared(cls, api:SDAPI, settings_controller:SettingsController):
+        if cls._shared is None or cls._shared.api is not api:
+            cls._shared = JobQueue(api, settings_controller)
+        return cls._shared
+
+    def __init__(self, api:SDAPI, settings_controller:SettingsController):
+        super().__init__()
+        self.api = api
+        self.settings_controller = settings_controller
+        self.pool = BackendPool(api, self.settings_controller.get('server.extra_hosts'))
+        self.pollers = [] # ProgressPollers already connected to this queue
+        self.backend_chosen.connect(self.follow_backend)
+        self.partial_results.connect(self.deliver_partial)
+        self.tile_results.connect(self.deliver_tile)
+        self.jobs = [] # Waiting to run
+        self.running = [] # Started, oldest first
+        self.history = [] # Finished, failed and cancelled jobs, newest last
+        self.loaded_key = None # model_key of the last job started, which is what the server should have loaded
+        self.swaps_saved = 0 # Model/VAE loads avoided by running jobs out of order
+        self.started_keys = [] # (priority, order, model_key) of the jobs started since the queue was last idle
+        self.start_key = None # What the server had loaded when those started
+
+    def set_hosts(self, hosts):
+        self.pool.set_hosts(hosts) # New hosts are checked the next time a job starts
+        self.start_next() # More hosts means more jobs can run
+
+    def pending(self):
+        # The order jobs will start in. With 'server.group_by_model' jobs that use the loaded model/VAE/refiner go ahead of jobs
+        # that would make the server load something else, within the same priority. Swapping checkpoints takes 10-40 seconds,
+        # so A, B, A runs as A, A, B. A job is only passed over MAX_SKIPS times, and never once the user has moved it.
+        if not self.group_by_model():
+            return sorted(self.jobs, key=lambda job: (-job.priority, job.order))
+        return ModelGrouping.order(self.jobs, self.current_model_key(), self.same_models, JobQueue.MAX_SKIPS)
+
+    def group_by_model(self):
+        return self.settings_controller.has_key('server.group_by_model') and self.settings_controller.get('server.group_by_model')
+
+    def current_model_key(self):
+        # While jobs are running the server ends up with whatever the last one started asked for. Once it's idle,
+        # what the server reported last is better, since model warm-up or the WebUI itself may have changed it.
+        server_options = self.api.server_options
+        if (len(self.running) > 0 or 'sd_model_checkpoint' not in server_options) and self.loaded_key is not None:
+            return self.loaded_key
+        return (server_options.get('sd_model_checkpoint', None), server_options.get('sd_vae', None), None)
+
+    def same_models(self, key, other_key):
+        # None, or an empty part, means no preference (the server default), which works with anything
+        if key is None or other_key is None:
+            return True
+        for option, value, other_value in zip(['sd_model_checkpoint', 'sd_vae', 'sd_model_checkpoint'], key, other_key):
+            if value is None or other_value is None or len(value) == 0 or len(other_value) == 0:
+                continue
+            if not self.api.same_option(option, value, other_value):
+                return False
+        return True
+
+    def is_busy(self):
+        return len(self.running) > 0 or len(self.jobs) > 0
+
+    def submit(self, job:GenerationJob):
+        self.jobs.append(job)
+        self.changed.emit()
+        self.start_next()
+        return job
+
+    def cancel(self, job:GenerationJob):
+        if job in self.running:
+            job.status = GenerationJob.CANCELLED
+            apis = []
+            for backend in [*job.backends, job.backend]:
+                if backend is not None and backend.api not in apis:
+                    apis.append(backend.api)
+            for api in apis if len(apis) > 0 else [self.api]:
+                api.interrupt() # The server returns what it has so far, which still gets added in job_done()
+        elif job in self.jobs:
+            self.jobs.remove(job)
+            job.status = GenerationJob.CANCELLED
+            self._add_history(job)
+        self.changed.emit()
+
+    def cancel_all(self):
+        for job in [*self.jobs, *self.running]:
+            self.cancel(job)
+
+    def move(self, job:GenerationJob, offset:int):
+        # Swaps the job with its neighbour in the pending order. offset is -1 for sooner, 1 for later.
+        pending = self.pending()
+        if job not in pending:
+            return
+        index = pending.index(job)
+        other_index = index + offset
+        if other_index < 0 or other_index >= len(pending):
+            return
+        other = pending[other_index]
+        job.order, other.order = other.order, job.order
+        job.priority, other.priority = other.priority, job.priority
+        job.pinned = other.pinned = True # The user picked this order, don't regroup it
+        self.changed.emit()
+
+    def run_next(self, job:GenerationJob):
+        # Puts the job at the front of the queue
+        if job not in self.jobs:
+            return
+        job.priority = max([other.priority for other in self.jobs]) + 1
+        self.changed.emit()
+
+    def uses_every_host(self, job:GenerationJob):
+        return job.processing_instructions.get('shard_batch', False) or 'tiles' in job.processing_instructions
+
+    def hosts_in_use(self):
+        # A sharded batch or tiled job uses every host, anything else uses one
+        capacity = self.pool.capacity()
+        return sum([capacity if self.uses_every_host(job) else 1 for job in self.running])
+
+    def start_next(self):
+        while len(self.jobs) > 0 and self.hosts_in_use() < self.pool.capacity():
+            job = self.pending()[0]
+            if self.uses_every_host(job) and len(self.running) > 0:
+                break # It'd put its shards on hosts that are still busy. It waits until they're all free, and so does everything behind it.
+            if len(self.running) == 0 and len(self.started_keys) == 0:
+                self.start_key = self.current_model_key()
+            self.started_keys.append((-job.priority, job.order, job.model_key))
+            self.note_skips(job)
+            if job.model_key is not None:
+                self.loaded_key = job.model_key
+            self.jobs.remove(job)
+            job.status = GenerationJob.RUNNING
+            job.kc = KritaController() # Each job gets its own thread and preview layer
+            self.running.append(job)
+            self.changed.emit()
+            job.kc.run_as_thread(lambda job=job: self.run_job(job), lambda job=job: self.job_done(job)) # job=job, or every lambda sees the last job
+
+    def note_skips(self, job:GenerationJob):
+        # Counts the jobs that arrived earlier with the same priority, that job is starting ahead of
+        for other in self.jobs:
+            if other is not job and other.priority == job.priority and other.order < job.order:
+                other.skipped += 1
+
+    def count_saved_swaps(self):
+        # Once the queue is idle, compares the loads the jobs that ran needed against what running them in the order
+        # they were queued would've needed. Done per busy stretch, since a job queued later can't be grouped with one long gone.
+        self.swaps_saved += ModelGrouping.saved_swaps(self.started_keys, self.start_key, self.same_models)
+        self.started_keys = []
+        self.changed.emit()
+
+    @staticmethod
+    def decode_image(b64_str):
+        # on_image for SDAPI.post_streaming(). Each image is turned into its compressed bytes as soon as it's off the socket,
+        # so the response never holds the base64 text, which is a third bigger. KritaController takes either.
+        if b64_str is None or len(b64_str) == 0:
+            return b64_str
+        return base64.b64decode(b64_str)
+
+    def run_job(self, job:GenerationJob):
+        # Runs on a worker thread, don't touch Krita or widgets here
+        on_backend = lambda backend: self.dispatched(job, backend)
+        on_image = JobQueue.decode_image if job.mode in JobQueue.STREAMING_MODES else None
+        if 'tiles' in job.processing_instructions:
+            self.run_tiled(job, on_backend, on_image)
+        elif job.processing_instructions.get('shard_batch', False):
+            job.results, backend = self.pool.run_sharded(job.mode, job.data, on_backend, self.prune_results, on_image)
+            job.backend = job.followed_backend if job.followed_backend is not None else backend # job_done() unsubscribes from the host that was followed
+        elif job.processing_instructions.get('progressive', False):
+            self.run_progressive(job, on_backend, on_image)
+        else:
+            job.results, job.backend = self.pool.run(job.mode, job.data, on_backend, on_image)
+
+    def dispatched(self, job:GenerationJob, backend):
+        # Worker threads. Remembers every host the job went to, so cancel() can interrupt all of them.
+        if backend not in job.backends:
+            job.backends.append(backend)
+        if job.processing_instructions.get('shard_batch', False) and job.followed_backend is not None and job.followed_backend.healthy is not False:
+            return # Shards are the same size, so one host's progress stands for all of them. Switching would make previews jump between hosts.
+        job.followed_backend = backend
+        self.backend_chosen.emit(job, backend)
+
+    def run_progressive(self, job:GenerationJob, on_backend, on_image=None):
+        # Runs the batch count as one request per iteration, handing each one to the GUI thread as soon as it's back.
+        # Seeds continue from one request to the next, the same as the server would've done in one request.
+        batch_count = job.data.get('batch_count', 1)
+        batch_size = job.data.get('batch_size', 1)
+        seed = BackendPool.fixed_seed(job.data.get('seed', -1))
+        subseed = BackendPool.fixed_seed(job.data.get('subseed', -1))
+        job.iterations = batch_count
+        for i in range(0, batch_count):
+            if job.status == GenerationJob.CANCELLED:
+                break # Whatever already arrived stays on the canvas
+            job.iteration = i
+            data = dict(job.data)
+            data['batch_count'] = 1
+            data['seed'] = seed + i * batch_size
+            data['subseed'] = subseed + i * batch_size
+            BackendPool.mark_random(job.data, data)
+            results, job.backend = self.pool.run(job.mode, data, on_backend, on_image)
+            if results is None:
+                break
+            self.partial_results.emit(job, results)
+
+    def run_tiled(self, job:GenerationJob, on_backend, on_image=None):
+        # Generates the tiles at the same time, one per host, and hands each one to the GUI thread to blend in as it finishes.
+        # Every tile uses the same seed, so the tiles share a look. Batches don't make sense here, so each tile is one image.
+        # Upscaling ('extra') works the same way, each tile's data has its own crop of the image and the size to upscale it to.
+        # on_backend is dispatched(), so every host with a tile in flight is in job.backends for cancel() to interrupt.
+        tiles = job.processing_instructions['tiles']
+        job.iterations = max(1, len(tiles))
+        seed = BackendPool.fixed_seed(job.data.get('seed', -1))
+        subseed = BackendPool.fixed_seed(job.data.get('subseed', -1))
+
+        def run_tile(tile):
+            if job.status == GenerationJob.CANCELLED:
+                return # Tiles that already finished stay on the canvas
+            data = dict(job.data)
+            data.update(tile.data)
+            tile.data = None # The cropped uploads are in data now, don't keep a second reference around
+            if job.mode != 'extra':
+                data['batch_count'] = 1
+                data['batch_size'] = 1
+                data['seed'] = seed
+                data['subseed'] = subseed
+                BackendPool.mark_random(job.data, data)
+            results, backend = self.pool.run(job.mode, data, on_backend, on_image)
+            del data
+            if backend is not None:
+                job.backend = backend
+            if results is not None and job.status != GenerationJob.CANCELLED:
+                self.tile_results.emit(job, tile, results) # An interrupted tile is half denoised, it would show as a noisy patch
+            job.iteration += 1
+
+        with ThreadPoolExecutor(max_workers=self.pool.capacity()) as executor:
+            [*executor.map(run_tile, tiles)]
+
+    def deliver_tile(self, job:GenerationJob, tile, results):
+        try:
+            results = self.prune_results(results)
+            if 'image' in results: # extras results
+                image = results.pop('image')
+            else:
+                images = results.get('images', [])
+                image = images.pop(0) if len(images) > 0 else None
+            if image is None or len(image) == 0:
+                return
+            kc = KritaController()
+            if job.layer is None:
+                job.layer = kc.create_tiled_layer(job.processing_instructions.get('layer_name', 'Tiled'), below_layer=self.below_layer(kc, job), doc=job.doc)
+            kc.blend_tile(job.layer, image, job.x + tile.x, job.y + tile.y, tile.w, tile.h, tile.feather_edges(job.placed_tiles), doc=job.doc)
+            del image
+            job.placed_tiles.append(tile)
+            job.images_delivered = 1 # All the tiles make one image
+        except Exception as e:
+            self.delivery_failed(job, 'tile %s' % (tile.index + 1), e)
+
+    def deliver_partial(self, job:GenerationJob, results):
+        try:
+            results = self.prune_results(results)
+            if job.group is None and job.iterations * len(results.get('images', [])) > 1:
+                kc = KritaController()
+                job.group = kc.create_results_group(below_layer=self.below_layer(kc, job), doc=job.doc)
+            self.deliver(job, results)
+        except Exception as e:
+            self.delivery_failed(job, 'part of the batch', e)
+
+    def delivery_failed(self, job:GenerationJob, part, e):
+        # Krita refused part of the results. The job is marked failed in job_done(), rather than finishing with a hole in it.
+        error = 'Error adding %s to the canvas: %s' % (part, e)
+        print('Cyanic SD - Job #%s: %s' % (job.id, error))
+        job.errors.append(error)
+
+    def follow_backend(self, job:GenerationJob, backend):
+        # Progress and previews come from whichever host is running the job
+        job.backend = backend
+        poller = ProgressPoller.shared(backend.api, self.settings_controller)
+        if poller not in self.pollers:
+            self.pollers.append(poller)
+            poller.progress_changed.connect(lambda results: self.update_progress(poller, results))
+            poller.preview_ready.connect(lambda: self.show_preview(poller))
+        if job in self.running:
+            poller.subscribe(self, job.preview_size())
+
+    def jobs_on(self, poller):
+        return [job for job in self.running if job.backend is not None and job.backend.api is poller.api]
+
+    def update_progress(self, poller, results):
+        if results is None:
+            return
+        for job in self.jobs_on(poller):
+            job.progress = min(1.0, (job.iteration + (results.get('progress', 0) or 0)) / job.iterations)
+            self.progress_changed.emit(job)
+
+    def job_done(self, job:GenerationJob):
+        if job not in self.running:
+            return
+        self.running.remove(job)
+        job.kc.delete_preview_layer()
+        if job.backend is not None:
+            poller = ProgressPoller.shared(job.backend.api, self.settings_controller)
+            if len(self.jobs_on(poller)) == 0:
+                poller.unsubscribe(self)
+        if job.mode == 'interrogate':
+            pass # Nothing goes on the canvas. The page that asked reads the caption from job.results in job_finished.
+        elif job.results is not None:
+            try:
+                self.deliver(job, job.results)
+            except Exception as e:
+                self.delivery_failed(job, 'the results', e)
+        if job.status != GenerationJob.CANCELLED:
+            delivered = job.images_delivered > 0 or (job.mode == 'interrogate' and job.results is not None)
+            job.status = GenerationJob.DONE if delivered and len(job.errors) == 0 else GenerationJob.FAILED
+        job.data = None # The uploaded images aren't needed anymore
+        for tile in job.processing_instructions.get('tiles', []):
+            tile.data = None # Tiles skipped by cancelling still have their crops
+        self._add_history(job)
+        self.job_finished.emit(job)
+        self.changed.emit()
+        self.start_next()
+        if not self.is_busy() and len(self.started_keys) > 0:
+            self.count_saved_swaps()
+
+    def prune_results(self, results):
+        # Prune the results images so that ControlNet preprocessors or masks aren't included in the results
+        if 'images' in results and 'parameters' in results and 'batch_size' in results['parameters'] and 'n_iter' in results['parameters']:
+            expected_images = results['parameters']['batch_size'] * results['parameters']['n_iter']
+            if len(results['images']) > expected_images:
+                # Determine if the extra images are from ControlNet (after the results), or Grid previews (before the results), or a combination of the two
+                if results['parameters']['save_images']:
+                    # Remove the grid from the front
+                    results['images'] = results['images'][1:]
+                if len(results['images']) > expected_images: # Checking again incase the grid was the difference
+                    results['images'] = results['images'][:expected_images]
+        return results
+
+    def below_layer(self, kc:KritaController, job:GenerationJob):
+        if 'results_below_layer_uuid' in job.processing_instructions and kc.document_is_open(job.doc):
+            kc.doc = job.doc
+            return kc._get_layer_with_uid(job.processing_instructions['results_below_layer_uuid'])
+        return None
+
+    @staticmethod
+    def count_images(results):
+        # Images results_to_layers() will place: the 'images' list from txt2img/img2img, or the single 'image' from extras and RemBG
+        images = [*results.get('images', []), results.get('image', None)]
+        return len([image for image in images if image is not None and len(image) > 0])
+
+    def deliver(self, job:GenerationJob, results):
+        results = self.prune_results(results)
+        job.results = None
+        images = JobQueue.count_images(results) # Counted first, results_to_layers() releases them
+        kc = KritaController()
+        if job.processing_instructions.get('as_transparency_mask', False) and kc.document_is_open(job.doc):
+            # RemBG's mask goes on the layer that was active when the job was made
+            kc.doc = job.doc
+            layer = kc._get_layer_with_uid(job.processing_instructions['mask_layer_uuid'])
+            if layer is not None:
+                kc.doc.setActiveNode(layer)
+            kc.result_to_transparency_mask(results, job.x, job.y, job.w, job.h)
+            job.images_delivered += images
+            return
+        below_layer = None if job.group is not None else self.below_layer(kc, job)
+        kc.results_to_layers(results, job.x, job.y, job.w, job.h, below_layer=below_layer, release_images=True, doc=job.doc, group=job.group)
+        job.images_delivered += images
+
+    def show_preview(self, poller):
+        frame = poller.take_preview()
+        jobs = self.jobs_on(poller)
+        if frame is None or len(jobs) == 0:
+            return
+        job = jobs[-1] # The poller decodes at the size of the latest job subscribed on that host
+        byte_array, img_w, img_h, preview_size = frame
+        try:
+            job.kc.update_preview_layer_pixels(byte_array, preview_size[0], preview_size[1], img_w, img_h, doc=job.doc)
+        except Exception as e:
+            pass
+
+    def _add_history(self, job:GenerationJob):
+        self.history.append(job)
+        if len(self.history) > JobQueue.MAX_HISTORY:
+            self.history = self.history[-JobQueue.MAX_HISTORY:]
@@ -0,0 +1,227 @@
+import json
+import re
+
+class JSONImageStream():
+    # Parses a generation response while it's still coming in, handing each base64 image to on_image() as soon as it's complete.
+    # The whole response is never held as bytes or as a str, only one image at a time plus the small fields (info, parameters).
+    # on_image(b64_str) returns whatever should go in the results in the image's place: the string itself, None after it's been
+    # used, or something smaller like a decoded QImage.
+    CHUNK_SIZE = 64 * 1024
+    STRUCTURE = re.compile(rb'["{}\[\]]') # Everything that matters when skipping over a value
+    SCALAR_END = re.compile(rb'[,}\]]') # Numbers, true, false and null end at whatever comes after them
+    WHITESPACE = b' \t\r\n'
+
+    def __init__(self, read, on_image=None, image_keys=('images', 'image'), chunk_size=CHUNK_SIZE):
+        # read(n) returns up to n bytes, and b'' at the end (HTTPResponse.read, file.read)
+        self.read = read
+        self.on_image = on_image if on_image is not None else (lambda image: image)
+        self.image_keys = image_keys
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # Drops what's been parsed and appends the next chunk. Returns False at the end of the stream.
+        if self.eof:
+            return False
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _next_char(self):
+        # The next byte that isn't whitespace, without consuming it. None at the end of the stream.
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in JSONImageStream.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos:self.pos + 1]
+            if not self._fill():
+                return None
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError('Cyanic SD - Expected %s in the response' % char.decode())
+        self.pos += 1
+
+    def _string_end(self, start):
+        # Index of the quote closing a string that started before `start`, or -1 if it isn't in the buffer yet
+        end = self.buffer.find(b'"', start)
+        while end > -1:
+            backslashes = 0
+            while end - backslashes - 1 >= start and self.buffer[end - backslashes - 1] == 0x5c: # '\'
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end
+            end = self.buffer.find(b'"', end + 1)
+        return -1
+
+    def _read_string(self):
+        # Reads a string value, returned as the raw bytes between the quotes (escapes untouched)
+        self._expect(b'"')
+        parts = []
+        while True:
+            end = self._string_end(self.pos)
+            if end > -1:
+                parts.append(self.buffer[self.pos:end])
+                self.pos = end + 1
+                return b''.join(parts)
+            # Keep any backslashes at the end, they might escape a quote at the start of the next chunk
+            keep = 0
+            while len(self.buffer) - keep - 1 >= self.pos and self.buffer[len(self.buffer) - keep - 1] == 0x5c:
+                keep += 1
+            parts.append(self.buffer[self.pos:len(self.buffer) - keep])
+            self.pos = len(self.buffer) - keep
+            if not self._fill():
+                raise ValueError('Cyanic SD - The response ended inside a string')
+
+    def _decode_string(self, raw:bytes):
+        if b'\\' in raw:
+            return json.loads(b'"' + raw + b'"')
+        return raw.decode('utf-8') # Base64 never has escapes, skip the json module's copy
+
+    def _read_raw_value(self):
+        # The bytes of one complete value of any type, for json.loads(). Strings inside are skipped with _read_string().
+        char = self._next_char()
+        if char == b'"':
+            return b'"' + self._read_string() + b'"'
+        parts = []
+        depth = 0
+        while True:
+            if depth == 0 and char not in [b'{', b'[']:
+                end = JSONImageStream.SCALAR_END.search(self.buffer, self.pos)
+                if end is None:
+                    parts.append(self.buffer[self.pos:])
+                    self.pos = len(self.buffer)
+                    if not self._fill():
+                        return b''.join(parts)
+                    continue
+                parts.append(self.buffer[self.pos:end.start()])
+                self.pos = end.start()
+                return b''.join(parts)
+            match = JSONImageStream.STRUCTURE.search(self.buffer, self.pos)
+            if match is None:
+                parts.append(self.buffer[self.pos:])
+                self.pos = len(self.buffer)
+                if not self._fill():
+                    raise ValueError('Cyanic SD - The response ended inside a value')
+                continue
+            parts.append(self.buffer[self.pos:match.start()])
+            self.pos = match.start()
+            token = self.buffer[self.pos:self.pos + 1]
+            if token == b'"':
+                parts.append(b'"' + self._read_string() + b'"')
+                continue
+            parts.append(token)
+            self.pos += 1
+            depth += 1 if token in [b'{', b'['] else -1
+            if depth == 0:
+                return b''.join(parts)
+
+    def _read_images(self):
+        # An image key's value: one base64 string, or a list of them
+        if self._next_char() == b'"':
+            return self.on_image(self._decode_string(self._read_string()))
+        if self._next_char() != b'[':
+            return json.loads(self._read_raw_value())
+        self.pos += 1
+        images = []
+        if self._next_char() == b']':
+            self.pos += 1
+            return images
+        while True:
+            if self._next_char() == b'"':
+                images.append(self.on_image(self._decode_string(self._read_string())))
+            else:
+                images.append(json.loads(self._read_raw_value())) # null
+            char = self._next_char()
+            self.pos += 1
+            if char == b']':
+                return images
+            if char != b',':
+                raise ValueError('Cyanic SD - Expected , or ] in the images list')
+
+    def parse(self):
+        # Returns the response as a dict, with each image replaced by what on_image() returned.
+        # Anything that isn't an object (a plain error message, say) is read whole and returned as json.loads() would.
+        if self._next_char() != b'{':
+            rest = [self.buffer[self.pos:]]
+            self.pos = len(self.buffer) # Already in rest, _fill() would carry it over again
+            while self._fill():
+                rest.append(self.buffer)
+                self.pos = len(self.buffer)
+            return json.loads(b''.join(rest))
+        self.pos += 1
+        results = {}
+        if self._next_char() == b'}':
+            self.pos += 1
+            return results
+        while True:
+            key = self._decode_string(self._read_string())
+            self._expect(b':')
+            if key in self.image_keys:
+                results[key] = self._read_images()
+            else:
+                results[key] = json.loads(self._read_raw_value())
+            char = self._next_char()
+            self.pos += 1
+            if char == b'}':
+                return results
+            if char != b',':
+                raise ValueError('Cyanic SD - Expected , or } in the response')
+
+
+class JSONBody():
+    # A request body that serializes itself while it's being sent. Big strings (base64 images) are referenced, not copied,
+    # and go out in slices straight from the str, so a payload with several images never exists as one str or bytes object.
+    # Everything else goes through json.dumps(). The length is known up front, for the Content-Length header.
+    # Iterating again starts over, so a request can be retried with the same body.
+    INLINE_LIMIT = 64 * 1024 # Strings shorter than this are serialized with everything around them
+    CHUNK_SIZE = 1024 * 1024
+    NEEDS_ESCAPING = re.compile(r'[^\x20\x21\x23-\x5b\x5d-\x7e]') # Control characters, non-ASCII, quotes and backslashes
+
+    def __init__(self, data):
+        self.parts = [] # bytes, or a str that can be written as-is between quotes
+        self.pending = [] # Small pieces not yet joined into a bytes part
+        self._add(data)
+        self._flush()
+        self.length = sum([len(part) for part in self.parts]) # str parts are pure ASCII, one byte per character
+
+    def _flush(self):
+        if len(self.pending) > 0:
+            self.parts.append(''.join(self.pending).encode('utf-8'))
+            self.pending = []
+
+    def _add(self, value):
+        if type(value) is dict:
+            self.pending.append('{')
+            for i, (key, item) in enumerate(value.items()):
+                self.pending.append('%s%s: ' % (', ' if i > 0 else '', json.dumps(str(key))))
+                self._add(item)
+            self.pending.append('}')
+        elif type(value) in [list, tuple]:
+            self.pending.append('[')
+            for i, item in enumerate(value):
+                if i > 0:
+                    self.pending.append(', ')
+                self._add(item)
+            self.pending.append(']')
+        elif type(value) is str and len(value) >= JSONBody.INLINE_LIMIT and JSONBody.NEEDS_ESCAPING.search(value) is None:
+            self.pending.append('"')
+            self._flush()
+            self.parts.append(value)
+            self.pending.append('"')
+        else:
+            self.pending.append(json.dumps(value))
+
+    def __iter__(self):
+        for part in self.parts:
+            if type(part) is bytes:
+                yield part
+                continue
+            for start in range(0, len(part), JSONBody.CHUNK_SIZE):
+                yield part[start:start + JSONBody.CHUNK_SIZE].encode('ascii')
@@ -1,8 +1,10 @@
 from krita import *
-from PyQt5.QtGui import QImage
+from PyQt5.QtGui import QImage, QImageWriter, QPainter, QLinearGradient, QColor
 from PyQt5.QtCore import QBuffer, QIODevice, QByteArray, QThread, QPointF, pyqtSignal, Qt, QTimer
 import base64
 import random
+import time
+from .image_cache import EncodedImageCache
 # https://scripting.krita.org/lessons/layers
 # https://api.kde.org/krita/html/classNode.html
 
@@ -20,9 +22,21 @@ class GenericWorker(QObject):
         self.finished.emit()
 
 class KritaController():
+    # Upload encodings, as (Qt format, Qt quality, convert to grayscale first).
+    # For PNG, Qt's quality is the inverse of zlib's compression level. 80 works out to level 1, which is several times faster
+    # than the default and still lossless. JPEG/WebP use the quality passed to qimage_to_b64_str() and drop transparency.
+    UPLOAD_FORMATS = {
+        'PNG': ('PNG', -1, False),
+        'PNG (fast)': ('PNG', 80, False),
+        'PNG (grayscale)': ('PNG', 80, True), # Lossless for masks, which are already gray, and a quarter of the pixels to compress
+        'JPEG': ('JPG', None, False),
+        'WebP': ('WEBP', None, False),
+    }
+    encoded_images = EncodedImageCache() # Shared by every KritaController, since each widget makes its own
     def __init__(self):
         self.doc = Krita.instance().activeDocument()
         self.preview_layer_uid = None
+        self.decode_stats = [] # One dict per decoded image in the last results_to_layers() call
 
     def version_gte(self, target_version):
         # Check if the current version is greater than or equal to the target version
@@ -57,6 +71,9 @@ class KritaController():
     def refresh_doc(self):
         self.doc = Krita.instance().activeDocument()
 
+    def document_is_open(self, doc):
+        return doc is not None and doc in Krita.instance().documents()
+
     def get_selection_bounds(self):
         self.doc = Krita.instance().activeDocument()
         if self.doc is None:
@@ -127,40 +144,94 @@ class KritaController():
         # return width, height
         return self.doc.width(), self.doc.height()
     
-    def base64_to_pixeldata(self, base64str:str, width=-1, height=-1):
-        b64img_data = base64.b64decode(base64str)
-        png_start = 'iVBORw0KGgo' # this byte sequence is always at the start of PNG images
-        image = None
-        if base64str.find(png_start) == 0:
-            image = QImage.fromData(b64img_data, 'PNG') # This formats the bytes in a way Krita can understand them
-        else:
-            image = QImage.fromData(b64img_data, 'JPEG')
+    @staticmethod
+    def result_image_bytes(image):
+        # Result images are the API's base64 str, or the compressed bytes JobQueue.decode_image() already turned it into
+        # while the response was streaming in. Returns the compressed bytes and 'PNG' or 'JPEG'.
+        if type(image) is str:
+            image = base64.b64decode(image)
+        png_start = b'\x89PNG' # this byte sequence is always at the start of PNG images
+        return image, 'PNG' if image[:4] == png_start else 'JPEG'
+
+    def base64_to_pixeldata(self, base64str, width=-1, height=-1):
+        # Goes from the API's base64 string to the bytes Node.setPixelData() wants, keeping as few full-size copies alive as possible.
+        # Each intermediate is released as soon as the next step has what it needs, and the copies made are recorded in self.decode_stats.
+        # base64str can also be the already decoded bytes, see result_image_bytes().
+        start = time.perf_counter()
+        stats = {
+            'encoded_bytes': len(base64str),
+            'decoded_bytes': 0,
+            'bytes_copied': 0,
+            'copies': 0,
+        }
+        b64img_data, image_format = KritaController.result_image_bytes(base64str)
+        if type(base64str) is str:
+            stats['bytes_copied'] += len(b64img_data)
+            stats['copies'] += 1
+        image = QImage.fromData(b64img_data, image_format) # This formats the bytes in a way Krita can understand them
+        del b64img_data # The compressed bytes aren't needed once the image is decoded
+        stats['decoded_bytes'] = image.byteCount()
+        stats['bytes_copied'] += image.byteCount()
+        stats['copies'] += 1
 
         # If the image is grayscale (like ControlNet previews often are), convert it to full color
         # if image.format() == QImage.Format_Grayscale8 or image.format() == QImage.Format_Grayscale16:
         if image.isGrayscale():
-            image = image.convertToFormat(QImage.Format_RGBA8888) 
+            image = image.convertToFormat(QImage.Format_RGBA8888) # Reassigning frees the grayscale version right away
+            stats['bytes_copied'] += image.byteCount()
+            stats['copies'] += 1
         
         # scale the image, used for previews to prevent flickering when scaling
-        if width > -1:
+        # Skipped when it's already the right size, since scaling always makes a new full-size copy
+        if width > -1 and width != image.width():
             image = image.scaledToWidth(width)
-        if height > -1:
+            stats['bytes_copied'] += image.byteCount()
+            stats['copies'] += 1
+        if height > -1 and height != image.height():
             image = image.scaledToHeight(height)
-        image_bits = image.bits()
-        if image_bits is not None:
-            image_bits.setsize(image.byteCount())
-            byte_array = QByteArray(image_bits.asstring())
-            return byte_array, image.width(), image.height()
-        else:
-            return QByteArray(), 0, 0
+            stats['bytes_copied'] += image.byteCount()
+            stats['copies'] += 1
 
-    def qimage_to_b64_str(self, image:QImage):
+        image_bits = image.constBits()
+        if image_bits is None:
+            return QByteArray(), 0, 0
+        image_bits.setsize(image.byteCount())
+        # PyQt can only hand the pixels over as bytes (one copy), which QByteArray copies once more. The bytes are freed on the same line.
+        # QByteArray is implicitly shared, so setPixelData() doesn't copy it again.
+        byte_array = QByteArray(image_bits.asstring())
+        stats['bytes_copied'] += 2 * byte_array.size()
+        stats['copies'] += 2
+        image_w, image_h = image.width(), image.height()
+        del image_bits
+        del image
+        stats['seconds'] = time.perf_counter() - start
+        self.decode_stats.append(stats)
+        return byte_array, image_w, image_h
+
+    def qimage_to_b64_str(self, image:QImage, upload_format='PNG', quality=95):
+        # upload_format is a key of UPLOAD_FORMATS. quality (0-100) is only used by JPEG and WebP.
+        qt_format, qt_quality, grayscale = KritaController.UPLOAD_FORMATS.get(upload_format, KritaController.UPLOAD_FORMATS['PNG'])
+        if qt_quality is None:
+            qt_quality = quality
+        if qt_format == 'WEBP' and not b'webp' in QImageWriter.supportedImageFormats():
+            # Krita builds without the WebP image plugin, fall back to something lossless
+            qt_format, qt_quality, grayscale = KritaController.UPLOAD_FORMATS['PNG (fast)']
+        cache_key = EncodedImageCache.image_key(image, qt_format, qt_quality, grayscale)
+        if cache_key is not None:
+            b64_str = KritaController.encoded_images.get(cache_key)
+            if b64_str is not None:
+                return b64_str
+        if grayscale:
+            image = image.convertToFormat(QImage.Format_Grayscale8)
         ba = QByteArray()
         buffer = QBuffer(ba)
         buffer.open(QIODevice.OpenModeFlag.WriteOnly)
-        image.save(buffer, 'PNG')
+        image.save(buffer, qt_format, qt_quality)
         b64_data = ba.toBase64().data()
-        return b64_data.decode()
+        b64_str = b64_data.decode()
+        if cache_key is not None:
+            KritaController.encoded_images.set(cache_key, b64_str)
+        return b64_str
 
     def find_below(self, below_layer=None):
         dest = None
@@ -185,10 +256,32 @@ class KritaController():
             child_node = self.doc.activeNode()
         return child_node.parentNode()
 
-    def results_to_layers(self, results, x=0, y=0, w=-1, h=-1, layer_name='', below_active=False, below_layer=None):
-        self.doc = Krita.instance().activeDocument()
+    def create_results_group(self, below_active=False, below_layer=None, doc=None):
+        # The "Results" group results_to_layers() makes for batches, made up front so images can be added to it as they arrive
+        self.doc = doc if self.document_is_open(doc) else Krita.instance().activeDocument()
         if self.doc is None:
             self.create_new_doc()
+        group = self.doc.createGroupLayer("Results")
+        self.add_results_group(group, below_active, below_layer)
+        return group
+
+    def add_results_group(self, group, below_active=False, below_layer=None):
+        if below_active or below_layer is not None:
+            parent = self.find_parent_node(below_layer)
+            dest = self.find_below(below_layer)
+            parent.addChildNode(group, dest)
+        else:
+            self.doc.rootNode().addChildNode(group, None)
+
+    def results_to_layers(self, results, x=0, y=0, w=-1, h=-1, layer_name='', below_active=False, below_layer=None, release_images=False, doc=None, group=None):
+        # release_images drops each base64 string from results as soon as it's on a layer, which keeps peak memory down for big batches.
+        # Only use it when nothing reads the images afterwards.
+        # doc is the document the job was started from. Defaults to (and falls back to, if it was closed) the active document.
+        # group is a group from create_results_group() to add the images to, instead of making a new one.
+        self.doc = doc if self.document_is_open(doc) else Krita.instance().activeDocument()
+        if self.doc is None:
+            self.create_new_doc()
+        self.decode_stats = []
 
         if w < 0 or h < 0:
             # This is for img2img/txt2img results
@@ -214,8 +307,10 @@ class KritaController():
             img_layer_parent = self.find_parent_node(below_layer)
 
         if 'images' in results: # txt2img or img2img results
-            if len(results['images']) > 1:
+            new_group = group is None and len(results['images']) > 1
+            if new_group:
                 group = self.doc.createGroupLayer("Results")
+            if group is not None:
                 img_layer_parent = group
             
             for i in range(0, len(results['images'])):
@@ -229,22 +324,20 @@ class KritaController():
                     continue
                 layer = self.doc.createNode(name, 'paintLayer')
                 byte_array, img_w, img_h = self.base64_to_pixeldata(results['images'][i])
+                if release_images:
+                    results['images'][i] = None
                 layer.setPixelData(byte_array, x, y, img_w, img_h)
+                del byte_array # Krita has its own copy now
                 dest = None
-                if len(results['images']) == 1 and (below_active or below_layer is not None):
+                if group is None and (below_active or below_layer is not None):
                     dest = self.find_below(below_layer)
                 img_layer_parent.addChildNode(layer, dest)
                 if img_w != w or img_h != h:
                     self.transform_to_width_height(layer, x, y, w, h)
                 self.doc.refreshProjection()
 
-            if len(results['images']) > 1:
-                if below_active or below_layer is not None:
-                    parent = self.find_parent_node(below_layer)
-                    dest = self.find_below(below_layer)
-                    parent.addChildNode(group, dest)
-                else:
-                    self.doc.rootNode().addChildNode(group, None)
+            if new_group:
+                self.add_results_group(group, below_active, below_layer)
 
         if 'image' in results: # extras results
             name = 'Image'
@@ -280,8 +373,101 @@ class KritaController():
             self.doc.refreshProjection()
 
         self.doc.refreshProjection()
+        self.report_decode_stats()
+
+    def report_decode_stats(self):
+        # One line per results_to_layers() call, in Krita's log (or the terminal it was started from)
+        if len(self.decode_stats) == 0:
+            return
+        seconds = sum([stats['seconds'] for stats in self.decode_stats])
+        bytes_copied = sum([stats['bytes_copied'] for stats in self.decode_stats])
+        decoded_bytes = sum([stats['decoded_bytes'] for stats in self.decode_stats])
+        copies = sum([stats['copies'] for stats in self.decode_stats])
+        megabyte = 1024 * 1024
+        print('Cyanic SD - Decoded %s image(s) in %.3fs, %.1f MB of pixels, %.1f MB copied in %s copies' % (len(self.decode_stats), seconds, decoded_bytes / megabyte, bytes_copied / megabyte, copies))
 
 
+    def create_tiled_layer(self, name='Tiled', below_active=False, below_layer=None, doc=None):
+        # The empty layer a tiled generation blends its tiles into, added where results_to_layers() would put a single image
+        self.doc = doc if self.document_is_open(doc) else Krita.instance().activeDocument()
+        if self.doc is None:
+            self.create_new_doc()
+        layer = self.doc.createNode(name, 'paintLayer')
+        self.add_results_group(layer, below_active, below_layer)
+        return layer
+
+    def blend_tile(self, layer, base64str, x, y, w, h, feather={}, doc=None):
+        # Draws one tile over what's already on the layer at x, y, scaled to w x h.
+        # feather is {edge: pixels} from Tile.feather_edges(). Those edges fade from transparent to opaque across the overlap,
+        # so the tile blends into the neighbours already there. Only one tile's pixels are held at a time.
+        tile_data, image_format = KritaController.result_image_bytes(base64str)
+        tile = QImage.fromData(tile_data)
+        del tile_data
+        if tile.width() != w or tile.height() != h:
+            tile = tile.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        tile = tile.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        if len(feather) > 0:
+            painter = QPainter(tile)
+            painter.setCompositionMode(QPainter.CompositionMode_DestinationIn) # Multiplies the tile's alpha by the gradient's
+            ramps = {
+                'left': ((0, 0), (feather.get('left', 0), 0), (0, 0, feather.get('left', 0), h)),
+                'right': ((w, 0), (w - feather.get('right', 0), 0), (w - feather.get('right', 0), 0, feather.get('right', 0), h)),
+                'top': ((0, 0), (0, feather.get('top', 0)), (0, 0, w, feather.get('top', 0))),
+                'bottom': ((0, h), (0, h - feather.get('bottom', 0)), (0, h - feather.get('bottom', 0), w, feather.get('bottom', 0))),
+            }
+            for edge in feather.keys():
+                if edge in ramps:
+                    start, end, rect = ramps[edge]
+                    gradient = QLinearGradient(*start, *end)
+                    gradient.setColorAt(0, QColor(0, 0, 0, 0))
+                    gradient.setColorAt(1, QColor(0, 0, 0, 255))
+                    painter.fillRect(*rect, gradient)
+                else:
+                    corner_w, corner_h = feather[edge]
+                    corner_x = 0 if edge.endswith('left') else w - corner_w
+                    corner_y = 0 if edge.startswith('top') else h - corner_h
+                    painter.drawImage(corner_x, corner_y, self.corner_feather_mask(edge, corner_w, corner_h))
+            painter.end()
+
+        # Krita's RGBA 8 bit pixel data is BGRA, the same bytes as QImage.Format_ARGB32
+        existing = layer.pixelData(x, y, w, h)
+        canvas = QImage(existing.data(), w, h, w * 4, QImage.Format_ARGB32).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        del existing
+        painter = QPainter(canvas)
+        painter.drawImage(0, 0, tile)
+        painter.end()
+        del tile
+        canvas = canvas.convertToFormat(QImage.Format_ARGB32)
+        bits = canvas.constBits()
+        bits.setsize(canvas.byteCount())
+        byte_array = QByteArray(bits.asstring())
+        del bits
+        del canvas
+        layer.setPixelData(byte_array, x, y, w, h)
+        self.doc = doc if self.document_is_open(doc) else Krita.instance().activeDocument()
+        if self.doc is not None:
+            self.doc.refreshProjection()
+
+    def corner_feather_mask(self, corner, w, h):
+        # Alpha for a corner of a tile that only a diagonal neighbour overlaps: 0 at the corner itself, and the larger of
+        # the two linear ramps everywhere else. That reaches 1 along both inner sides, so it meets the rest of the tile without a seam.
+        ramp = QImage(w, h, QImage.Format_RGB32)
+        ramp.fill(QColor(0, 0, 0))
+        painter = QPainter(ramp)
+        painter.setCompositionMode(QPainter.CompositionMode_Lighten) # Keeps the brighter of the two ramps, the max
+        corner_x = 0 if corner.endswith('left') else w
+        corner_y = 0 if corner.startswith('top') else h
+        for end in [(w - corner_x, corner_y), (corner_x, h - corner_y)]:
+            gradient = QLinearGradient(corner_x, corner_y, *end)
+            gradient.setColorAt(0, QColor(0, 0, 0))
+            gradient.setColorAt(1, QColor(255, 255, 255))
+            painter.fillRect(0, 0, w, h, gradient)
+        painter.end()
+        mask = QImage(w, h, QImage.Format_ARGB32)
+        mask.fill(QColor(0, 0, 0))
+        mask.setAlphaChannel(ramp.convertToFormat(QImage.Format_Grayscale8))
+        return mask
+
     def result_to_transparency_mask(self, results, x=0, y=0, w=-1, h=-1):
         delay = 500 #ms
         old_active = self.doc.activeNode()
@@ -395,13 +581,43 @@ class KritaController():
         return self.projection_to_qimage(ba, x, y, width, height)
 
     def convert_qimage_to_grayscale_mask(self, image, width, height):
-        for pixel_x in range(0, width):
-            for pixel_y in range(0, height):
-                pixel = image.pixel(pixel_x, pixel_y)
-                alpha = qAlpha(pixel)
-                newPixel = qRgb(alpha, alpha, alpha)
-                image.setPixel(pixel_x, pixel_y, newPixel)
-        return image
+        # Alpha becomes the gray value (transparent = black, painted = white), the same as setting qRgb(alpha, alpha, alpha) on every pixel.
+        # Looping over pixels in Python took tens of seconds on big canvases, so this uses whole-image conversions instead:
+        # copy the alpha channel out as an 8 bit image, read those bytes as grayscale, then convert back to the original format.
+        if image.width() != width or image.height() != height:
+            image = image.copy(0, 0, width, height)
+        alpha = image.convertToFormat(QImage.Format_Alpha8)
+        gray = QImage(alpha.constBits(), alpha.width(), alpha.height(), alpha.bytesPerLine(), QImage.Format_Grayscale8)
+        return gray.convertToFormat(image.format()) # Makes a copy, so nothing points at alpha's memory after this returns
+
+    def get_mask_bounds(self, mask:QImage, padding=0):
+        # Returns x, y, w, h of the painted (non-black) part of a mask from convert_qimage_to_grayscale_mask, relative to the mask.
+        # padding grows the box on every side, clamped to the mask. Returns None if nothing is painted.
+        gray = mask.convertToFormat(QImage.Format_Grayscale8)
+        bits = gray.constBits()
+        bits.setsize(gray.byteCount())
+        data = bits.asstring()
+        width, height, bytes_per_line = gray.width(), gray.height(), gray.bytesPerLine()
+        left, top, right, bottom = width, None, -1, -1
+        for row in range(0, height):
+            # One Python step per row, lstrip/rstrip do the per-pixel work in C
+            line = data[row * bytes_per_line:row * bytes_per_line + width]
+            first = width - len(line.lstrip(b'\x00'))
+            if first == width:
+                continue # Nothing painted on this row
+            last = len(line.rstrip(b'\x00')) - 1
+            if top is None:
+                top = row
+            bottom = row
+            left = min(left, first)
+            right = max(right, last)
+        if top is None:
+            return None
+        left = max(0, left - padding)
+        top = max(0, top - padding)
+        right = min(width - 1, right + padding)
+        bottom = min(height - 1, bottom + padding)
+        return left, top, right - left + 1, bottom - top + 1
 
     def get_mask_and_image(self, mode='canvas'):
         # mode: 'canvas', 'layer', 'selection'
@@ -533,14 +749,21 @@ class KritaController():
         self.doc = Krita.instance().activeDocument()
         # byte_array, img_w, img_h = self.base64_to_pixeldata(base64str)
         byte_array, img_w, img_h = self.base64_to_pixeldata(base64str, w, h) # Using a transform over and over on the layer creates flickering. 
+        self.update_preview_layer_pixels(byte_array, x, y, img_w, img_h)
+
+    def update_preview_layer_pixels(self, byte_array:QByteArray, x, y, img_w, img_h, doc=None):
+        # For previews that were already decoded off the GUI thread (see ProgressPoller)
+        self.doc = doc if self.document_is_open(doc) else Krita.instance().activeDocument()
+        if self.doc is None:
+            return
         layer = None
-        if self.preview_layer_uid is None:
+        if self.preview_layer_uid is not None:
+            layer = self._get_layer_with_uid(self.preview_layer_uid)
+        if layer is None: # First preview, or the preview layer was deleted
             layer = self.doc.createNode('Preview', 'paintLayer')
             self.doc.rootNode().addChildNode(layer, None)
             self.preview_layer_uid = layer.uniqueId()
             # self.transform_to_width_height(layer, x, y, img_w, img_h)
-        else:
-            layer = self._get_layer_with_uid(self.preview_layer_uid)
         layer.setLocked(False)
         layer.setPixelData(byte_array, x, y, img_w, img_h)
         # self.transform_to_width_height(layer, x, y, w, h)
@@ -0,0 +1,47 @@
+class ModelGrouping():
+    # The ordering behind 'server.group_by_model', kept apart from JobQueue so it doesn't need Krita or Qt.
+    # Jobs only need priority, order, model_key, pinned and skipped (see GenerationJob). same_models(key, other_key) says
+    # whether the server could run a job with model_key `key` without loading anything after one with `other_key`.
+
+    @staticmethod
+    def order(jobs, loaded_key, same_models, max_skips):
+        # The order jobs will start in, see JobQueue.pending()
+        jobs = sorted(jobs, key=lambda job: (-job.priority, job.order))
+        ordered = []
+        skipped = {id(job): job.skipped for job in jobs} # Includes the skips this plan makes, so it matches what JobQueue.start_next() will do
+        while len(jobs) > 0:
+            job = jobs[0]
+            if not job.pinned and skipped[id(job)] < max_skips and not same_models(job.model_key, loaded_key):
+                for later_job in jobs[1:]:
+                    if later_job.priority != job.priority:
+                        break
+                    if later_job.model_key is not None and same_models(later_job.model_key, loaded_key):
+                        job = later_job
+                        break
+            for earlier_job in jobs[:jobs.index(job)]:
+                skipped[id(earlier_job)] += 1
+            jobs.remove(job)
+            ordered.append(job)
+            if job.model_key is not None:
+                loaded_key = job.model_key
+        return ordered
+
+    @staticmethod
+    def count_swaps(model_keys, loaded_key, same_models):
+        # How many times the server has to load something to run model_keys in this order, starting with loaded_key
+        swaps = 0
+        for model_key in model_keys:
+            if model_key is None:
+                continue
+            if not same_models(model_key, loaded_key):
+                swaps += 1
+            loaded_key = model_key
+        return swaps
+
+    @staticmethod
+    def saved_swaps(started_keys, start_key, same_models):
+        # started_keys are (priority, order, model_key) in the order the jobs ran, with priority negated like the sort in order().
+        # Returns the loads avoided compared to running them in the order they were queued.
+        in_queued_order = [model_key for priority, order, model_key in sorted(started_keys, key=lambda started: started[:2])]
+        in_run_order = [model_key for priority, order, model_key in started_keys]
+        return max(0, ModelGrouping.count_swaps(in_queued_order, start_key, same_models) - ModelGrouping.count_swaps(in_run_order, start_key, same_models))
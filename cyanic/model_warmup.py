@@ -0,0 +1,87 @@
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from .sdapi_v1 import SDAPI
+from .settings_controller import SettingsController
+from .krita_controller import KritaController
+from .job_queue import JobQueue
+
+class ModelWarmup(QObject):
+    # Loads the checkpoint/VAE picked in a ModelsWidget while the user is still writing the prompt, so the first job doesn't pay for it.
+    # Requests are debounced, so scrolling through the model list only loads wherever it stops. A load the server already started
+    # can't be stopped, but a newer pick waits for it and replaces it, and a pick that matches the server again is simply dropped.
+    started = pyqtSignal(object) # List of what's loading, 'model' and/or 'VAE'
+    finished = pyqtSignal(bool) # True if the server loaded it
+    DEBOUNCE_MS = 1500
+    _shared = {} # id(SDAPI): ModelWarmup
+
+    @classmethod
+    def shared(cls, api:SDAPI, settings_controller:SettingsController):
+        # One per SDAPI, shared by the ModelsWidget on every page
+        warmup = cls._shared.get(id(api), None)
+        if warmup is None or warmup.api is not api:
+            warmup = ModelWarmup(api, settings_controller)
+            cls._shared[id(api)] = warmup
+        return warmup
+
+    def __init__(self, api:SDAPI, settings_controller:SettingsController):
+        super().__init__()
+        self.api = api
+        self.settings_controller = settings_controller
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.start)
+        self.wanted = None # Options to load once the selection settles
+        self.loading = None # Options the server is loading right now
+        self.loaded = False
+        self.kc = None # Owns the worker thread
+
+    def enabled(self):
+        return self.settings_controller.has_key('defaults.warm_up_models') and self.settings_controller.get('defaults.warm_up_models')
+
+    def request(self, model, vae):
+        # Restarts the debounce, replacing whatever was asked for before
+        if not self.enabled():
+            return
+        options = {}
+        if model is not None and len(model) > 0:
+            options['sd_model_checkpoint'] = model
+        if vae is not None and len(vae) > 0:
+            options['sd_vae'] = vae
+        self.wanted = options
+        self.timer.start(ModelWarmup.DEBOUNCE_MS)
+
+    def cancel(self):
+        self.timer.stop()
+        self.wanted = None
+
+    def is_loading(self):
+        return self.loading is not None
+
+    def start(self):
+        if self.wanted is None or self.loading is not None:
+            return # Nothing to do, or load_done() will come back for it
+        options = self.api.overrides_needed(self.wanted)
+        self.wanted = None
+        if len(options) == 0:
+            return # Already loaded
+        if JobQueue.shared(self.api, self.settings_controller).is_busy():
+            return # Jobs carry the model in override_settings. Switching it under them would just cost another swap.
+        self.loading = options
+        self.loaded = False
+        swaps = [name for name, key in [('model', 'sd_model_checkpoint'), ('VAE', 'sd_vae')] if key in options]
+        self.started.emit(swaps)
+        self.kc = KritaController()
+        self.kc.run_as_thread(lambda: self.load(options), self.load_done)
+
+    def load(self, options):
+        # Runs on a worker thread. The options post returns once the server has loaded the model.
+        self.loaded = self.api.post('/sdapi/v1/options', options, self.api.generation_timeout) is not None
+        if self.loaded:
+            self.api.remember_server_options(options)
+        else:
+            self.api.forget_server_options(options) # It could have timed out partway through loading
+
+    def load_done(self):
+        self.loading = None
+        self.finished.emit(self.loaded)
+        if self.wanted is not None and not self.timer.isActive():
+            self.start() # The selection changed while the server was busy
@@ -3,7 +3,8 @@ from PyQt5.QtCore import Qt
 from ..sdapi_v1 import SDAPI
 from ..settings_controller import SettingsController
 from ..krita_controller import KritaController
-from ..widgets import ImageInWidget
+from ..job_queue import JobQueue, GenerationJob
+from ..widgets import ImageInWidget, JobProgressWidget
 import json
 
 class RemBGPage(QWidget):
@@ -12,6 +13,7 @@ class RemBGPage(QWidget):
         self.settings_controller = settings_controller
         self.api = api
         self.kc = KritaController()
+        self.queue = JobQueue.shared(self.api, self.settings_controller)
         self.setLayout(QVBoxLayout())
         self.debug = False
         self.size_dict = {"x":0,"y":0,"w":0,"h":0}
@@ -28,7 +30,7 @@ class RemBGPage(QWidget):
         ]
 
         # Image select
-        self.img_in = ImageInWidget(self.settings_controller, self.api, 'input_image', self.size_dict)
+        self.img_in = ImageInWidget(self.settings_controller, self.api, 'input_image', self.size_dict, lossless=True) # Transparency matters here
         self.layout().addWidget(self.img_in)
 
         # Background Removal model
@@ -79,7 +81,7 @@ class RemBGPage(QWidget):
         # Remove Background/Generate button
         generate_btn = QPushButton('Remove Background')
         generate_btn.clicked.connect(lambda: self.run_rembg())
-        self.layout().addWidget(generate_btn)
+        self.layout().addWidget(JobProgressWidget(self.queue, generate_btn))
 
         # Disclaimer
         disclaimer_text = "The RemBG extension is created by Automatic1111, and is available in the extensions tab as 'stable-diffusion-webui-rembg'."
@@ -149,12 +151,14 @@ class RemBGPage(QWidget):
     
     def run_rembg(self):
         data = self.get_generation_data()
-        # TODO: Make this async
-        results = self.api.post('/rembg', data)
-        if results is not None:
-            apply_mask = self.settings_controller.get('rembg.apply_mask')
-            as_mask = self.settings_controller.get('rembg.results_as_mask')
-            if (as_mask and not apply_mask) or not as_mask:
-                self.kc.results_to_layers(results, self.size_dict['x'], self.size_dict['y'], self.size_dict['w'], self.size_dict['h'])
-            else:
-                self.kc.result_to_transparency_mask(results, self.size_dict['x'], self.size_dict['y'], self.size_dict['w'], self.size_dict['h'])
\ No newline at end of file
+        processing_instructions = {}
+        apply_mask = self.settings_controller.get('rembg.apply_mask')
+        as_mask = self.settings_controller.get('rembg.results_as_mask')
+        if as_mask and apply_mask:
+            processing_instructions['as_transparency_mask'] = True
+            processing_instructions['mask_layer_uuid'] = self.kc.get_active_layer_uuid() # The active layer may change before the results are back
+        self.kc.refresh_doc()
+        # Runs in the JobQueue, so Krita stays responsive while the server works
+        job = GenerationJob('rembg', data, self.size_dict['x'], self.size_dict['y'], self.size_dict['w'], self.size_dict['h'], processing_instructions, self.kc.doc)
+        job.prompt = data['model'] # Shown in the queue in place of a prompt
+        self.queue.submit(job)
\ No newline at end of file
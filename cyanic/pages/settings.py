@@ -2,6 +2,9 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import QDoubleValidator
 from ..sdapi_v1 import SDAPI
 from ..settings_controller import SettingsController
+from ..krita_controller import KritaController
+from ..backend_pool import BackendPool
+from ..job_queue import JobQueue
 
 class SettingsPage(QWidget):
     def __init__(self, settings_controller:SettingsController, api:SDAPI):
@@ -15,6 +18,7 @@ class SettingsPage(QWidget):
         # self._generation_group()
         self._size_group()
         self._previews_group()
+        self._uploads_group()
         self._prompt_group()
         self.layout().addStretch() # Takes up the remaining space at the bottom, allowing everything to be pushed to the top
 
@@ -35,6 +39,47 @@ class SettingsPage(QWidget):
         host_form.layout().addRow('Save images on host', self.create_checkbox('server.save_imgs'))
         self.add_tooltip(host_form, 'Enable to have the host save generated images, the same way it would in the WebUI.')
 
+        host_form.layout().addRow('Load models on select', self.create_checkbox('defaults.warm_up_models'))
+        self.add_tooltip(host_form, 'Start loading a checkpoint or VAE on the host as soon as it\'s picked, instead of when Generate is clicked. This changes the model in the WebUI too.')
+
+        connect_timeout = QDoubleSpinBox()
+        connect_timeout.setRange(0.1, 60.0)
+        connect_timeout.setSingleStep(0.5)
+        connect_timeout.setValue(self.settings_controller.get('server.connect_timeout'))
+        connect_timeout.valueChanged.connect(lambda: self.update_timeout('server.connect_timeout', connect_timeout.value()))
+        host_form.layout().addRow('Connect timeout (seconds)', connect_timeout)
+        self.add_tooltip(host_form, 'How long to wait for the host to accept a connection. Keeps Krita from freezing when the host is offline.')
+
+        read_timeout = QDoubleSpinBox()
+        read_timeout.setRange(0.0, 600.0)
+        read_timeout.setSingleStep(5.0)
+        read_timeout.setValue(self.settings_controller.get('server.read_timeout'))
+        read_timeout.valueChanged.connect(lambda: self.update_timeout('server.read_timeout', read_timeout.value()))
+        host_form.layout().addRow('Read timeout (seconds)', read_timeout)
+        self.add_tooltip(host_form, 'How long to wait for a response to anything other than image generation. 0 waits forever.')
+
+        extra_hosts = QLineEdit(', '.join(self.settings_controller.get('server.extra_hosts')))
+        extra_hosts.setPlaceholderText('http://192.168.1.20:7860, http://192.168.1.21:7860')
+        extra_hosts.editingFinished.connect(lambda: self.update_extra_hosts(extra_hosts.text()))
+        host_form.layout().addRow('Extra hosts', extra_hosts)
+        self.add_tooltip(host_form, 'More WebUI hosts to generate on. Queued jobs run on whichever host is least busy and has the model, one job per host at a time.')
+
+        host_form.layout().addRow('Group jobs by model', self.create_checkbox('server.group_by_model'))
+        self.add_tooltip(host_form, 'Run queued jobs that use the loaded model, VAE and refiner before ones that would load a different one. A job is never passed over more than %s times, and jobs moved by hand keep their place.' % JobQueue.MAX_SKIPS)
+
+        host_form.layout().addRow('Cache results', self.create_checkbox('server.cache_results'))
+        self.add_tooltip(host_form, 'Keep generated images on disk, so running the exact same settings with a fixed seed again doesn\'t need the host. Random seeds (-1) are never cached.')
+
+        result_cache_mb = QSpinBox()
+        result_cache_mb.setRange(16, 16384)
+        result_cache_mb.setSingleStep(64)
+        result_cache_mb.setValue(self.settings_controller.get('server.result_cache_mb'))
+        result_cache_mb.valueChanged.connect(lambda: self.update_setting('server.result_cache_mb', result_cache_mb.value()))
+        host_form.layout().addRow('Result cache size (MB)', result_cache_mb)
+        clear_cache_btn = QPushButton('Clear Result Cache')
+        clear_cache_btn.clicked.connect(lambda: self.api.result_cache.clear() if self.api.result_cache is not None else None)
+        host_form.layout().addWidget(clear_cache_btn)
+
         # IDK what server setting to change to toggle this, so it'll have to be server default
         # host_form.layout().addRow('Filter NSFW', self.create_checkbox('server.filter_nsfw'))
 
@@ -62,6 +107,16 @@ class SettingsPage(QWidget):
         size_form.layout().addRow('Maximum Size', max_size_entry)
         self.add_tooltip(size_form, 'The largest size an image generated by the server will be. If the selected area is larger than this size, the server response will be scaled to fit.')
 
+        size_form.layout().addRow('Tile large images', self.create_checkbox('defaults.tile_large_images'))
+        self.add_tooltip(size_form, 'When max size is enabled and the area is larger, generate it as overlapping tiles at the maximum size and blend them together, instead of scaling one image up. Tiles run on every host at once.')
+
+        tile_overlap_entry = QSpinBox()
+        tile_overlap_entry.setRange(0, 512)
+        tile_overlap_entry.setValue(self.settings_controller.get('defaults.tile_overlap'))
+        tile_overlap_entry.valueChanged.connect(lambda: self.settings_controller.set('defaults.tile_overlap', tile_overlap_entry.value()))
+        size_form.layout().addRow('Tile Overlap', tile_overlap_entry)
+        self.add_tooltip(size_form, 'How many pixels neighbouring tiles share. The overlap is faded from one tile to the next to hide the seams.')
+
         self.layout().addWidget(size_form)
 
     def _previews_group(self):
@@ -78,9 +133,35 @@ class SettingsPage(QWidget):
         previews_form.layout().addRow('Refresh Time (seconds)', refresh_time)
         self.add_tooltip(previews_form, 'Sets how often Krita asks SD for an update. Progress bar will update faster or slower depending on this setting.')
 
+        previews_form.layout().addRow('Small server previews', self.create_checkbox('previews.small_server_previews'))
+        self.add_tooltip(previews_form, 'Changes the host\'s live preview settings to low resolution JPEGs. Much less data per update for hosts over the internet. This also changes the previews in the WebUI.')
+
         self.layout().addWidget(previews_form)
 
 
+    def _uploads_group(self):
+        uploads_form = QGroupBox('Uploads')
+        uploads_form.setLayout(QFormLayout())
+        formats = list(KritaController.UPLOAD_FORMATS.keys())
+
+        image_formats = [upload_format for upload_format in formats if upload_format != 'PNG (grayscale)']
+        uploads_form.layout().addRow('Image format', self.create_combobox(image_formats, self.settings_controller.get('uploads.image_format'), 'uploads.image_format'))
+        self.add_tooltip(uploads_form, 'How img2img/inpaint images are sent to the host. "PNG (fast)" is lossless. JPEG/WebP are much smaller for hosts over the internet, but lose transparency.')
+
+        mask_formats = [upload_format for upload_format in formats if upload_format.startswith('PNG')]
+        uploads_form.layout().addRow('Mask format', self.create_combobox(mask_formats, self.settings_controller.get('uploads.mask_format'), 'uploads.mask_format'))
+        self.add_tooltip(uploads_form, 'How inpaint masks are sent to the host. All options are lossless, "PNG (grayscale)" is the smallest.')
+
+        quality_entry = QSpinBox()
+        quality_entry.setRange(50, 100)
+        quality_entry.setValue(self.settings_controller.get('uploads.quality'))
+        quality_entry.valueChanged.connect(lambda: self.update_setting('uploads.quality', quality_entry.value()))
+        uploads_form.layout().addRow('JPEG/WebP quality', quality_entry)
+        self.add_tooltip(uploads_form, 'Only used when the image format is JPEG or WebP.')
+
+        self.layout().addWidget(uploads_form)
+
+
     def _prompt_group(self):
         prompt_form = QGroupBox('Prompts')
         prompt_form.setLayout(QFormLayout())
@@ -188,8 +269,10 @@ class SettingsPage(QWidget):
             return
         # Check a user entered host
         try:
-            test_api = SDAPI(host)
-            test_api.get_status()
+            test_api = SDAPI(host, connect=False)
+            test_api.set_timeouts(self.api.connect_timeout, self.api.read_timeout)
+            if test_api.get_status() is None:
+                raise Exception('Cyanic SD - No response from %s' % host)
             # Test passed, inform user, update api
             self.connection_label.setText('Connected')
             self.api.change_host(host)
@@ -205,6 +288,18 @@ class SettingsPage(QWidget):
     def update_setting(self, key, value):
         self.settings_controller.set(key, value)
 
+    def update_timeout(self, key, value):
+        self.settings_controller.set(key, value)
+        self.settings_controller.save()
+        self.api.set_timeouts(self.settings_controller.get('server.connect_timeout'), self.settings_controller.get('server.read_timeout'))
+
+
+    def update_extra_hosts(self, text):
+        hosts = BackendPool.parse_hosts(text)
+        self.settings_controller.set('server.extra_hosts', hosts)
+        self.settings_controller.save()
+        JobQueue.shared(self.api, self.settings_controller).set_hosts(hosts)
+
 
     def save_user_settings(self):
         try:
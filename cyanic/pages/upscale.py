@@ -5,7 +5,9 @@ import json
 from ..sdapi_v1 import SDAPI
 from ..settings_controller import SettingsController
 from ..krita_controller import KritaController
-from ..widgets import PromptWidget, SeedWidget, CollapsibleWidget, ModelsWidget, GenerateWidget, ImageInWidget, DenoiseWidget, ExtensionWidget, MaskWidget, ColorCorrectionWidget
+from ..job_queue import JobQueue, GenerationJob
+from ..tiling import Tile
+from ..widgets import PromptWidget, SeedWidget, CollapsibleWidget, ModelsWidget, GenerateWidget, ImageInWidget, DenoiseWidget, ExtensionWidget, MaskWidget, ColorCorrectionWidget, JobProgressWidget
 
 class UpscalePage(QWidget):
     def __init__(self, settings_controller:SettingsController, api:SDAPI):
@@ -13,6 +15,7 @@ class UpscalePage(QWidget):
         self.settings_controller = settings_controller
         self.api = api
         self.kc = KritaController()
+        self.queue = JobQueue.shared(self.api, self.settings_controller)
         self.setLayout(QVBoxLayout())
         self.max_scale = 10
         self.generating = False
@@ -83,6 +86,14 @@ class UpscalePage(QWidget):
         upscaler_select.currentIndexChanged.connect(lambda: self.settings_controller.set('defaults.upscaler', upscaler_select.currentText()))
 
         upscaler_form.layout().addRow('Upscaler', upscaler_select)
+
+        tile_size_entry = QSpinBox()
+        tile_size_entry.setRange(128, 4096)
+        tile_size_entry.setSingleStep(64)
+        tile_size_entry.setValue(self.settings_controller.get('upscale.tile_size'))
+        tile_size_entry.setToolTip('Large canvases are sent in overlapping tiles of this size, several at once, and stitched together as they come back.')
+        tile_size_entry.valueChanged.connect(lambda: self.settings_controller.set('upscale.tile_size', tile_size_entry.value()))
+        upscaler_form.layout().addRow('Tile Size', tile_size_entry)
         self.layout().addWidget(upscaler_form)
 
         # Upscaler 2 + visiblity?
@@ -91,7 +102,7 @@ class UpscalePage(QWidget):
         # It's not worth using the Generate component for this...
         self.upscale_btn = QPushButton("Upscale")
         self.upscale_btn.clicked.connect(lambda: self.upscale())
-        self.layout().addWidget(self.upscale_btn)
+        self.layout().addWidget(JobProgressWidget(self.queue, self.upscale_btn))
 
         # self.debug_text = QPlainTextEdit()
         # self.debug_text.setPlaceholderText('Debuging output')
@@ -106,52 +117,54 @@ class UpscalePage(QWidget):
         if self.generating:
             self.upscale_btn.setText('Upscale')
 
+    def upscaled_size(self, w, h):
+        if self.settings_controller.get('upscale.tab') == 0:
+            # Upscale was a %
+            scale = self.settings_controller.get('upscale.resize')
+            return int(w * scale), int(h * scale)
+        # Upscale was a specific value
+        return self.settings_controller.get('upscale.width'), self.settings_controller.get('upscale.height')
+
     def upscale(self):
         tab = self.scale_tabs.currentIndex()
         self.settings_controller.set('upscale.tab', tab)
         self.settings_controller.save()
-        
+
+        x, y, w, h = self.kc.get_canvas_bounds()
+        canvas_w, canvas_h = self.upscaled_size(w, h)
+        if w == 0 or h == 0 or canvas_w == 0 or canvas_h == 0:
+            return
+
+        # The canvas goes up in tiles, each one upscaled to its part of the result and stitched into the layer as it comes back.
+        # Neither the server nor Krita ever has the whole upscaled image as one PNG/base64 string. Small canvases are a single tile.
+        scale_x, scale_y = canvas_w / w, canvas_h / h
+        offset_x, offset_y = 0, 0
+        if tab == 1 and self.settings_controller.get('upscale.crop_to_fit'):
+            # Keep the aspect ratio, and center the result on the new size like the server's crop would
+            scale_x = scale_y = max(scale_x, scale_y)
+            offset_x = (w * scale_x - canvas_w) / 2
+            offset_y = (h * scale_y - canvas_h) / 2
+
         data = {
-            'resize_mode': tab, # 0 = "Upscale By", 1 = "Upscale to"
-            'upscaling_resize': self.settings_controller.get('upscale.resize'),
-            'upscaling_resize_w': self.settings_controller.get('upscale.width'),
-            'upscaling_resize_h': self.settings_controller.get('upscale.height'),
-            'upscaling_crop': self.settings_controller.get('upscale.crop_to_fit'),
+            'resize_mode': 1, # Every tile is upscaled to an exact size
+            'upscaling_crop': False,
             'upscaler_1': self.settings_controller.get('defaults.upscaler'),
-            'image': self.kc.qimage_to_b64_str(self.kc.get_canvas_img()),
         }
-        # self.debug_text.setPlainText(json.dumps(data))
-        # self.debug_text.setPlainText('%s' % type(data))
-        # self.kc.run_as_thread(lambda: self.threadable_run(data), lambda: self.threadable_return())
-        self.results = self.api.extra(data)
-        self.threadable_return()
-
-
-    def threadable_run(self, data):
-        self.results = self.api.extra(data)
-
-        self.upscale_btn.setText('Upscaling')
-        self.upscale_btn.setDisabled(True)
-        self.update()
-
-    def threadable_return(self):
-        x, y, canvas_w, canvas_h = self.kc.get_canvas_bounds()
-        if self.settings_controller.get('upscale.tab') == 0:
-            # Upscale was a %
-            scale = self.settings_controller.get('upscale.resize')
-            canvas_w = int(canvas_w * scale)
-            canvas_h = int(canvas_h * scale)
-        else:
-            # Upscale was a specific value
-            canvas_w = self.settings_controller.get('upscale.width')
-            canvas_h = self.settings_controller.get('upscale.height')
+        image = self.kc.get_canvas_img()
+        tiles = []
+        for tile in Tile.plan(w, h, self.settings_controller.get('upscale.tile_size'), self.settings_controller.get('upscale.tile_overlap')):
+            upscaled_tile = Tile(tile.index, round(tile.x * scale_x - offset_x), round(tile.y * scale_y - offset_y), round(tile.w * scale_x), round(tile.h * scale_y))
+            upscaled_tile.data = {
+                'image': self.kc.qimage_to_b64_str(image.copy(tile.x, tile.y, tile.w, tile.h), 'PNG (fast)'), # Always lossless, upscalers magnify compression artifacts
+                'upscaling_resize_w': upscaled_tile.w,
+                'upscaling_resize_h': upscaled_tile.h,
+            }
+            tiles.append(upscaled_tile)
+        del image
 
         if self.settings_controller.get('upscale.resize_canvas'):
             self.kc.resize_canvas(canvas_w, canvas_h)
 
-        # self.debug_text.setPlainText('%s, %s - %sx%s' % (x, y, canvas_w, canvas_h))
-        self.kc.results_to_layers(self.results, x, y, canvas_w, canvas_h, layer_name='Upscaled')
-
-        self.upscale_btn.setText('Upscale')
-        self.upscale_btn.setDisabled(False)
-        self.update()
\ No newline at end of file
+        job = GenerationJob('extra', data, x, y, canvas_w, canvas_h, {'tiles': tiles, 'layer_name': 'Upscaled'}, self.kc.doc)
+        job.prompt = data['upscaler_1'] # Shown in the queue in place of a prompt
+        self.queue.submit(job)
@@ -0,0 +1,158 @@
+import threading
+from PyQt5.QtCore import QThread, pyqtSignal
+from .sdapi_v1 import SDAPI
+from .settings_controller import SettingsController
+from .krita_controller import KritaController
+
+class ProgressPoller(QThread):
+    # Polls /sdapi/v1/progress on its own thread for the whole plugin, so the GUI thread never waits on the server
+    # or decodes previews. Widgets subscribe while they have a job running and react to the signals.
+    progress_changed = pyqtSignal(object) # The /progress results without 'current_image', or None if the server didn't answer
+    preview_ready = pyqtSignal() # A decoded preview is waiting in take_preview()
+    _shared = {} # id(SDAPI): ProgressPoller
+    MIN_INTERVAL = 0.25 # Seconds. Never poll faster than this, even when a job is about to finish.
+    MAX_BACKOFF = 4.0 # When nothing changes between polls, the interval grows up to this many times previews.refresh_seconds
+
+    @classmethod
+    def shared(cls, api:SDAPI, settings_controller:SettingsController):
+        # One poller per SDAPI (each host in a BackendPool has its own), so nothing polls the same server twice
+        poller = cls._shared.get(id(api), None)
+        if poller is None or poller.api is not api:
+            poller = ProgressPoller(api, settings_controller)
+            cls._shared[id(api)] = poller
+        return poller
+
+    def __init__(self, api:SDAPI, settings_controller:SettingsController):
+        super().__init__()
+        self.api = api
+        self.settings_controller = settings_controller
+        self.kc = KritaController() # Only used for decoding, made here because KritaController() asks Krita for the active document
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.subscribers = {} # id(subscriber): (x, y, w, h) the preview should be decoded at, or None
+        self.frame = None # (QByteArray, width, height, preview_size) of the newest preview nobody has taken yet
+        self.frame_pending = False # preview_ready was emitted and take_preview() hasn't been called since
+        self.last_image = None
+        self.polling = False # Set under the lock, so a subscribe() racing the thread's exit still starts it again
+        self.last_state = None
+        self.unchanged_polls = 0
+
+    def subscribe(self, subscriber, preview_size=None):
+        # preview_size is (x, y, w, h). Subscribing again replaces the size.
+        key = id(subscriber)
+        with self.lock:
+            if key not in self.subscribers:
+                subscriber.destroyed.connect(lambda: self._unsubscribe_key(key)) # Pages can be deleted mid-generation
+            self.subscribers[key] = preview_size
+            start = not self.polling
+            self.polling = True
+        if start:
+            self.wait() # The last run() may still be returning
+            self.wake.clear()
+            self.start()
+
+    def unsubscribe(self, subscriber):
+        self._unsubscribe_key(id(subscriber))
+
+    def _unsubscribe_key(self, key):
+        with self.lock:
+            self.subscribers.pop(key, None)
+            if len(self.subscribers) == 0:
+                self.frame = None
+                self.frame_pending = False
+                self.last_image = None
+                self.wake.set() # Stop sleeping so the thread exits now
+
+    def keep_polling(self):
+        with self.lock:
+            if len(self.subscribers) == 0:
+                self.polling = False
+            return self.polling
+
+    def take_preview(self):
+        # Returns the newest (QByteArray, width, height, preview_size), or None if it was already taken.
+        # Frames that arrived while the GUI was busy were replaced by newer ones, so only the latest is ever drawn.
+        with self.lock:
+            frame = self.frame
+            self.frame = None
+            self.frame_pending = False
+            return frame
+
+    def interval(self):
+        if self.settings_controller.has_key('previews.refresh_seconds'):
+            return self.settings_controller.get('previews.refresh_seconds')
+        return 1.0
+
+    def next_interval(self, results):
+        # Slows down while the server reports the same step (loading a model, a long VAE decode, queued behind someone else)
+        # and checks back right when the ETA says the job should be done.
+        interval = self.interval()
+        if results is None:
+            return interval
+        state = results.get('state') or {}
+        current_state = (state.get('job'), state.get('job_count'), state.get('sampling_step'), results.get('progress'))
+        if current_state == self.last_state:
+            self.unchanged_polls += 1
+        else:
+            self.unchanged_polls = 0
+        self.last_state = current_state
+        interval = interval * min(1.5 ** self.unchanged_polls, ProgressPoller.MAX_BACKOFF)
+        eta = results.get('eta_relative', 0) or 0
+        if 0 < eta < interval:
+            interval = eta
+        return max(ProgressPoller.MIN_INTERVAL, interval)
+
+    def previews_enabled(self):
+        return self.settings_controller.has_key('previews.enabled') and self.settings_controller.get('previews.enabled')
+
+    def wants_preview(self):
+        if not self.previews_enabled():
+            return False
+        with self.lock:
+            return any([size is not None for size in self.subscribers.values()])
+
+    def run(self):
+        self.last_state = None
+        self.unchanged_polls = 0
+        previous_options = {}
+        if self.previews_enabled() and self.settings_controller.has_key('previews.small_server_previews') and self.settings_controller.get('previews.small_server_previews'):
+            previous_options = self.api.set_live_preview_options() # Does nothing if the server already has them
+        try:
+            while self.keep_polling():
+                try:
+                    # The preview is most of each response, don't download it if nobody will draw it
+                    results = self.api.get_progress(skip_current_image=not self.wants_preview())
+                except Exception as e:
+                    results = None
+                current_image = None
+                if results is not None:
+                    current_image = results.pop('current_image', None)
+                self.progress_changed.emit(results)
+                if current_image is not None and len(current_image) > 0 and self.previews_enabled():
+                    self.decode_preview(current_image)
+                self.wake.wait(self.next_interval(results))
+                self.wake.clear()
+        finally:
+            self.api.restore_live_preview_options(previous_options) # Nothing is following a job anymore
+
+    def decode_preview(self, current_image):
+        if current_image == self.last_image:
+            return # The server sends the same preview until the next one is ready
+        self.last_image = current_image
+        with self.lock:
+            preview_sizes = [size for size in self.subscribers.values() if size is not None]
+        if len(preview_sizes) == 0:
+            return
+        preview_size = preview_sizes[-1] # The most recent job
+        try:
+            byte_array, img_w, img_h = self.kc.base64_to_pixeldata(current_image, preview_size[2], preview_size[3])
+        except Exception as e:
+            return
+        finally:
+            self.kc.decode_stats = [] # Nothing reads these for previews, don't let them pile up
+        with self.lock:
+            self.frame = (byte_array, img_w, img_h, preview_size)
+            notify = not self.frame_pending
+            self.frame_pending = True
+        if notify:
+            self.preview_ready.emit()
@@ -0,0 +1,197 @@
+import json
+import hashlib
+import os
+import threading
+import time
+
+class ResultCache():
+    # Keeps generation responses on disk, keyed by a fingerprint of the exact payload sent to the server, so regenerating with
+    # the same settings and a fixed seed (after an undo, or flipping between two prompts) is answered without the server.
+    # Each entry is one file: the base64 images one per line, then a line of JSON with the rest of the response. Images are
+    # written as they arrive and read back one at a time, the same way responses are streamed (see SDAPI.post_streaming).
+    # Requests with a random seed are never cached, there's no way they'd come back the same.
+    HASH_LENGTH = 1024 # Strings at least this long (uploaded images) are fingerprinted by a hash of their content
+    DEFAULT_MAX_MB = 512
+    EXTENSION = '.result'
+
+    def __init__(self, settings_controller=None):
+        self.settings_controller = settings_controller
+        self.plugin_dir = os.path.dirname(os.path.realpath(__file__))
+        self.cache_dir = os.path.join(self.plugin_dir, 'result_cache') # Lives next to user_settings.json
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        if self.settings_controller is None:
+            return True
+        return self.settings_controller.has_key('server.cache_results') and self.settings_controller.get('server.cache_results')
+
+    def max_bytes(self):
+        max_mb = ResultCache.DEFAULT_MAX_MB
+        if self.settings_controller is not None and self.settings_controller.has_key('server.result_cache_mb'):
+            max_mb = self.settings_controller.get('server.result_cache_mb')
+        return max_mb * 1024 * 1024
+
+    @staticmethod
+    def cacheable(data, server_options={}):
+        # data is the cleaned up payload. Extras (upscaling) have no seed at all and always come out the same.
+        if data.get('save_images', False):
+            return False # The host is supposed to save a copy, which it can't do if it never sees the request
+        if 'seed' not in data:
+            return 'prompt' not in data
+        if 'sd_model_checkpoint' not in server_options and 'sd_model_checkpoint' not in data.get('override_settings', {}):
+            return False # No telling which model it'd run on
+        for key in ['seed', 'subseed']:
+            if key == 'subseed' and not data.get('subseed_strength', 0):
+                continue # The subseed does nothing at strength 0
+            try:
+                if int(data.get(key, -1)) == -1:
+                    return False
+            except (TypeError, ValueError):
+                return False # '' means random too
+        return True
+
+    @staticmethod
+    def _canonical(value):
+        if type(value) is dict:
+            return {str(key): ResultCache._canonical(item) for key, item in value.items()}
+        if type(value) in [list, tuple]:
+            return [ResultCache._canonical(item) for item in value]
+        if type(value) is str and len(value) >= ResultCache.HASH_LENGTH:
+            return 'blake2b:%s' % hashlib.blake2b(value.encode('utf-8'), digest_size=16).hexdigest()
+        return value
+
+    @staticmethod
+    def fingerprint(url, data, server_options={}):
+        # server_options are what the server has loaded, since cleanup_data() leaves out the override_settings that match it.
+        # Without them, the same payload could mean a different model depending on what was loaded when it was sent.
+        canonical = ResultCache._canonical(data)
+        canonical['override_settings'] = {**server_options, **canonical.get('override_settings', {})}
+        text = json.dumps([url, canonical], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _path(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint + ResultCache.EXTENSION)
+
+    def read(self, fingerprint, on_image=None):
+        # Returns the response with each image replaced by what on_image(b64_str) returned, or None if it isn't cached
+        path = self._path(fingerprint)
+        on_image = on_image if on_image is not None else (lambda image: image)
+        try:
+            images = []
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.startswith('{'):
+                        entry = json.loads(line)
+                        break
+                    images.append(on_image(line.rstrip('\n')))
+                else:
+                    raise ValueError('Cyanic SD - Incomplete cache entry')
+            os.utime(path) # Marks it recently used, see prune()
+        except Exception as e:
+            self.misses += 1
+            return None
+        self.hits += 1
+        results = entry['results']
+        image_key = entry.get('image_key', None)
+        if image_key is not None:
+            results[image_key] = images if entry.get('image_list', True) else (images[0] if len(images) > 0 else None)
+        return results
+
+    def writer(self, fingerprint):
+        return ResultCacheWriter(self, fingerprint)
+
+    def prune(self):
+        # Deletes the least recently used entries until the cache fits in 'server.result_cache_mb'
+        max_bytes = self.max_bytes()
+        with self.lock:
+            try:
+                entries = []
+                for name in os.listdir(self.cache_dir):
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                    if name.endswith('.tmp') and time.time() - stat.st_mtime > 24 * 60 * 60:
+                        os.remove(os.path.join(self.cache_dir, name)) # Left behind by Krita closing mid-request
+                        continue
+                    if not name.endswith(ResultCache.EXTENSION):
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                total_bytes = sum([size for mtime, size, name in entries])
+                for mtime, size, name in sorted(entries):
+                    if total_bytes <= max_bytes:
+                        break
+                    os.remove(os.path.join(self.cache_dir, name))
+                    total_bytes -= size
+            except Exception as e:
+                pass # Worst case the cache is a bit bigger than asked
+
+    def clear(self):
+        with self.lock:
+            if not os.path.isdir(self.cache_dir):
+                return
+            for name in os.listdir(self.cache_dir):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except Exception as e:
+                    pass
+
+class ResultCacheWriter():
+    # Writes one entry as the response streams in. Nothing is visible to read() until finish() renames it into place,
+    # so a failed or interrupted request never leaves half an entry behind.
+    def __init__(self, cache:ResultCache, fingerprint):
+        self.cache = cache
+        self.path = cache._path(fingerprint)
+        self.temp_path = '%s.%s.%s.tmp' % (self.path, threading.get_ident(), time.monotonic_ns())
+        self.file = None
+        try:
+            os.makedirs(cache.cache_dir, exist_ok=True)
+            self.file = open(self.temp_path, 'w')
+        except Exception as e:
+            self.file = None
+
+    def wrap(self, on_image=None):
+        # Returns an on_image(b64_str) that saves each image before handing it on
+        on_image = on_image if on_image is not None else (lambda image: image)
+        def save_and_pass_on(b64_str):
+            self.add_image(b64_str)
+            return on_image(b64_str)
+        return save_and_pass_on
+
+    def add_image(self, b64_str):
+        if self.file is None:
+            return
+        try:
+            self.file.write(b64_str)
+            self.file.write('\n')
+        except Exception as e:
+            self.discard()
+
+    def finish(self, results):
+        # results is the response as post_streaming() returned it. Only the parts that aren't images are written here.
+        if self.file is None:
+            return
+        image_key = next((key for key in ['images', 'image'] if key in results), None)
+        entry = {
+            'results': {key: value for key, value in results.items() if key != image_key},
+            'image_key': image_key,
+            'image_list': type(results.get(image_key, None)) is list,
+        }
+        try:
+            self.file.write(json.dumps(entry))
+            self.file.write('\n')
+            self.file.close()
+            self.file = None
+            os.replace(self.temp_path, self.path)
+        except Exception as e:
+            self.discard()
+            return
+        self.cache.prune()
+
+    def discard(self):
+        try:
+            if self.file is not None:
+                self.file.close()
+            self.file = None
+            os.remove(self.temp_path)
+        except Exception as e:
+            pass
@@ -1,17 +1,56 @@
-import urllib.request
-import urllib.error
 import json
 import base64
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from .http_pool import HTTPConnectionPool
+from .result_cache import ResultCache
+from .json_stream import JSONImageStream, JSONBody
 # Allow self-signed certs to be used. Self-signed certs allow some WebUI features (like ControlNet's camera) to work over local network.
 # import ssl
 # ssl._create_default_https_context = ssl._create_unverified_context
 
+DEFAULT_TIMEOUT = -1 # Use SDAPI.read_timeout. Pass None instead to wait as long as the server needs.
+
 class SDAPI():
     DEFAULT_HOST = 'http://127.0.0.1:7860'
-    def __init__(self, host=DEFAULT_HOST):
+    connection_pool = HTTPConnectionPool() # Shared by every SDAPI instance, so test connections and page widgets reuse sockets too
+    MAX_INIT_WORKERS = 6 # How many catalog endpoints init_api will request at the same time
+    CONNECT_TIMEOUT = 2.0 # Seconds. A host that's down fails this fast instead of freezing whoever called.
+    READ_TIMEOUT = 30.0 # Seconds, for everything that isn't generating images
+    # Attributes that make up the server catalog, which is what gets stored in the CatalogCache
+    CATALOG_KEYS = [
+        'models',
+        'vaes',
+        'samplers',
+        'upscalers',
+        'facerestorers',
+        'styles',
+        'scripts',
+        'loras',
+        'embeddings',
+        'hypernetworks',
+        'default_settings',
+        'controlnet',
+    ]
+    # Server options for small live previews: JPEG instead of PNG, from the cheap latent approximation (1/8 the size)
+    SMALL_LIVE_PREVIEW_OPTIONS = {
+        'live_previews_image_format': 'jpeg',
+        'show_progress_type': 'Approx cheap',
+    }
+    # Options cleanup_data() sends in override_settings. The server keeps them after each job (override_settings_restore_afterwards
+    # is False), so sending one that's already set is wasted, and on some servers it reloads the model anyway.
+    # The snapshot is read with the catalog, then only changed by what the plugin itself loads (jobs, ModelWarmup), so generating
+    # never waits on an extra request. Anything changed from the WebUI in the meantime gets picked up on the next catalog refresh.
+    TRACKED_OPTIONS = ['sd_model_checkpoint', 'sd_vae', 'img2img_color_correction', 'sd_model_refiner']
+    def __init__(self, host=DEFAULT_HOST, catalog_cache=None, connect=True, result_cache=None):
         self.host = host
+        self.catalog_cache = catalog_cache # CatalogCache, or None to always fetch from the server
+        self.result_cache = result_cache # ResultCache, or None to always generate
+        self.interrupts = 0 # Counts interrupt() calls, so a request can tell it was cut short
+        self.connect_timeout = SDAPI.CONNECT_TIMEOUT
+        self.read_timeout = SDAPI.READ_TIMEOUT
+        self.generation_timeout = None # txt2img/img2img/etc. can take as long as they take
         self.host_version = 'A1111' # SD.Next also supported
         self.supports_refiners = True # SD.Next with sd_backend == "original" does not support refiners
         self.models = []
@@ -25,6 +64,8 @@ class SDAPI():
         self.embeddings = []
         self.hypernetworks = []
         self.default_settings = {}
+        self.server_options = {} # Last known values of TRACKED_OPTIONS on the server. Empty until they've been read from the server itself.
+        self.controlnet = {} # Raw ControlNet extension responses, parsed by ControlNetAPI
         self.defaults = {
             'sampler': '',
             'model': '',
@@ -35,12 +76,26 @@ class SDAPI():
             'color_correction': True,
         }
         self.connected = False
+        self.catalog_stale = False # True when the catalog came from the cache and refresh_catalog() hasn't run yet
+        self.last_catalog_changes = []
+        self.catalog_listeners = []
         self.last_url = ''
-        self.init_api()
+        if connect:
+            # connect=False lets the caller run init_api() on a worker thread instead
+            self.init_api()
+
+    def set_timeouts(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        # 0 or None means no limit
+        self.connect_timeout = connect_timeout if connect_timeout else None
+        self.read_timeout = read_timeout if read_timeout else None
 
     def change_host(self, host=DEFAULT_HOST):
         self.host = host
         self.init_api()
+        if self.catalog_stale:
+            # Changing hosts is already a blocking action, so don't leave the cached catalog unchecked
+            self.refresh_catalog()
+            self.notify_catalog_listeners()
 
     def init_api(self):
         try:
@@ -53,7 +108,20 @@ class SDAPI():
         except Exception as e:
             self.connected = False
             return # There was an issue, but the server might not be online yet.
+
+        cached = self.catalog_cache.get(self.host) if self.catalog_cache is not None else None
+        if cached is not None:
+            # Stale-while-revalidate: fill everything from disk now, whoever owns this SDAPI calls refresh_catalog() in the background
+            self.apply_catalog(cached['catalog'])
+            self.catalog_stale = True
+            return
+        self.fetch_catalog()
+        if self.catalog_cache is not None:
+            self.catalog_cache.set(self.host, self.get_catalog())
+
+    def fetch_catalog(self):
         init_processes = [
+            self.get_options, # Submitted first since it's usually the slowest. It fills default_settings before calling set_host_version()
             self.get_models,
             self.get_vaes,
             self.get_samplers,
@@ -64,34 +132,133 @@ class SDAPI():
             self.get_loras,
             self.get_embeddings,
             self.get_hypernetworks,
-            self.get_options,
         ]
-        for process in init_processes:
-            process()
+        # Each get_* only writes its own attributes and none of them read host_version, so they can run side by side.
+        # Startup then costs about as long as the slowest endpoint instead of the sum of all of them.
+        with ThreadPoolExecutor(max_workers=SDAPI.MAX_INIT_WORKERS) as executor:
+            futures = [executor.submit(process) for process in init_processes]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    pass # A failed list stays at its previous value, the same as a server error would leave it
+        # Needs self.scripts to know if the extension is installed
+        self.get_controlnet()
+
+    def get_catalog(self):
+        return {key: getattr(self, key) for key in SDAPI.CATALOG_KEYS}
+
+    def apply_catalog(self, catalog):
+        for key in SDAPI.CATALOG_KEYS:
+            if key in catalog:
+                setattr(self, key, catalog[key])
+        self.set_options(self.default_settings)
+
+    def refresh_catalog(self):
+        # Safe to run off the GUI thread. Returns (and stores) the list of catalog keys that changed.
+        # The caller should pass them to notify_catalog_listeners() once it's back on the GUI thread.
+        old_catalog = self.get_catalog()
+        old_host_version = self.host_version
+        response = self.get_status()
+        if response is None:
+            self.last_catalog_changes = []
+            return self.last_catalog_changes # Keep showing the cached catalog until the server is back
+        self.connected = True
+        self.fetch_catalog()
+        new_catalog = self.get_catalog()
+        if self.host_version != old_host_version:
+            # A different backend (A1111 vs SD.Next) on the same host, treat everything as new
+            self.last_catalog_changes = [*SDAPI.CATALOG_KEYS]
+        else:
+            # Only what actually differs. A changed option (a different model loaded, say) shouldn't rebuild every page.
+            self.last_catalog_changes = [key for key in SDAPI.CATALOG_KEYS if old_catalog[key] != new_catalog[key]]
+        self.catalog_stale = False
+        if self.catalog_cache is not None:
+            self.catalog_cache.set(self.host, new_catalog)
+        return self.last_catalog_changes
+
+    def add_catalog_listener(self, callback):
+        # callback(changed_keys:list) is called when a background refresh finds different values than what was shown
+        if callback not in self.catalog_listeners:
+            self.catalog_listeners.append(callback)
+
+    def remove_catalog_listener(self, callback):
+        if callback in self.catalog_listeners:
+            self.catalog_listeners.remove(callback)
+
+    def notify_catalog_listeners(self, changed_keys=None):
+        if changed_keys is None:
+            changed_keys = self.last_catalog_changes
+        if len(changed_keys) == 0:
+            return
+        for callback in [*self.catalog_listeners]:
+            try:
+                callback(changed_keys)
+            except Exception as e:
+                # Most likely the widget was deleted when the page changed
+                self.remove_catalog_listener(callback)
 
-    def post(self, url, data):
+    def _parse_response(self, status, text):
+        if status >= 400:
+            return None
+        try:
+            return json.loads(text)
+        except:
+            return text
+
+    def _timeout(self, timeout):
+        if timeout == DEFAULT_TIMEOUT:
+            return self.read_timeout
+        return timeout
+
+    def post(self, url, data, timeout=DEFAULT_TIMEOUT):
         self.last_url = "{}{}".format(self.host, url)
-        request = urllib.request.Request(self.last_url, data=json.dumps(data).encode('utf-8'), headers={"Content-Type": "application/json"})       
         try:
-            response = urllib.request.urlopen(request)
-            text = response.read()
-            try:
-                return json.loads(text)
-            except:
-                return text
+            body = JSONBody(data) # Written to the socket a piece at a time, images aren't copied into one big body first
+            status, text = self.connection_pool.request('POST', self.last_url, body=body, headers={"Content-Type": "application/json", "Content-Length": str(body.length)}, connect_timeout=self.connect_timeout, read_timeout=self._timeout(timeout))
+            return self._parse_response(status, text)
         except:
             return None
 
 
-    def get(self, url):
+    def post_streaming(self, url, data, timeout=DEFAULT_TIMEOUT, on_image=None):
+        # Like post(), but the response is parsed as it arrives and each image goes to on_image(b64_str) as soon as it's complete.
+        # The response is never held whole, so a big batch costs one copy of each image instead of the raw bytes, text and dict together.
+        # The results have whatever on_image() returned in place of each image (the image itself by default).
         self.last_url = "{}{}".format(self.host, url)
         try:
-            response = urllib.request.urlopen(self.last_url)
-            text = response.read()
-            try:
-                return json.loads(text)
-            except:
-                return text
+            body = JSONBody(data)
+            status, results = self.connection_pool.request('POST', self.last_url, body=body, headers={"Content-Type": "application/json", "Content-Length": str(body.length)}, connect_timeout=self.connect_timeout, read_timeout=self._timeout(timeout), read_body=lambda response: JSONImageStream(response.read, on_image).parse())
+            if status >= 400:
+                return None
+            return results
+        except:
+            return None
+
+    def post_cached(self, url, data, timeout=DEFAULT_TIMEOUT, on_image=None, use_cache=True):
+        # post_streaming(), answered from the ResultCache when the same request with a fixed seed has been sent before.
+        # data is the payload after cleanup_data(). Returns (results, cached), cached being True when the server never saw it.
+        server_options = self.server_options
+        if not use_cache or self.result_cache is None or not self.result_cache.enabled() or not ResultCache.cacheable(data, server_options):
+            return self.post_streaming(url, data, timeout, on_image), False
+        fingerprint = ResultCache.fingerprint(url, data, server_options)
+        results = self.result_cache.read(fingerprint, on_image)
+        if results is not None:
+            return results, True
+        interrupts = self.interrupts
+        writer = self.result_cache.writer(fingerprint)
+        results = self.post_streaming(url, data, timeout, writer.wrap(on_image))
+        if results is None or self.interrupts != interrupts:
+            writer.discard() # An interrupted job still returns what it has, which isn't what the request asked for
+        else:
+            writer.finish(results)
+        return results, False
+
+    def get(self, url, timeout=DEFAULT_TIMEOUT):
+        self.last_url = "{}{}".format(self.host, url)
+        try:
+            status, text = self.connection_pool.request('GET', self.last_url, connect_timeout=self.connect_timeout, read_timeout=self._timeout(timeout))
+            return self._parse_response(status, text)
         except:
             return None
 
@@ -101,8 +268,34 @@ class SDAPI():
     def get_system_status(self):
         return self.get("/sdapi/v1/system-info/status")
 
-    def get_progress(self):
+    def get_progress(self, skip_current_image=False):
+        # skip_current_image leaves out the base64 preview, which is most of the response
+        if skip_current_image:
+            return self.get("/sdapi/v1/progress?skip_current_image=true")
         return self.get("/sdapi/v1/progress")
+
+    def set_live_preview_options(self, options=None):
+        # Asks the server for cheaper live previews. Only options the server actually has and that differ are sent,
+        # since SD.Next and A1111 name things differently and every options post makes the server re-save its config.
+        # Returns the previous values of whatever was changed, for restore_live_preview_options().
+        if options is None:
+            options = SDAPI.SMALL_LIVE_PREVIEW_OPTIONS
+        changed = {key: value for key, value in options.items() if key in self.default_settings and self.default_settings[key] != value}
+        if len(changed) == 0:
+            return {}
+        previous = {key: self.default_settings[key] for key in changed.keys()}
+        if self.post('/sdapi/v1/options', changed) is None:
+            return {}
+        self.default_settings.update(changed)
+        return previous
+
+    def restore_live_preview_options(self, previous):
+        # Puts back what set_live_preview_options() changed. They're server-wide, so the WebUI itself and anyone else using it
+        # would be stuck with small previews otherwise. (override_settings can't do this, cleanup_data() keeps overrides.)
+        if previous is None or len(previous) == 0:
+            return
+        if self.post('/sdapi/v1/options', previous) is not None:
+            self.default_settings.update(previous)
     
     # ===========================
     # API calls that cache values
@@ -132,8 +325,56 @@ class SDAPI():
             self.host_version = 'A1111'
 
     def get_options(self):
-        self.default_settings = self.get("/sdapi/v1/options")
-        if self.default_settings is None: # Some sort of server error while getting the configs?
+        default_settings = self.get("/sdapi/v1/options")
+        if default_settings is None: # Some sort of server error while getting the configs?
+            default_settings = {}
+        else:
+            self.remember_server_options(default_settings) # Options from the catalog cache could be out of date, these aren't
+        return self.set_options(default_settings)
+
+    def remember_server_options(self, options):
+        # options can be all of /sdapi/v1/options, or just the override_settings a job was sent with
+        snapshot = dict(self.server_options) # Replaced, not changed, so other threads never see it half updated
+        snapshot.update({key: options[key] for key in SDAPI.TRACKED_OPTIONS if key in options})
+        self.server_options = snapshot
+
+    def forget_server_options(self, options):
+        # For when the server may or may not have loaded options (a job or options post that failed partway).
+        # Forgotten options aren't pruned by overrides_needed(), so the next job sends them again instead of guessing.
+        self.server_options = {key: value for key, value in self.server_options.items() if key not in options}
+
+    def _model_title(self, name):
+        # Checkpoints can be named by title ("model.safetensors [hash]"), model_name or filename. Titles are what the server reports.
+        for model in self.models:
+            if name in [model.get('title'), model.get('model_name'), model.get('filename')]:
+                return model['title']
+        return name
+
+    def same_option(self, key, value, server_value):
+        if key in ['sd_model_checkpoint', 'sd_model_refiner']:
+            return self._model_title(value) == self._model_title(server_value)
+        return value == server_value
+
+    def overrides_needed(self, override_settings):
+        # The override_settings that would actually change something. Anything not tracked, or not known yet, is kept.
+        server_options = self.server_options
+        return {key: value for key, value in override_settings.items() if key not in server_options or not self.same_option(key, value, server_options[key])}
+
+    def swaps_needed(self, data):
+        # For the UI, before cleanup_data(): which of 'model' and 'VAE' the server would have to load for this data.
+        server_options = self.server_options
+        swaps = []
+        for name, data_key, option_key in [('model', 'model', 'sd_model_checkpoint'), ('VAE', 'vae', 'sd_vae')]:
+            value = data.get(data_key, None)
+            if value is None or len(value) == 0 or option_key not in server_options:
+                continue
+            if not self.same_option(option_key, value, server_options[option_key]):
+                swaps.append(name)
+        return swaps
+
+    def set_options(self, default_settings):
+        self.default_settings = default_settings
+        if self.default_settings is None:
             self.default_settings = {}
 
         self.set_host_version()
@@ -233,6 +474,20 @@ class SDAPI():
         self.hypernetworks = self.get("/sdapi/v1/hypernetworks")
         return self.hypernetworks
     
+    def get_controlnet(self):
+        # Raw responses from the ControlNet extension. ControlNetAPI parses them, this just makes them cacheable.
+        if not self.script_installed('controlnet'):
+            self.controlnet = {}
+            return self.controlnet
+        self.controlnet = {
+            'model_list': self.get('/controlnet/model_list?update=true'),
+            'module_list': self.get('/controlnet/module_list?alias_names=true'),
+            'control_types': self.get('/controlnet/control_types'),
+            'settings': self.get('/controlnet/settings'),
+            'version': self.get('/controlnet/version'),
+        }
+        return self.controlnet
+
     # TODO: /sdapi/v1/lycos exists in SD.Next
     
     # ===========================
@@ -331,6 +586,7 @@ class SDAPI():
     # ===========================
 
     def interrupt(self):
+        self.interrupts += 1
         self.post('/sdapi/v1/interrupt', {})
 
     # txt2img defaults to using server settings, so you can call it with as little as {"prompt":"", "negative_prompt":""}
@@ -452,35 +708,57 @@ class SDAPI():
         if 'batch_count' in data.keys():
             data['n_iter'] = data.pop('batch_count')
 
+        # Only send what the server doesn't already have. An override matching the loaded checkpoint can still cost a reload.
+        data['override_settings'] = self.overrides_needed(data['override_settings'])
+
         return data
 
-    def txt2img(self, data):
+    def txt2img(self, data, on_image=None):
+        # on_image(b64_str) gets each image as it comes off the socket, see post_streaming()
+        instructions = data.pop('CYANIC', {}) # From BackendPool.mark_random(), not for the server
         data = self.cleanup_data(data)
 
-        results = self.post("/sdapi/v1/txt2img", data)
+        results, cached = self.post_cached("/sdapi/v1/txt2img", data, self.generation_timeout, on_image, not instructions.get('no_cache', False))
+        if results is None:
+            self.forget_server_options(data['override_settings']) # It may have failed before or after loading them
+            return None
+        if not cached:
+            self.remember_server_options(data['override_settings']) # The server keeps them, see TRACKED_OPTIONS. A cached result loaded nothing.
         if type(results['info']) is str:
             results['info'] = json.loads(results['info'])
         self.log_request_and_response(data, results)
         return results
 
-    def img2img(self, data):
+    def img2img(self, data, on_image=None):
+        instructions = data.pop('CYANIC', {})
         data = self.cleanup_data(data)
 
-        results = self.post("/sdapi/v1/img2img", data)
+        results, cached = self.post_cached("/sdapi/v1/img2img", data, self.generation_timeout, on_image, not instructions.get('no_cache', False))
+        if results is None:
+            self.forget_server_options(data['override_settings'])
+            return None
+        if not cached:
+            self.remember_server_options(data['override_settings'])
         if type(results['info']) is str:
             results['info'] = json.loads(results['info'])
         self.log_request_and_response(data, results)
         return results
     
-    def extra(self, data):
+    def extra(self, data, on_image=None):
         data = self.cleanup_data(data)
-        results = self.post("/sdapi/v1/extra-single-image", data)
+        results, cached = self.post_cached("/sdapi/v1/extra-single-image", data, self.generation_timeout, on_image)
         # No 'info' section to parse
         self.log_request_and_response(data, results)
         return results
         
     def interrogate(self, data):
-        results = self.post("/sdapi/v1/interrogate", data)
+        results = self.post("/sdapi/v1/interrogate", data, self.generation_timeout)
+        self.log_request_and_response(data, results)
+        return results
+
+    def rembg(self, data):
+        # From the stable-diffusion-webui-rembg extension
+        results = self.post("/rembg", data, self.generation_timeout)
         self.log_request_and_response(data, results)
         return results
 
@@ -495,7 +773,8 @@ class SDAPI():
                 'request': data,
                 'response': response
             }
-            output_file.write(json.dumps(log))
+            # Written as it's encoded, so the images aren't copied into one big str. Images already decoded by on_image() are just noted.
+            json.dump(log, output_file, default=lambda value: '<%s, %s bytes>' % (type(value).__name__, len(value)) if hasattr(value, '__len__') else str(value))
 
     def write_img_to_file(self, base64_str, filename='saved.png'):
         with open(filename, 'wb') as output_file:
@@ -0,0 +1,142 @@
+import base64
+import math
+from PyQt5.QtGui import QImage
+
+class Tile():
+    # One overlapping piece of a region too big to generate in one go. x, y, w, h are relative to the region.
+    # Tiles in a row share y/h and tiles in a column share x/w, which is how neighbours are found when blending.
+    def __init__(self, index, x, y, w, h):
+        self.index = index
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.data = {} # Overrides for this tile's request (size, cropped uploads). Dropped once the request is sent.
+
+    @staticmethod
+    def spans(length, tile_size, overlap):
+        # (start, size) along one side. Tiles are spread evenly, so every overlap is at least `overlap` and none end up tiny.
+        if length <= tile_size:
+            return [(0, length)]
+        count = math.ceil((length - overlap) / (tile_size - overlap))
+        step = (length - tile_size) / (count - 1)
+        return [(int(round(i * step)), tile_size) for i in range(0, count)]
+
+    @staticmethod
+    def plan(w, h, tile_size, overlap):
+        # tile_size is the largest side the server should generate at (defaults.max_size), rounded down to the multiple of 8 SD works in
+        tile_size = max(64, tile_size - tile_size % 8)
+        overlap = max(0, min(overlap, tile_size // 2))
+        tiles = []
+        for tile_y, tile_h in Tile.spans(h, tile_size, overlap):
+            for tile_x, tile_w in Tile.spans(w, tile_size, overlap):
+                tiles.append(Tile(len(tiles), tile_x, tile_y, tile_w, tile_h))
+        return tiles
+
+    def feather_edges(self, placed):
+        # Edges that overlap a tile already on the layer, and by how much. Only those edges fade out, so every overlap is
+        # blended once, by whichever of the two tiles arrives second. Edges with nothing under them yet stay opaque.
+        edges = {}
+        for other in placed:
+            if other.y == self.y and other.x < self.x < other.x + other.w:
+                edges['left'] = max(edges.get('left', 0), other.x + other.w - self.x)
+            elif other.y == self.y and self.x < other.x < self.x + self.w:
+                edges['right'] = max(edges.get('right', 0), self.x + self.w - other.x)
+            elif other.x == self.x and other.y < self.y < other.y + other.h:
+                edges['top'] = max(edges.get('top', 0), other.y + other.h - self.y)
+            elif other.x == self.x and self.y < other.y < self.y + self.h:
+                edges['bottom'] = max(edges.get('bottom', 0), self.y + self.h - other.y)
+        # A diagonal neighbour only overlaps a corner. When neither edge next to that corner is feathered already,
+        # the corner fades on its own, as (width, height) of the overlap.
+        for other in placed:
+            overlap_w = other.x + other.w - self.x if other.x < self.x < other.x + other.w else (self.x + self.w - other.x if self.x < other.x < self.x + self.w else 0)
+            overlap_h = other.y + other.h - self.y if other.y < self.y < other.y + other.h else (self.y + self.h - other.y if self.y < other.y < self.y + self.h else 0)
+            if overlap_w == 0 or overlap_h == 0:
+                continue # Same row or column, or not touching
+            vertical = 'top' if other.y < self.y else 'bottom'
+            horizontal = 'left' if other.x < self.x else 'right'
+            if vertical in edges or horizontal in edges:
+                continue
+            corner = '%s_%s' % (vertical, horizontal)
+            previous_w, previous_h = edges.get(corner, (0, 0))
+            edges[corner] = (max(previous_w, overlap_w), max(previous_h, overlap_h))
+        return edges
+
+    @staticmethod
+    def controlnet_units(data:dict):
+        # ExtensionWidget puts ControlNet's units under alwayson_scripts, next to the other extensions
+        return data.get('alwayson_scripts', {}).get('controlnet', {}).get('args', [])
+
+    @staticmethod
+    def crop_controlnet_uploads(data:dict, x, y, w, h, region_w, region_h, kc, image_format='PNG', mask_format='PNG', quality=95):
+        # Cuts ControlNet inputs taken from the canvas down to x, y, w, h of the region, the way the mask widget crops the
+        # inpaint image and mask. Inputs that aren't the region's size (a file, say) weren't taken from the canvas,
+        # so they're left for ControlNet to resize.
+        for unit in Tile.controlnet_units(data):
+            images = unit.get('image', None)
+            if type(images) is not dict:
+                continue
+            for image_key, b64_str in images.items():
+                if b64_str is None:
+                    continue
+                image = QImage.fromData(base64.b64decode(b64_str))
+                if image.width() != region_w or image.height() != region_h:
+                    continue
+                upload_format = mask_format if image_key == 'mask' else image_format
+                images[image_key] = kc.qimage_to_b64_str(image.copy(x, y, w, h), upload_format, quality)
+                del image
+
+    @staticmethod
+    def split_uploads(data:dict, tiles:list, w, h, kc, image_format='PNG', mask_format='PNG', quality=95):
+        # Moves every uploaded image in data (img2img/inpaint image, the inpaint mask, ControlNet inputs) into the tiles,
+        # cropped to each tile. Returns the tiles worth generating. With an inpaint mask, tiles with nothing masked are left out.
+        def decode(b64_str):
+            image = QImage.fromData(base64.b64decode(b64_str))
+            if image.width() != w or image.height() != h:
+                image = image.scaled(w, h) # Uploads are usually already the region's size
+            return image
+
+        def crop(image, tile, upload_format):
+            return kc.qimage_to_b64_str(image.copy(tile.x, tile.y, tile.w, tile.h), upload_format, quality)
+
+        for key in ['img2img_img', 'inpaint_img']:
+            if data.get(key, None) is not None:
+                image = decode(data.pop(key))
+                for tile in tiles:
+                    tile.data[key] = crop(image, tile, image_format)
+                del image
+
+        if data.get('mask_img', None) is not None:
+            mask = decode(data.pop('mask_img'))
+            inverted = data.get('inpainting_mask_invert', 0) == 1
+            masked_tiles = []
+            for tile in tiles:
+                tile_mask = mask.copy(tile.x, tile.y, tile.w, tile.h)
+                if not inverted and kc.get_mask_bounds(tile_mask) is None:
+                    continue # Nothing to inpaint here, the canvas already shows this part
+                tile.data['mask_img'] = kc.qimage_to_b64_str(tile_mask, mask_format)
+                masked_tiles.append(tile)
+            del mask
+            tiles = masked_tiles
+
+        units = Tile.controlnet_units(data)
+        if len(units) > 0:
+            # Each tile gets its own copy of alwayson_scripts, since tile.data replaces data's keys rather than merging into them
+            scripts = data['alwayson_scripts']
+            for tile in tiles:
+                tile.data['alwayson_scripts'] = dict(scripts)
+                tile.data['alwayson_scripts']['controlnet'] = dict(scripts['controlnet'])
+                tile.data['alwayson_scripts']['controlnet']['args'] = [dict(unit) for unit in units]
+            for i, unit in enumerate(units):
+                images = unit.get('image', None)
+                if type(images) is not dict:
+                    continue
+                for image_key, b64_str in images.items():
+                    if b64_str is None:
+                        continue
+                    image = decode(b64_str)
+                    upload_format = mask_format if image_key == 'mask' else image_format
+                    for tile in tiles:
+                        tile_unit = tile.data['alwayson_scripts']['controlnet']['args'][i]
+                        tile_unit['image'] = dict(tile_unit['image'])
+                        tile_unit['image'][image_key] = crop(image, tile, upload_format)
+                    del image
+                unit['image'] = None # Every tile has its own copy now
+        return tiles
@@ -14,3 +14,4 @@ from .hires_fix import HiResFixWidget
 from .cfg import CFGWidget
 from .interrogate_model import InterrogateModelWidget
 from .interrogate import InterrogateWidget
+from .job_queue import JobQueueWidget, JobProgressWidget
@@ -13,6 +13,8 @@ class BatchWidget(QWidget):
         self.variables = {
             'batch_count': self.settings_controller.get('batch.count'),
             'batch_size': self.settings_controller.get('batch.size'),
+            'shard': self.settings_controller.get('batch.shard'),
+            'progressive': self.settings_controller.get('batch.progressive'),
         }
 
         self.draw_ui()
@@ -35,12 +37,27 @@ class BatchWidget(QWidget):
         self.layout().addWidget(QLabel('Batch Size'))
         self.layout().addWidget(size_spin)
 
+        progressive_cb = QCheckBox('Progressive')
+        progressive_cb.setToolTip('Add each image to the canvas as soon as it\'s done, instead of waiting for the whole batch count. Cancelling keeps the images that are done.')
+        progressive_cb.setChecked(self.variables['progressive'])
+        progressive_cb.stateChanged.connect(lambda: self._update_variable('progressive', progressive_cb.isChecked()))
+        self.layout().addWidget(progressive_cb)
+
+        if len(self.settings_controller.get('server.extra_hosts')) > 0:
+            shard_cb = QCheckBox('Split')
+            shard_cb.setToolTip('Split the batch count across the extra hosts. Seeds continue from one host to the next, so the results match a single host.')
+            shard_cb.setChecked(self.variables['shard'])
+            shard_cb.stateChanged.connect(lambda: self._update_variable('shard', shard_cb.isChecked()))
+            self.layout().addWidget(shard_cb)
+
     def _update_variable(self, key, value):
         self.variables[key] = value
 
     def save_settings(self):
         self.settings_controller.set('batch.count', self.variables['batch_count'])
         self.settings_controller.set('batch.size', self.variables['batch_size'])
+        self.settings_controller.set('batch.shard', self.variables['shard'])
+        self.settings_controller.set('batch.progressive', self.variables['progressive'])
         self.settings_controller.save()
 
     def get_generation_data(self):
@@ -48,5 +65,15 @@ class BatchWidget(QWidget):
             'batch_count': self.variables['batch_count'],
             'batch_size': self.variables['batch_size'], # n_iter in the API
         }
+        if self.variables['batch_count'] > 1:
+            # This data will be intercepted by the Generate widget
+            if self.variables['shard'] and len(self.settings_controller.get('server.extra_hosts')) > 0:
+                data['CYANIC'] = {
+                    'shard_batch': True # Takes priority over progressive
+                }
+            elif self.variables['progressive']:
+                data['CYANIC'] = {
+                    'progressive': True
+                }
         self.save_settings()
         return data
\ No newline at end of file
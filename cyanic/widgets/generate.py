@@ -1,12 +1,14 @@
 from PyQt5.QtWidgets import *
-from krita import QTimer
 import json
 from ..sdapi_v1 import SDAPI
 from ..settings_controller import SettingsController
 from ..krita_controller import KritaController
+from ..job_queue import JobQueue, GenerationJob
+from ..tiling import Tile
 from ..widgets import PromptWidget
+from .job_queue import JobProgressWidget
 
-# Generate Button, Progress Bar, and the threading logic for previews
+# Generate Button, Progress Bar, and the job queue. The generation itself runs in the plugin-wide JobQueue.
 # list_of_widgets is txt2img/img2img's [self.model_widget, self.prompt_widget, etc].
 # All of them should have `def get_generation_data(self)`.
 # Yes, I should've made an abstract class for that.
@@ -21,23 +23,17 @@ class GenerateWidget(QWidget):
         self.setLayout(QVBoxLayout())
         self.layout().setContentsMargins(0,0,0,0)
         self.kc = KritaController()
-        self.results = None
-        self.is_generating = False
-        self.abort = False
-        self.finished = False
         self.debug = False
-
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setMinimum(0)
-        self.progress_bar.setMaximum(100)
-        self.progress_bar.setValue(1)
-        self.progress_bar.setHidden(True)
-        self.layout().addWidget(self.progress_bar)
+        self.queue = JobQueue.shared(self.api, self.settings_controller)
+        self.queue.changed.connect(self.update_queue_state)
 
         self.generate_btn = QPushButton()
         self.generate_btn.setText('Generate')
         self.generate_btn.clicked.connect(self.handle_generate_btn_click)
-        self.layout().addWidget(self.generate_btn)
+
+        self.job_progress = JobProgressWidget(self.queue, self.generate_btn)
+        self.layout().addWidget(self.job_progress)
+        self.update_queue_state()
 
         if self.debug:
             self.debug_data = QTextEdit()
@@ -45,19 +41,11 @@ class GenerateWidget(QWidget):
             self.layout().addWidget(self.debug_data)
 
     def handle_generate_btn_click(self):
-        if self.is_generating:
-            self.cancel()
-        else:
-            self.generate()
+        # Clicking Generate while a job runs adds another one to the queue
+        self.generate()
         self.update()
 
     def generate(self):
-        # TODO: Give some sort of indicator if the backend is loading a new model/VAE, because that makes everything take longer.
-        self.is_generating = True
-        self.generate_btn.setText('Cancel')
-        self.progress_bar.setHidden(False)
-        self.update()
-
         processing_instructions = {} # Used to store instructions that should be executed after the image is generated
 
         x = self.size_dict["x"]
@@ -72,7 +60,60 @@ class GenerateWidget(QWidget):
                 x, y = 0, 0
                 w, h = self.kc.get_canvas_size()
 
+        data = self.fit_to_size_limits(w, h, processing_instructions)
+
+        # Whether or not to save the images on the server
+        if self.settings_controller.get('server.save_imgs'):
+            data['save_images'] = True
+
+        for widget in self.list_of_widgets:
+            # data.update(widget.get_generation_data()) # Have to switch off of this because multiple widgets update 'alwayson_scripts'
+            widget_data = widget.get_generation_data()
+            for w_key, w_value in widget_data.items():
+                if w_key in data and type(w_value) == dict:
+                    # data[w_key] has a conflict. Go through w_value.items() and add each one
+                    for nested_key, nested_value in w_value.items():
+                        data[w_key][nested_key] = nested_value
+                else:
+                    data[w_key] = w_value
+
+            if 'CYANIC' in data.keys(): # Special instructions for processing results are passed through with this tag.
+                processing_instructions.update(data.pop('CYANIC'))
+            # if type(widget) is PromptWidget:
+            #     widget.save_prompt()
+
+        if 'crop' in processing_instructions:
+            # The mask widget cropped the upload to the mask, so generate at the crop's size and put the results there
+            crop = processing_instructions.pop('crop')
+            self.crop_canvas_uploads(data, crop['x'] - x, crop['y'] - y, crop['w'], crop['h'], w, h)
+            x, y, w, h = crop['x'], crop['y'], crop['w'], crop['h']
+            processing_instructions.pop('resize', None)
+            data.update(self.fit_to_size_limits(w, h, processing_instructions))
+        if self.use_tiles(w, h):
+            # Too big for one request. Generate overlapping tiles at max size instead of scaling one small image up.
+            processing_instructions.pop('resize', None)
+            tiles = Tile.plan(w, h, self.settings_controller.get('defaults.max_size'), self.settings_controller.get('defaults.tile_overlap'))
+            tiles = Tile.split_uploads(data, tiles, w, h, self.kc, self.settings_controller.get('uploads.image_format'), self.settings_controller.get('uploads.mask_format'), self.settings_controller.get('uploads.quality'))
+            for tile in tiles:
+                tile.data.update(self.fit_to_size_limits(tile.w, tile.h, {}))
+            processing_instructions['tiles'] = tiles
+        # TODO: Check settings for anything that changes the parameters, such as limiting generation size, HR Fix, upscaling, clip skip, etc
+        if self.debug:
+            self.debug_data.setPlainText('%s' % json.dumps(self.api.cleanup_data(data)))
+            # return
         
+        try:
+            self.kc.refresh_doc()
+            if self.kc.doc is None: 
+                self.kc.create_new_doc()
+            job = GenerationJob(self.mode, data, x, y, w, h, processing_instructions, self.kc.doc)
+            job.swaps = self.api.swaps_needed(data)
+            self.queue.submit(job)
+        except Exception as e:
+            raise Exception('Cyanic SD - Error getting %s: %s' % (self.mode, e))
+
+    def fit_to_size_limits(self, w, h, processing_instructions):
+        # Returns the width/height to generate at, adding a 'resize' instruction if the results need scaling back to w x h
         data = {
             "width": w,
             "height": h,
@@ -111,153 +152,22 @@ class GenerateWidget(QWidget):
                 ratio = data['height'] / data['width']
                 data['height'] = int( ratio * max_size )
                 data['width'] = max_size
+        return data
 
-        # Whether or not to save the images on the server
-        if self.settings_controller.get('server.save_imgs'):
-            data['save_images'] = True
+    def crop_canvas_uploads(self, data, crop_x, crop_y, crop_w, crop_h, region_w, region_h):
+        # The mask widget only crops the inpaint image and mask. ControlNet inputs taken from the same region of the canvas
+        # have to be cut down the same way, or the control maps stop lining up with the area being generated.
+        Tile.crop_controlnet_uploads(data, crop_x, crop_y, crop_w, crop_h, region_w, region_h, self.kc, self.settings_controller.get('uploads.image_format'), self.settings_controller.get('uploads.mask_format'), self.settings_controller.get('uploads.quality'))
 
-        for widget in self.list_of_widgets:
-            # data.update(widget.get_generation_data()) # Have to switch off of this because multiple widgets update 'alwayson_scripts'
-            widget_data = widget.get_generation_data()
-            for w_key, w_value in widget_data.items():
-                if w_key in data and type(w_value) == dict:
-                    # data[w_key] has a conflict. Go through w_value.items() and add each one
-                    for nested_key, nested_value in w_value.items():
-                        data[w_key][nested_key] = nested_value
-                else:
-                    data[w_key] = w_value
-
-            if 'CYANIC' in data.keys(): # Special instructions for processing results are passed through with this tag.
-                processing_instructions.update(data.pop('CYANIC'))
-            # if type(widget) is PromptWidget:
-            #     widget.save_prompt()
-        # TODO: Check settings for anything that changes the parameters, such as limiting generation size, HR Fix, upscaling, clip skip, etc
-        if self.debug:
-            self.debug_data.setPlainText('%s' % json.dumps(self.api.cleanup_data(data)))
-            # return
-        
-        try:
-            self.kc.refresh_doc()
-            if self.kc.doc is None: 
-                self.kc.create_new_doc()
-            self.kc.run_as_thread(lambda: self.threadable_run(data), lambda: self.threadable_return(x, y, w, h, processing_instructions))
-            self.progress_timer = QTimer()
-            self.progress_timer.timeout.connect(lambda: self.progress_check(x, y, w, h, processing_instructions))
-            # Set the refresh rate
-            if self.settings_controller.has_key('previews.refresh_seconds'):
-                self.progress_timer.start(int(1000 * self.settings_controller.get('previews.refresh_seconds')))
-            else:
-                self.progress_timer.start(1000)
-
-        except Exception as e:
-            self.generate_btn.setText('Generate') # Want the UI to look right, even if we have an exception
-            self.update()
-            self.is_generating = False
-            raise Exception('Cyanic SD - Error getting %s: %s' % (self.mode, e))
-
-    def update_progress_bar(self, value):
-        # Moved to a separate function to allow switching tabs to not break and stop image generation
-        try:
-            self.progress_bar.setValue(value)
-        except Exception as e:
-            pass
-
-    def progress_check(self, x, y, w, h, processing_instructions={}):
-        try:
-            results = self.api.get_progress()
-            skipped_or_interrupted = results['state'] and (results['state']['skipped'] or results['state']['interrupted'])
-            # if results is None or results['progress'] == 0 or self.abort: # The operation has stopped
-            if results is None or skipped_or_interrupted or self.abort or self.finished: # The operation has stopped
-                self.abort = False
-                self.finished = False
-                self.update_progress_bar(1)
-                self.kc.delete_preview_layer()
-                self.progress_timer.stop()
-                self.is_generating = False
-                # raise Exception('Cyanic SD - Early progress end - Abort: %s Progress: %s' % (self.abort, results['progress']))
-                return
-            self.update_progress_bar(int(results['progress'] * 100))
-            # Show the preview
-            if self.settings_controller.has_key('previews.enabled') and self.settings_controller.get('previews.enabled'):
-                if results['current_image'] is not None and len(results['current_image']) > 0:
-                    if 'resize' in processing_instructions.keys():
-                        w = processing_instructions['resize']['width']
-                        h = processing_instructions['resize']['height']
-                    self.kc.update_preview_layer(results['current_image'], x, y, w, h)
-        except Exception as e:
-            # Kill the progress check
-            self.abort = False
-            self.finished = False
-            self.update_progress_bar(1)
-            self.kc.delete_preview_layer()
-            self.progress_timer.stop()
-            self.is_generating = False
-            # raise Exception('Cyanic SD - Error in progress loop: %s' % e)
-
-    def threadable_run(self, data):
-        self.generate_btn.setText('Cancel')
-        self.update()
-        # if self.debug:
-            # self.debug_data.setPlainText('%s\nThreadable Run start' % self.debug_data.toPlainText())
-        if self.mode == 'txt2img':
-            self.results = self.api.txt2img(data)
-        elif self.mode == 'img2img':
-            self.results = self.api.img2img(data)
-        elif self.mode == 'inpaint':
-            self.results = self.api.img2img(data)
-        # if self.debug:
-            # self.debug_data.setPlainText('Threadable Run!\n%s' % self.results)
-
-    def threadable_return(self, x, y, w, h, processing_instructions={}):
-        kc = KritaController()
-        # self.debug_data.setPlainText('Threadable Return!\n%s' % self.results)
-        if self.results is not None:
-            self.finished = True
-            # Prune the results images so that ControlNet preprocessors or masks aren't included in the results
-            if 'images' in self.results and 'parameters' in self.results and 'batch_size' in self.results['parameters'] and 'n_iter' in self.results['parameters']:
-                expected_images = self.results['parameters']['batch_size'] * self.results['parameters']['n_iter']
-                if len(self.results['images']) > expected_images:
-                    # Determine if the extra images are from ControlNet (after the results), or Grid previews (before the results), or a combination of the two
-                    if self.results['parameters']['save_images']:
-                        # Remove the grid from the front
-                        self.results['images'] = self.results['images'][1:]
-                    if len(self.results['images']) > expected_images: # Checking again incase the grid was the difference
-                        self.results['images'] = self.results['images'][:expected_images]
-
-            if 'results_below_layer_uuid' in processing_instructions:
-                layer = kc.get_layer_from_uuid(processing_instructions['results_below_layer_uuid'])
-                kc.results_to_layers(self.results, x, y, w, h, below_layer=layer)
-            else:
-                kc.results_to_layers(self.results, x, y, w, h)
+    def use_tiles(self, w, h):
+        max_size = self.settings_controller.get('defaults.max_size')
+        return self.settings_controller.get('defaults.enable_max_size') and self.settings_controller.get('defaults.tile_large_images') and (w > max_size or h > max_size)
 
-            # if self.debug:
-            #     temp_results = self.results
-            #     if 'images' in temp_results:
-            #         for i in range(len(temp_results['images'])):
-            #             temp_results['images'][i] = '...'
-            #     self.debug_data.setPlainText('%s' % temp_results)
-        else:
-            if self.debug:
-                self.debug_data.setPlainText('%s\nThreadable Return found no results' % self.debug_data.toPlainText())
+    def update_queue_state(self):
         try:
-            self.generate_btn.setText('Generate')
-            self.update_progress_bar(0)
-            self.progress_bar.setHidden(True)
+            jobs = len(self.queue.jobs) + len(self.queue.running)
+            self.generate_btn.setText('Generate' if jobs == 0 else 'Generate (%s in queue)' % jobs)
             self.update()
-        except Exception as e:
-            # The UI was changed to a different tab mid-generation, and these UI elements don't exist anymore
+        except RuntimeError as e:
+            # The page was deleted, but Qt hasn't disconnected the signal yet
             pass
-        
-
-    def cancel(self):
-        # raise Exception('Cyanic SD - Cancel!')
-        try:
-            self.api.interrupt()
-            # self.progress_timer.stop()
-            self.abort = True
-            self.generate_btn.setText('Generate')
-            self.update_progress_bar(0)
-            self.progress_bar.setHidden(True)
-            self.update()
-        except Exception as e:
-            raise Exception('Cyanic SD - Exception trying to interrupt: %s' % e)
\ No newline at end of file
@@ -35,7 +35,7 @@ class HiResFixWidget(QWidget):
         ]
 
         self.draw_ui()
-
+        self.api.add_catalog_listener(self.update_catalog)
 
     def draw_ui(self):
         enable_row = QWidget()
@@ -103,16 +103,15 @@ class HiResFixWidget(QWidget):
 
         upscaler_row.layout().addWidget(QLabel('Upscaler'))
 
-        upscalers = self.hires_only_upscalers
-        upscalers.extend(self.api.get_upscaler_names())
-        upscaler_select = QComboBox()
-        upscaler_select.addItems(upscalers)
-        upscaler_select.setStyleSheet("QComboBox { combobox-popup: 0; }") # Needed for setMaxVisibleItems to work
-        upscaler_select.setMinimumContentsLength(10) # Allows the box to be smaller than the longest item's char length
-        upscaler_select.setMaxVisibleItems(10) # Suppose to limit the number of visible options
-        upscaler_select.setCurrentText(self.variables['hr_upscaler'])
-        upscaler_select.currentTextChanged.connect(lambda: self._update_variables('hr_upscaler', upscaler_select.currentText()))
-        upscaler_row.layout().addWidget(upscaler_select)
+        upscalers = [*self.hires_only_upscalers, *self.api.get_upscaler_names()]
+        self.upscaler_select = QComboBox()
+        self.upscaler_select.addItems(upscalers)
+        self.upscaler_select.setStyleSheet("QComboBox { combobox-popup: 0; }") # Needed for setMaxVisibleItems to work
+        self.upscaler_select.setMinimumContentsLength(10) # Allows the box to be smaller than the longest item's char length
+        self.upscaler_select.setMaxVisibleItems(10) # Suppose to limit the number of visible options
+        self.upscaler_select.setCurrentText(self.variables['hr_upscaler'])
+        self.upscaler_select.currentTextChanged.connect(lambda: self._update_variables('hr_upscaler', self.upscaler_select.currentText()))
+        upscaler_row.layout().addWidget(self.upscaler_select)
 
         # Steps
         steps = QSpinBox()
@@ -153,6 +152,20 @@ class HiResFixWidget(QWidget):
         if self.ignore_hidden or not self.settings_controller.get('hide_ui.hires_denoise'):
             self.layout().addWidget(denoise_settings)
 
+    def update_catalog(self, changed_keys):
+        # Called after a background catalog refresh
+        if not 'upscalers' in changed_keys:
+            return
+        upscalers = [*self.hires_only_upscalers, *self.api.get_upscaler_names()]
+        self.upscaler_select.blockSignals(True)
+        self.upscaler_select.clear()
+        self.upscaler_select.addItems(upscalers)
+        if self.variables['hr_upscaler'] in upscalers:
+            self.upscaler_select.setCurrentText(self.variables['hr_upscaler'])
+        else:
+            self.variables['hr_upscaler'] = self.upscaler_select.currentText()
+        self.upscaler_select.blockSignals(False)
+
     def _update_variables(self, key, value):
         self.variables[key] = value
 
@@ -9,11 +9,12 @@ from ..settings_controller import SettingsController
 # Select an image
 class ImageInWidget(QWidget):
     MAX_HEIGHT = 100
-    def __init__(self, settings_controller:SettingsController, api:SDAPI, key:str, size_dict:dict={"x":0,"y":0,"w":0,"h":0}, hide_refresh=True):
+    def __init__(self, settings_controller:SettingsController, api:SDAPI, key:str, size_dict:dict={"x":0,"y":0,"w":0,"h":0}, hide_refresh=True, lossless=False):
         super().__init__()
         self.settings_controller = settings_controller
         self.api = api
         self.key = key # `key` should be whatever the key get_generation_data() should use to return the image
+        self.lossless = lossless # Ignore the JPEG/WebP upload settings, for results that need the exact pixels or transparency
         self.size_dict = size_dict
         self.hide_refresh = hide_refresh
         self.selection_mode = 'canvas'
@@ -127,7 +128,10 @@ class ImageInWidget(QWidget):
                 self.get_canvas_img()
 
         if self.image is not None:
-            data[self.key] = self.kc.qimage_to_b64_str(self.image)
+            upload_format = self.settings_controller.get('uploads.image_format')
+            if self.lossless and upload_format not in ['PNG', 'PNG (fast)']:
+                upload_format = 'PNG (fast)'
+            data[self.key] = self.kc.qimage_to_b64_str(self.image, upload_format, self.settings_controller.get('uploads.quality'))
         else:
             data[self.key] = None # Keeps things from crashing, even if it's not very useful.
         return data
\ No newline at end of file
@@ -1,12 +1,13 @@
 from PyQt5.QtWidgets import *
-from krita import QTimer
 import json
 from ..sdapi_v1 import SDAPI
 from ..settings_controller import SettingsController
 from ..krita_controller import KritaController
+from ..job_queue import JobQueue, GenerationJob
 from ..widgets import PromptWidget
 from ..widgets import ImageInWidget
 from ..widgets import InterrogateModelWidget
+from .job_queue import JobProgressWidget
 
 
 class InterrogateWidget(QWidget):
@@ -30,12 +31,15 @@ class InterrogateWidget(QWidget):
         self.layout().setContentsMargins(0, 0, 0, 0)
         self.kc = KritaController()
         self.results = None
+        self.job = None # The last job this widget submitted
         self.debug = False
+        self.queue = JobQueue.shared(self.api, self.settings_controller)
+        self.queue.job_finished.connect(self.interrogate_done)
 
         self.interrogate_btn = QPushButton()
         self.interrogate_btn.setText("Interrogate")
         self.interrogate_btn.clicked.connect(self.handle_interrogate_btn_click)
-        self.layout().addWidget(self.interrogate_btn)
+        self.layout().addWidget(JobProgressWidget(self.queue, self.interrogate_btn))
 
         if self.debug:
             self.debug_data = QTextEdit()
@@ -78,26 +82,35 @@ class InterrogateWidget(QWidget):
             self.debug_data.setPlainText("%s" % json.dumps(data))
             # return
 
-        processing_instructions = {}
-
         try:
             self.kc.refresh_doc()
             if self.kc.doc is None:
                 self.kc.create_new_doc()
 
-            self.results = self.api.interrogate(data)
+            # Runs in the JobQueue, the caption is filled in by interrogate_done()
+            self.job = GenerationJob("interrogate", data, x, y, w, h, {}, self.kc.doc)
+            self.job.prompt = data["model"]  # Shown in the queue in place of a prompt
+            self.queue.submit(self.job)
 
         except Exception as e:
-            self.interrogate_btn.setText(
-                "Interrogate"
-            )  # Want the UI to look right, even if we have an exception
-            self.update()
-            self.is_interrogating = False
             raise Exception(
                 "Cyanic SD - Error getting %s: %s"
                 % (self.interrogate_model_widget.get_model(), e)
             )
 
+    def interrogate_done(self, job: GenerationJob):
+        if job is not self.job:
+            return
+        self.job = None
+        self.results = job.results
+        job.results = None
+        try:
+            self.show_results()
+        except RuntimeError as e:
+            # The page was deleted, but Qt hasn't disconnected the signal yet
+            pass
+
+    def show_results(self):
         if self.results is not None:
             self.finished = True
 
@@ -0,0 +1,151 @@
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import Qt
+from ..job_queue import JobQueue, GenerationJob
+
+# Shows the plugin-wide JobQueue, with buttons to reorder or cancel whatever is selected.
+# Every page's GenerateWidget has one of these, and they all show the same queue.
+class JobQueueWidget(QWidget):
+    def __init__(self, queue:JobQueue):
+        super().__init__()
+        self.queue = queue
+        self.setLayout(QVBoxLayout())
+        self.layout().setContentsMargins(0,0,0,0)
+
+        self.job_list = QListWidget()
+        self.job_list.setMaximumHeight(120)
+        self.job_list.currentRowChanged.connect(self.update_buttons)
+        self.layout().addWidget(self.job_list)
+
+        button_row = QWidget()
+        button_row.setLayout(QHBoxLayout())
+        button_row.layout().setContentsMargins(0,0,0,0)
+
+        self.up_btn = QPushButton('Up')
+        self.up_btn.clicked.connect(lambda: self.queue.move(self.selected_job(), -1))
+        button_row.layout().addWidget(self.up_btn)
+
+        self.down_btn = QPushButton('Down')
+        self.down_btn.clicked.connect(lambda: self.queue.move(self.selected_job(), 1))
+        button_row.layout().addWidget(self.down_btn)
+
+        self.next_btn = QPushButton('Run Next')
+        self.next_btn.setToolTip('Move to the front of the queue')
+        self.next_btn.clicked.connect(lambda: self.queue.run_next(self.selected_job()))
+        button_row.layout().addWidget(self.next_btn)
+
+        self.cancel_btn = QPushButton('Cancel')
+        self.cancel_btn.clicked.connect(lambda: self.queue.cancel(self.selected_job()))
+        button_row.layout().addWidget(self.cancel_btn)
+
+        self.layout().addWidget(button_row)
+
+        self.swaps_label = QLabel()
+        self.swaps_label.setToolTip('Jobs using the model the server already has loaded are run first. See "Group jobs by model" in the settings.')
+        self.layout().addWidget(self.swaps_label)
+
+        self.queue.changed.connect(self.refresh)
+        self.refresh()
+
+    def listed_jobs(self):
+        return [*self.queue.running, *self.queue.pending()]
+
+    def selected_job(self):
+        jobs = self.listed_jobs()
+        row = self.job_list.currentRow()
+        if row < 0 or row >= len(jobs):
+            return None
+        return jobs[row]
+
+    def refresh(self):
+        selected = self.selected_job()
+        self.job_list.blockSignals(True)
+        self.job_list.clear()
+        jobs = self.listed_jobs()
+        for job in jobs:
+            text = '%s (%s)' % (job.label(), job.status)
+            if job.backend is not None and len(self.queue.pool.backends) > 1:
+                text = '%s on %s' % (text, job.backend.host())
+            item = QListWidgetItem(text)
+            item.setData(Qt.UserRole, job.id)
+            self.job_list.addItem(item)
+        if selected in jobs:
+            self.job_list.setCurrentRow(jobs.index(selected))
+        self.job_list.blockSignals(False)
+        self.swaps_label.setText('Model loads saved by grouping: %s' % self.queue.swaps_saved)
+        self.swaps_label.setHidden(self.queue.swaps_saved == 0)
+        self.setHidden(len(jobs) == 0)
+        self.update_buttons()
+
+    def update_buttons(self):
+        job = self.selected_job()
+        queued = job is not None and job.status == GenerationJob.QUEUED
+        self.up_btn.setEnabled(queued)
+        self.down_btn.setEnabled(queued)
+        self.next_btn.setEnabled(queued)
+        self.cancel_btn.setEnabled(job is not None)
+
+# Progress bar and Cancel button for the oldest running job, with the queue under them.
+# button is the page's own action button (Generate, Upscale...), shown next to Cancel.
+class JobProgressWidget(QWidget):
+    def __init__(self, queue:JobQueue, button:QPushButton=None):
+        super().__init__()
+        self.queue = queue
+        self.setLayout(QVBoxLayout())
+        self.layout().setContentsMargins(0,0,0,0)
+        self.queue.changed.connect(self.update_queue_state)
+        self.queue.progress_changed.connect(self.progress_check)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMinimum(0)
+        self.progress_bar.setMaximum(100)
+        self.progress_bar.setValue(1)
+        self.progress_bar.setHidden(True)
+        self.layout().addWidget(self.progress_bar)
+
+        button_row = QWidget()
+        button_row.setLayout(QHBoxLayout())
+        button_row.layout().setContentsMargins(0,0,0,0)
+        if button is not None:
+            button_row.layout().addWidget(button)
+
+        self.cancel_btn = QPushButton('Cancel')
+        self.cancel_btn.setToolTip('Cancel the running job')
+        self.cancel_btn.clicked.connect(self.cancel)
+        button_row.layout().addWidget(self.cancel_btn)
+        self.layout().addWidget(button_row)
+
+        self.queue_widget = JobQueueWidget(self.queue)
+        self.layout().addWidget(self.queue_widget)
+        self.update_queue_state()
+
+    def update_progress_bar(self, value):
+        # Moved to a separate function to allow switching tabs to not break and stop image generation
+        try:
+            self.progress_bar.setValue(value)
+        except Exception as e:
+            pass
+
+    def update_queue_state(self):
+        try:
+            running = len(self.queue.running) > 0
+            self.cancel_btn.setHidden(not running)
+            self.progress_bar.setHidden(not running)
+            if not running:
+                self.update_progress_bar(0)
+            self.update()
+        except RuntimeError as e:
+            # The page was deleted, but Qt hasn't disconnected the signal yet
+            pass
+
+    def progress_check(self, job):
+        # The bar follows the oldest running job
+        if len(self.queue.running) == 0 or job is not self.queue.running[0]:
+            return
+        self.update_progress_bar(int(job.progress * 100))
+
+    def cancel(self):
+        try:
+            if len(self.queue.running) > 0:
+                self.queue.cancel(self.queue.running[0])
+        except Exception as e:
+            raise Exception('Cyanic SD - Exception trying to interrupt: %s' % e)
@@ -8,11 +8,12 @@ from ..widgets import CollapsibleWidget
 
 class MaskWidget(QWidget):
     MAX_HEIGHT = 100
-    def __init__(self, settings_controller:SettingsController, api:SDAPI, size_dict:dict):
+    def __init__(self, settings_controller:SettingsController, api:SDAPI, size_dict:dict, allow_crop=True):
         super().__init__()
         self.settings_controller = settings_controller
         self.api = api
         self.size_dict = size_dict
+        self.allow_crop = allow_crop # 'Crop to Mask' moves where the results go, which only the page's GenerateWidget can handle
         self.kc = KritaController()
         # self.setLayout(QFormLayout())
         self.setLayout(QVBoxLayout())
@@ -146,15 +147,18 @@ class MaskWidget(QWidget):
         form.layout().addRow('Masked Content', mask_content_select)
 
         # Inpaint Area = inpaint_full_res (0 = whole picture, 1 = only masked)
+        # 'Crop to Mask' is done here instead of on the server, so only the masked area (plus padding) is uploaded and generated
         inpaint_area_options = [
             'Whole Picture',
             'Only Masked',
+            'Crop to Mask',
         ]
         inpaint_select = QComboBox()
         inpaint_select.addItems(inpaint_area_options)
         inpaint_select.setMinimumContentsLength(10) # Allows the box to be smaller than the longest item's char length
         inpaint_select.setCurrentIndex(self.variables['inpaint_area'])
         inpaint_select.currentIndexChanged.connect(lambda: self._update_variable('inpaint_area', inpaint_select.currentIndex()))
+        inpaint_select.setItemData(2, 'Only sends the masked area plus the padding. Faster on big canvases, but the model only sees that area.', Qt.ToolTipRole)
         # inpaint_select.setCurrentIndex(self.settings_controller.get('inpaint.inpaint_area'))
         # inpaint_select.currentIndexChanged.connect(lambda: self.settings_controller.set('inpaint.inpaint_area', inpaint_select.currentIndex()))
         form.layout().addRow('Inpaint Area', inpaint_select)
@@ -167,7 +171,7 @@ class MaskWidget(QWidget):
         padding_box.valueChanged.connect(lambda: self._update_variable('mask_padding', padding_box.value()))
         # padding_box.setValue(self.settings_controller.get('inpaint.padding'))
         # padding_box.valueChanged.connect(lambda: self.settings_controller.set('inpaint.padding', padding_box.value()))
-        form.layout().addRow('Only masked padding', padding_box)
+        form.layout().addRow('Only masked padding', padding_box) # Also used by 'Crop to Mask'
 
         # self.layout().addWidget(form)
         cw = CollapsibleWidget('Inpaint Settings', form)
@@ -257,16 +261,33 @@ class MaskWidget(QWidget):
             else:
                 self.get_mask_and_img(mode="canvas")
 
-        if self.image is not None:
-            data['inpaint_img'] = self.kc.qimage_to_b64_str(self.image)
-        if self.mask is not None:
-            data['mask_img'] = self.kc.qimage_to_b64_str(self.mask)
+        image = self.image
+        mask = self.mask
+        processing_instructions = {} # This data will be intercepted by the Generate widget
+        if self.variables['inpaint_area'] == 2:
+            data['inpaint_full_res'] = 0 # The crop is already the area to inpaint
+            if self.allow_crop and image is not None and mask is not None:
+                bounds = self.kc.get_mask_bounds(mask, self.variables['mask_padding'])
+                if bounds is not None: # Nothing painted means there's nothing to crop to, send everything
+                    crop_x, crop_y, crop_w, crop_h = bounds
+                    image = image.copy(crop_x, crop_y, crop_w, crop_h)
+                    mask = mask.copy(crop_x, crop_y, crop_w, crop_h)
+                    processing_instructions['crop'] = {
+                        'x': self.size_dict['x'] + crop_x,
+                        'y': self.size_dict['y'] + crop_y,
+                        'w': crop_w,
+                        'h': crop_h,
+                    }
+
+        if image is not None:
+            data['inpaint_img'] = self.kc.qimage_to_b64_str(image, self.settings_controller.get('uploads.image_format'), self.settings_controller.get('uploads.quality'))
+        if mask is not None:
+            data['mask_img'] = self.kc.qimage_to_b64_str(mask, self.settings_controller.get('uploads.mask_format'))
 
         if self.variables['results_below_mask']:
-            # This data will be intercepted by the Generate widget
-            data['CYANIC'] = {
-                'results_below_layer_uuid': self.mask_uuid 
-            }
+            processing_instructions['results_below_layer_uuid'] = self.mask_uuid
+        if len(processing_instructions) > 0:
+            data['CYANIC'] = processing_instructions
         if self.variables['hide_mask_on_gen']:
             layer = self.kc.get_layer_from_uuid(self.mask_uuid)
             self.kc.set_layer_visible(layer, False)
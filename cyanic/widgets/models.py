@@ -2,6 +2,8 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import Qt
 from ..sdapi_v1 import SDAPI
 from ..settings_controller import SettingsController
+from ..job_queue import JobQueue
+from ..model_warmup import ModelWarmup
 
 # Select model, VAE, sampler, steps for generation
 # Yes, a better name would've been nice. No, I couldn't think of one
@@ -28,8 +30,13 @@ class ModelsWidget(QWidget):
         self.samplers = []
 
         self.init_variables()
+        self.warmup = ModelWarmup.shared(self.api, self.settings_controller)
 
         self.draw_ui()
+        self.api.add_catalog_listener(self.update_catalog)
+        JobQueue.shared(self.api, self.settings_controller).job_finished.connect(self.job_finished)
+        self.warmup.started.connect(self.warmup_started)
+        self.warmup.finished.connect(self.warmup_finished)
     
     def init_variables(self):
         # Model
@@ -85,11 +92,7 @@ class ModelsWidget(QWidget):
         # VAE Select
         self.vae_box = QComboBox()
         # vaes, server_default_vae = self.api.get_vaes_and_default()
-        if not 'None' in self.vaes:
-            new_vaes = ['None']
-            for vae in self.vaes:
-                new_vaes.append(vae)
-            self.vaes = new_vaes
+        self.vaes = self._with_none_vae(self.vaes)
         self.vae_box.addItems(self.vaes)
         self.vae_box.setCurrentText(self.variables['vae'])
         self.vae_box.setMinimumContentsLength(10) # Allows the box to be smaller than the longest item's char length
@@ -160,6 +163,67 @@ class ModelsWidget(QWidget):
 
         self.layout().addWidget(select_form)
 
+        # Model/VAE swap warning
+        self.swap_label = QLabel()
+        self.swap_label.setWordWrap(True)
+        self.swap_label.setToolTip('Loading a checkpoint or VAE usually takes 10-40 seconds, on top of generating')
+        self.layout().addWidget(self.swap_label)
+
+        # Model warm-up, the server doesn't report load progress so this is a busy bar
+        self.warmup_bar = QProgressBar()
+        self.warmup_bar.setRange(0, 0)
+        self.warmup_bar.setTextVisible(False)
+        self.warmup_bar.setMaximumHeight(6)
+        self.warmup_bar.setHidden(True)
+        self.layout().addWidget(self.warmup_bar)
+        self.update_swap_warning()
+
+    def _with_none_vae(self, vaes):
+        if not 'None' in vaes:
+            new_vaes = ['None']
+            for vae in vaes:
+                new_vaes.append(vae)
+            return new_vaes
+        return vaes
+
+    def update_catalog(self, changed_keys):
+        # Called after a background catalog refresh. Only the boxes whose lists changed get rebuilt.
+        if 'models' in changed_keys or 'default_settings' in changed_keys:
+            self.models, default_model = self.api.get_models_and_default()
+            self._refill_box(self.model_box, self.models, 'model', default_model)
+            self.refiners, default_refiner = self.api.get_refiners_and_default()
+            self._refill_box(self.refiner_box, self.refiners, 'refiner', default_refiner)
+        if 'vaes' in changed_keys or 'default_settings' in changed_keys:
+            vaes, default_vae = self.api.get_vaes_and_default()
+            self.vaes = self._with_none_vae(vaes)
+            self._refill_box(self.vae_box, self.vaes, 'vae', default_vae)
+        if 'samplers' in changed_keys and getattr(self, 'sampler_box', None) is not None:
+            self.samplers, default_sampler = self.api.get_samplers_and_default()
+            self._refill_box(self.sampler_box, self.samplers, 'sampler', default_sampler)
+        self.update_swap_warning()
+
+    def job_finished(self, job):
+        # The job may have loaded a different model
+        try:
+            self.update_swap_warning()
+        except RuntimeError as e:
+            # The page was deleted, but Qt hasn't disconnected the signal yet
+            pass
+
+    def _refill_box(self, box:QComboBox, items, variable_name, fallback):
+        current = self.variables[variable_name]
+        box.blockSignals(True) # Clearing the box would otherwise overwrite the selected value
+        box.clear()
+        box.addItems(items)
+        if current in items:
+            box.setCurrentText(current)
+        elif fallback in items:
+            box.setCurrentText(fallback)
+            self.variables[variable_name] = fallback
+        elif len(items) > 0:
+            self.variables[variable_name] = box.currentText()
+        box.blockSignals(False)
+
     def update_slider(self, value):
         if value == 0:
             self._update_variables('refiner_start', value)
@@ -202,6 +266,33 @@ class ModelsWidget(QWidget):
     
     def _update_variables(self, key, value):
         self.variables[key] = value
+        if key in ['model', 'vae']:
+            self.update_swap_warning()
+            self.warmup.request(self.variables['model'], self.variables['vae'])
+
+    def warmup_started(self, swaps):
+        try:
+            self.swap_label.setText('Loading the %s on the server...' % ' and '.join(swaps))
+            self.swap_label.setHidden(False)
+            self.warmup_bar.setHidden(False)
+        except RuntimeError as e:
+            # The page was deleted, but Qt hasn't disconnected the signal yet
+            pass
+
+    def warmup_finished(self, loaded):
+        try:
+            self.warmup_bar.setHidden(True)
+            self.update_swap_warning()
+        except RuntimeError as e:
+            pass # Same as warmup_started()
+
+    def update_swap_warning(self):
+        # Compares against the server's last known checkpoint/VAE, which is updated after every job
+        if self.warmup.is_loading():
+            return # warmup_started() is showing what's loading
+        swaps = self.api.swaps_needed(self.variables)
+        self.swap_label.setText('The server will load this %s first' % ' and '.join(swaps) if len(swaps) > 0 else '')
+        self.swap_label.setHidden(len(swaps) == 0)
 
     def save_settings(self):
         self.settings_controller.set('defaults.model', self.variables['model'])
@@ -24,6 +24,7 @@ class PromptWidget(QWidget):
         }
 
         self.draw_ui()
+        self.api.add_catalog_listener(self.update_catalog)
 
     def draw_ui(self):
         self.prompt_text_edit = QPlainTextEdit()
@@ -76,11 +77,14 @@ class PromptWidget(QWidget):
         style_form.layout().addWidget(add_to_prompt)
         return CollapsibleWidget('Styles', style_form)
     
-    def network_control(self):
+    def load_network_names(self):
         self.network_types['Loras'] = self.api.get_lora_names()
         self.network_types['Textual Inversions'] = self.api.get_embedding_names() 
         self.network_types['Hypernetworks'] = self.api.get_hypernetwork_names()
 
+    def network_control(self):
+        self.load_network_names()
+
         networks_form = QWidget()
         networks_form.setLayout(QVBoxLayout())
     
@@ -95,6 +99,22 @@ class PromptWidget(QWidget):
         self.name_list.itemPressed.connect(self.add_to_prompt)
         return CollapsibleWidget('Extra Networks', networks_form)
 
+    def update_catalog(self, changed_keys):
+        # Called after a background catalog refresh. Only touches the lists that changed.
+        network_keys = ['loras', 'embeddings', 'hypernetworks']
+        if any(key in changed_keys for key in network_keys):
+            self.load_network_names()
+            network_type_select = getattr(self, 'network_type_select', None)
+            if network_type_select is not None:
+                self.change_list(network_type_select.currentText())
+        if 'styles' in changed_keys:
+            checked = self.get_selected_style_names()
+            self.style_name_list.clear()
+            for name in self.api.get_style_names():
+                item = QListWidgetItem(name, self.style_name_list)
+                item.setBackground( QColor('#222222') )
+                item.setCheckState(Qt.Checked if name in checked else Qt.Unchecked)
+
     def change_list(self, list_name):
         names = self.network_types[list_name]
         self.name_list.clear()
@@ -0,0 +1,11 @@
+import os
+import sys
+import types
+
+# cyanic/__init__.py is the plugin's entry point and registers the docker with Krita, which only exists inside Krita.
+# The modules tested here don't need it, so the package is registered without running it.
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'cyanic')
+if 'cyanic' not in sys.modules:
+    package = types.ModuleType('cyanic')
+    package.__path__ = [PLUGIN_DIR]
+    sys.modules['cyanic'] = package
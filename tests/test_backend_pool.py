@@ -0,0 +1,90 @@
+from cyanic.backend_pool import BackendPool
+from cyanic.sdapi_v1 import SDAPI
+
+def test_shards_continue_the_seed_sequence():
+    shards = BackendPool.plan_shards({'seed': 100, 'subseed': 7, 'batch_count': 5, 'batch_size': 2}, 3)
+    assert [shard['batch_count'] for shard in shards] == [2, 2, 1]
+    assert [shard['seed'] for shard in shards] == [100, 104, 108]
+    assert [shard['subseed'] for shard in shards] == [7, 11, 15]
+    assert all(['CYANIC' not in shard for shard in shards])
+
+def test_no_more_shards_than_iterations():
+    shards = BackendPool.plan_shards({'seed': 1, 'n_iter': 2}, 4)
+    assert len(shards) == 2
+    assert all(['n_iter' not in shard for shard in shards])
+
+def test_random_seed_is_picked_once_and_not_cached():
+    shards = BackendPool.plan_shards({'seed': -1, 'batch_count': 3}, 3)
+    assert shards[1]['seed'] == shards[0]['seed'] + 1
+    assert shards[2]['seed'] == shards[0]['seed'] + 2
+    assert all([shard['CYANIC']['no_cache'] for shard in shards])
+
+def test_fixed_seed():
+    assert BackendPool.fixed_seed(42) == 42
+    assert BackendPool.fixed_seed('42') == 42
+    for seed in [-1, '', None, '-1']:
+        assert BackendPool.is_random_seed(seed)
+        assert 0 <= BackendPool.fixed_seed(seed) < 4294967294
+
+def shard_results(seeds):
+    return {
+        'images': ['image %s' % seed for seed in seeds],
+        'parameters': {'n_iter': len(seeds), 'batch_size': 1},
+        'info': {'all_seeds': seeds, 'all_prompts': ['p'] * len(seeds), 'seed': seeds[0]},
+    }
+
+def test_merge_keeps_seed_order():
+    merged = BackendPool.merge_results([shard_results([1, 2]), shard_results([3, 4]), shard_results([5])])
+    assert merged['images'] == ['image 1', 'image 2', 'image 3', 'image 4', 'image 5']
+    assert merged['info']['all_seeds'] == [1, 2, 3, 4, 5]
+    assert len(merged['info']['all_prompts']) == 5
+    assert merged['info']['seed'] == 1
+    assert merged['parameters']['n_iter'] == 5
+
+def test_merge_skips_failed_shards():
+    merged = BackendPool.merge_results([None, shard_results([3, 4])])
+    assert merged['info']['all_seeds'] == [3, 4]
+    assert BackendPool.merge_results([None, None]) is None
+
+def test_merge_leaves_the_shards_alone():
+    first = shard_results([1])
+    BackendPool.merge_results([first, shard_results([2])])
+    assert first['images'] == ['image 1']
+    assert first['info']['all_seeds'] == [1]
+
+class FakeHost(SDAPI):
+    # Answers GETs like an SD.Next host, without a server
+    RESPONSES = {
+        '/queue/status': {'queue_size': 0},
+        '/sdapi/v1/progress?skip_current_image=true': {'state': {'job_count': 0}},
+        '/sdapi/v1/options': {'sd_backend': 'original', 'cross_attention_sep': '', 'cuda_compile_sep': '', 'models_paths_sep_options': '', 'outdir_sep_dirs': '', 'outdir_sep_grids': '', 'sd_model_checkpoint': 'm [1]'},
+        '/sdapi/v1/sd-models': [{'title': 'm [1]', 'model_name': 'm'}],
+    }
+    def get(self, url, timeout=None):
+        self.gets = getattr(self, 'gets', []) + [url]
+        return FakeHost.RESPONSES.get(url, None)
+
+def test_extra_hosts_are_connected_before_they_get_work(monkeypatch):
+    monkeypatch.setattr('cyanic.backend_pool.SDAPI', FakeHost)
+    pool = BackendPool(SDAPI('http://primary', connect=False), ['http://extra'])
+    extra = pool.backends[1]
+    assert extra.api.host_version == 'A1111' and not extra.api.connected
+    assert pool.check(extra)
+    assert extra.api.connected
+    assert extra.api.host_version == 'SD.Next'
+    assert extra.api.server_options['sd_model_checkpoint'] == 'm [1]'
+    assert extra.models == ['m [1]', 'm']
+    gets = len(extra.api.gets)
+    pool.check(extra)
+    assert '/sdapi/v1/options' not in extra.api.gets[gets:] # Only connects once
+
+class DownHost(FakeHost):
+    def get(self, url, timeout=None):
+        return None
+
+def test_unreachable_extra_host_gets_no_work(monkeypatch):
+    monkeypatch.setattr('cyanic.backend_pool.SDAPI', DownHost)
+    pool = BackendPool(FakeHost('http://primary', connect=False), ['http://extra'])
+    pool.check_all(force=True)
+    assert pool.backends[1].healthy is False
+    assert pool.choose() is pool.backends[0]
@@ -0,0 +1,36 @@
+from cyanic.catalog_cache import CatalogCache
+from cyanic.sdapi_v1 import SDAPI
+
+def refreshed_api(old, new, new_host_version='A1111'):
+    api = SDAPI('http://localhost:7860', connect=False)
+    for key, value in old.items():
+        setattr(api, key, value)
+    def fetch_catalog():
+        for key, value in new.items():
+            setattr(api, key, value)
+        api.host_version = new_host_version
+    api.get_status = lambda: {}
+    api.fetch_catalog = fetch_catalog
+    return api
+
+def test_refresh_reports_only_changed_keys():
+    api = refreshed_api(
+        {'models': ['a'], 'loras': ['x'], 'default_settings': {'sd_model_checkpoint': 'a'}},
+        {'models': ['a', 'b'], 'loras': ['x'], 'default_settings': {'sd_model_checkpoint': 'b'}},
+    )
+    assert api.refresh_catalog() == ['models', 'default_settings']
+    assert api.last_catalog_changes == ['models', 'default_settings']
+
+def test_refresh_reports_nothing_when_unchanged():
+    api = refreshed_api({'models': ['a'], 'default_settings': {'x': 1}}, {'models': ['a'], 'default_settings': {'x': 1}})
+    assert api.refresh_catalog() == []
+
+def test_refresh_reports_everything_for_a_new_backend():
+    api = refreshed_api({'models': ['a']}, {'models': ['a']}, new_host_version='SD.Next')
+    assert api.refresh_catalog() == SDAPI.CATALOG_KEYS
+
+def test_failed_save_doesnt_raise(tmp_path):
+    cache = CatalogCache()
+    cache.cache_file = str(tmp_path / 'missing' / 'catalog_cache.json')
+    cache.set('http://localhost:7860', {'models': ['a']})
+    assert cache.get('http://localhost:7860')['catalog'] == {'models': ['a']}
@@ -0,0 +1,81 @@
+import io
+import json
+import random
+import pytest
+from cyanic.json_stream import JSONImageStream, JSONBody
+
+def parse(text, chunk_size=7, on_image=None):
+    stream = io.BytesIO(text.encode('utf-8') if type(text) is str else text)
+    return JSONImageStream(stream.read, on_image, chunk_size=chunk_size).parse()
+
+def random_value(depth=0):
+    kind = random.choice(['str', 'int', 'float', 'bool', 'null', 'list', 'dict'] if depth < 3 else ['str', 'int', 'null'])
+    if kind == 'str':
+        return ''.join(random.choice('ab"\\\\/\né{}[],: ') for i in range(0, random.randint(0, 12)))
+    if kind == 'int':
+        return random.randint(-1000, 1000)
+    if kind == 'float':
+        return random.random() * 100
+    if kind == 'bool':
+        return random.choice([True, False])
+    if kind == 'null':
+        return None
+    if kind == 'list':
+        return [random_value(depth + 1) for i in range(0, random.randint(0, 4))]
+    return {'k%s' % i: random_value(depth + 1) for i in range(0, random.randint(0, 4))}
+
+def test_round_trips_random_responses():
+    random.seed(1234)
+    for i in range(0, 200):
+        response = {
+            'images': ['iVBORw0KGgo%s' % ('A' * random.randint(0, 50)) for j in range(0, random.randint(0, 3))],
+            'parameters': random_value(),
+            'info': json.dumps(random_value()),
+        }
+        for chunk_size in [1, 3, 64]:
+            assert parse(json.dumps(response, indent=random.choice([None, 2])), chunk_size) == response
+
+def test_images_go_to_on_image_in_order():
+    seen = []
+    results = parse('{"images": ["a", "b", null], "info": "{}"}', 2, lambda image: seen.append(image) or len(seen))
+    assert seen == ['a', 'b']
+    assert results == {'images': [1, 2, None], 'info': '{}'}
+
+def test_single_image_key():
+    assert parse('{"html_info": "<p>\\"x\\"</p>", "image": "abc"}', 4, lambda image: image.upper()) == {'html_info': '<p>"x"</p>', 'image': 'ABC'}
+
+def test_escaped_quotes_split_across_chunks():
+    text = json.dumps({'info': 'a\\\\"b' * 5, 'images': []})
+    for chunk_size in range(1, 10):
+        assert parse(text, chunk_size) == json.loads(text)
+
+def test_non_object_response():
+    assert parse('"Not Found"') == 'Not Found'
+    assert parse('[1, 2]') == [1, 2]
+
+def test_truncated_response_raises():
+    with pytest.raises(ValueError):
+        parse('{"images": ["abc')
+
+def test_body_matches_json_dumps():
+    random.seed(99)
+    for i in range(0, 100):
+        data = {'prompt': random_value(), 'init_images': ['iVBORw0KGgo' + 'A' * random.randint(0, 2 * JSONBody.INLINE_LIMIT)], 'extra': random_value()}
+        body = JSONBody(data)
+        sent = b''.join(body)
+        assert json.loads(sent) == data
+        assert len(sent) == body.length
+
+def test_body_references_big_strings():
+    image = 'A' * (JSONBody.INLINE_LIMIT * 3)
+    body = JSONBody({'init_images': [image], 'prompt': 'x'})
+    assert any([part is image for part in body.parts])
+    assert max([len(chunk) for chunk in body]) <= JSONBody.CHUNK_SIZE
+
+def test_body_escapes_big_strings_that_need_it():
+    text = '"\\' * JSONBody.INLINE_LIMIT
+    assert json.loads(b''.join(JSONBody({'prompt': text}))) == {'prompt': text}
+
+def test_body_can_be_sent_again():
+    body = JSONBody({'init_images': ['A' * JSONBody.INLINE_LIMIT]})
+    assert b''.join(body) == b''.join(body)
@@ -0,0 +1,70 @@
+from cyanic.model_grouping import ModelGrouping
+
+class Job():
+    def __init__(self, order, model, priority=0, pinned=False):
+        self.order = order
+        self.priority = priority
+        self.model_key = None if model is None else (model, None, None)
+        self.pinned = pinned
+        self.skipped = 0
+
+def same_models(key, other_key):
+    return key is None or other_key is None or key[0] == other_key[0]
+
+def run(jobs, loaded_model, max_skips=3):
+    # Starts the jobs one at a time, the way JobQueue.start_next() does
+    loaded_key = (loaded_model, None, None)
+    jobs = list(jobs)
+    started = []
+    while len(jobs) > 0:
+        planned = ModelGrouping.order(jobs, loaded_key, same_models, max_skips)
+        job = planned[0]
+        for other in jobs:
+            if other is not job and other.priority == job.priority and other.order < job.order:
+                other.skipped += 1
+        jobs.remove(job)
+        started.append(job)
+        if job.model_key is not None:
+            loaded_key = job.model_key
+    return started
+
+def test_loaded_model_goes_first():
+    jobs = [Job(0, 'a'), Job(1, 'b'), Job(2, 'a')]
+    assert [job.order for job in ModelGrouping.order(jobs, ('a', None, None), same_models, 3)] == [0, 2, 1]
+    assert [job.order for job in ModelGrouping.order(jobs, ('b', None, None), same_models, 3)] == [1, 0, 2]
+
+def test_plan_matches_what_runs():
+    jobs = [Job(i, model) for i, model in enumerate('babaaaa')]
+    planned = [job.order for job in ModelGrouping.order(jobs, ('a', None, None), same_models, 3)]
+    assert planned == [1, 3, 4, 0, 2, 5, 6]
+    assert [job.order for job in run(jobs, 'a')] == planned
+
+def test_max_skips():
+    started = run([Job(i, model) for i, model in enumerate('baaaaa')], 'a', max_skips=2)
+    assert [job.order for job in started] == [1, 2, 0, 3, 4, 5]
+    started = run([Job(i, model) for i, model in enumerate('baaaaa')], 'a', max_skips=0)
+    assert [job.order for job in started] == [0, 1, 2, 3, 4, 5]
+
+def test_pinned_and_priority_are_kept():
+    jobs = [Job(0, 'b', pinned=True), Job(1, 'a')]
+    assert [job.order for job in ModelGrouping.order(jobs, ('a', None, None), same_models, 3)] == [0, 1]
+    jobs = [Job(0, 'b', priority=1), Job(1, 'a')]
+    assert [job.order for job in ModelGrouping.order(jobs, ('a', None, None), same_models, 3)] == [0, 1]
+    jobs = [Job(0, 'a', priority=1), Job(1, 'b', priority=1), Job(2, 'a')]
+    assert [job.order for job in ModelGrouping.order(jobs, ('b', None, None), same_models, 3)] == [1, 0, 2]
+
+def test_no_model_isnt_pulled_forward():
+    # A job without a model runs with whatever is loaded, so it isn't worth skipping ahead for
+    jobs = [Job(0, 'b'), Job(1, None), Job(2, 'a')]
+    assert [job.order for job in ModelGrouping.order(jobs, ('a', None, None), same_models, 3)] == [2, 0, 1]
+    jobs = [Job(0, None), Job(1, 'b')]
+    assert [job.order for job in ModelGrouping.order(jobs, ('a', None, None), same_models, 3)] == [0, 1]
+
+def test_saved_swaps():
+    started = run([Job(i, model) for i, model in enumerate('babaaaa')], 'a')
+    started_keys = [(-job.priority, job.order, job.model_key) for job in started]
+    in_run_order = [model_key for priority, order, model_key in started_keys]
+    assert ModelGrouping.count_swaps(in_run_order, ('a', None, None), same_models) == 2
+    assert ModelGrouping.saved_swaps(started_keys, ('a', None, None), same_models) == 2
+    in_order = [(0, i, (model, None, None)) for i, model in enumerate('aab')]
+    assert ModelGrouping.saved_swaps(in_order, ('a', None, None), same_models) == 0
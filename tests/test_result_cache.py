@@ -0,0 +1,83 @@
+import os
+import pytest
+from cyanic.result_cache import ResultCache
+
+MODEL = {'sd_model_checkpoint': 'model.safetensors'}
+
+@pytest.mark.parametrize('data,server_options,expected', [
+    ({'prompt': 'cat', 'seed': 5}, MODEL, True),
+    ({'prompt': 'cat', 'seed': '5'}, MODEL, True),
+    ({'prompt': 'cat', 'seed': -1}, MODEL, False),
+    ({'prompt': 'cat', 'seed': ''}, MODEL, False),
+    ({'prompt': 'cat', 'seed': None}, MODEL, False),
+    ({'prompt': 'cat'}, MODEL, False),
+    ({'prompt': 'cat', 'seed': 5, 'subseed': -1}, MODEL, True),
+    ({'prompt': 'cat', 'seed': 5, 'subseed': -1, 'subseed_strength': 0.5}, MODEL, False),
+    ({'prompt': 'cat', 'seed': 5, 'subseed': 9, 'subseed_strength': 0.5}, MODEL, True),
+    ({'prompt': 'cat', 'seed': 5, 'save_images': True}, MODEL, False),
+    ({'prompt': 'cat', 'seed': 5}, {}, False),
+    ({'prompt': 'cat', 'seed': 5, 'override_settings': MODEL}, {}, True),
+    ({'image': 'abc', 'upscaling_resize': 2}, {}, True),
+    ({'image': 'abc', 'save_images': True}, {}, False),
+])
+def test_cacheable(data, server_options, expected):
+    assert ResultCache.cacheable(data, server_options) == expected
+
+def test_fingerprint():
+    data = {'prompt': 'cat', 'seed': 5}
+    fingerprint = ResultCache.fingerprint('/sdapi/v1/txt2img', data, MODEL)
+    assert fingerprint == ResultCache.fingerprint('/sdapi/v1/txt2img', dict(data), dict(MODEL))
+    assert fingerprint != ResultCache.fingerprint('/sdapi/v1/img2img', data, MODEL)
+    assert fingerprint != ResultCache.fingerprint('/sdapi/v1/txt2img', dict(data, seed=6), MODEL)
+    assert fingerprint != ResultCache.fingerprint('/sdapi/v1/txt2img', data, {'sd_model_checkpoint': 'other.safetensors'})
+    # Overriding the loaded model is the same as having it loaded
+    assert fingerprint == ResultCache.fingerprint('/sdapi/v1/txt2img', dict(data, override_settings=MODEL), {})
+
+def test_fingerprint_hashes_long_strings():
+    image = 'A' * ResultCache.HASH_LENGTH
+    fingerprint = ResultCache.fingerprint('/sdapi/v1/img2img', {'init_images': [image], 'seed': 5}, MODEL)
+    assert fingerprint == ResultCache.fingerprint('/sdapi/v1/img2img', {'init_images': ['A' * ResultCache.HASH_LENGTH], 'seed': 5}, MODEL)
+    assert fingerprint != ResultCache.fingerprint('/sdapi/v1/img2img', {'init_images': ['B' + image[1:]], 'seed': 5}, MODEL)
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResultCache()
+    cache.cache_dir = str(tmp_path / 'result_cache')
+    return cache
+
+def test_round_trip(cache):
+    results = {'images': ['aW1hZ2Ux', 'aW1hZ2Uy'], 'info': '{"seed": 5}', 'parameters': {}}
+    writer = cache.writer('abc')
+    on_image = writer.wrap()
+    streamed = {'images': [on_image(image) for image in results['images']], 'info': results['info'], 'parameters': {}}
+    writer.finish(streamed)
+    assert cache.read('abc') == results
+    assert cache.read('abc', on_image=len) == dict(results, images=[8, 8])
+    assert cache.hits == 2
+
+def test_single_image_round_trip(cache):
+    writer = cache.writer('abc')
+    writer.add_image('aW1hZ2Ux')
+    writer.finish({'image': 'aW1hZ2Ux', 'html_info': ''})
+    assert cache.read('abc') == {'image': 'aW1hZ2Ux', 'html_info': ''}
+
+def test_unfinished_entries_arent_read(cache):
+    writer = cache.writer('abc')
+    writer.add_image('aW1hZ2Ux')
+    assert cache.read('abc') is None
+    writer.discard()
+    assert os.listdir(cache.cache_dir) == []
+    assert cache.misses == 1
+
+def test_prune_removes_least_recently_used(cache):
+    for i, fingerprint in enumerate(['old', 'new']):
+        writer = cache.writer(fingerprint)
+        writer.add_image('A' * 1000)
+        writer.finish({'images': []})
+        os.utime(cache._path(fingerprint), (i, i))
+    cache.max_bytes = lambda: 1500
+    cache.prune()
+    assert cache.read('old') is None
+    assert cache.read('new') is not None
+    cache.clear()
+    assert os.listdir(cache.cache_dir) == []
@@ -0,0 +1,36 @@
+from cyanic.sdapi_v1 import SDAPI
+
+MODEL = 'model.safetensors [abc]'
+
+def api_with(results):
+    api = SDAPI('http://localhost:7860', connect=False)
+    api.remember_server_options({'sd_model_checkpoint': MODEL, 'sd_vae': 'Automatic', 'something_else': 1})
+    api.sent = []
+    def get(url, timeout=None):
+        raise AssertionError('Generating shouldn\'t need a GET')
+    api.get = get
+    def post_cached(url, data, timeout=None, on_image=None, use_cache=True):
+        api.sent.append(dict(data['override_settings']))
+        return results.pop(0), False
+    api.post_cached = post_cached
+    api.log_request_and_response = lambda data, results: None
+    return api
+
+def test_only_tracked_options_are_remembered():
+    api = api_with([])
+    assert api.server_options == {'sd_model_checkpoint': MODEL, 'sd_vae': 'Automatic'}
+
+def test_loaded_options_arent_sent():
+    api = api_with([{'images': [], 'info': '{}'}, {'images': [], 'info': '{}'}])
+    api.txt2img({'prompt': 'cat', 'model': MODEL, 'vae': 'other.vae'})
+    assert api.sent[-1] == {'sd_vae': 'other.vae'}
+    api.txt2img({'prompt': 'cat', 'model': MODEL, 'vae': 'other.vae'})
+    assert api.sent[-1] == {}
+
+def test_failed_job_sends_its_options_again():
+    api = api_with([None, {'images': [], 'info': '{}'}])
+    api.txt2img({'prompt': 'cat', 'model': 'other.safetensors'})
+    assert 'sd_model_checkpoint' not in api.server_options
+    api.txt2img({'prompt': 'cat', 'model': MODEL})
+    assert api.sent[-1] == {'sd_model_checkpoint': MODEL}
+    assert api.server_options['sd_model_checkpoint'] == MODEL
@@ -0,0 +1,114 @@
+import base64
+import pytest
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice
+from PyQt5.QtGui import QImage, qRgb
+from cyanic.tiling import Tile
+
+def covered(spans, length):
+    # Tiles form a grid, so covering both sides covers the whole region
+    position = 0
+    for start, size in sorted(spans):
+        if start > position:
+            return False
+        position = max(position, start + size)
+    return position == length
+
+@pytest.mark.parametrize('w,h,tile_size,overlap', [
+    (512, 512, 512, 64),
+    (1000, 600, 512, 64),
+    (2048, 1536, 768, 128),
+    (1300, 520, 515, 64),
+])
+def test_plan_covers_the_region(w, h, tile_size, overlap):
+    tiles = Tile.plan(w, h, tile_size, overlap)
+    assert covered(set([(tile.x, tile.w) for tile in tiles]), w)
+    assert covered(set([(tile.y, tile.h) for tile in tiles]), h)
+    assert len(tiles) == len(set([tile.x for tile in tiles])) * len(set([tile.y for tile in tiles]))
+    assert [tile.index for tile in tiles] == list(range(len(tiles)))
+    for tile in tiles:
+        assert tile.w <= max(64, tile_size - tile_size % 8)
+        assert tile.h <= max(64, tile_size - tile_size % 8)
+
+def test_plan_sizes_and_overlaps():
+    tiles = Tile.plan(2000, 900, 512, 64)
+    assert all([tile.w == 512 and tile.h == 512 for tile in tiles])
+    xs = sorted(set([tile.x for tile in tiles]))
+    ys = sorted(set([tile.y for tile in tiles]))
+    for starts in [xs, ys]:
+        for previous, start in zip(starts, starts[1:]):
+            assert previous + 512 - start >= 64
+
+def test_small_region_is_one_tile():
+    tiles = Tile.plan(300, 200, 512, 64)
+    assert [(tile.x, tile.y, tile.w, tile.h) for tile in tiles] == [(0, 0, 300, 200)]
+
+def test_feather_edges():
+    tiles = Tile.plan(900, 900, 512, 64)
+    assert len(tiles) == 4
+    top_left, top_right, bottom_left, bottom_right = tiles
+    overlap = top_left.x + top_left.w - top_right.x
+    assert top_left.feather_edges([]) == {}
+    assert top_right.feather_edges([top_left]) == {'left': overlap}
+    assert bottom_left.feather_edges([top_left, top_right]) == {'top': overlap}
+    assert bottom_right.feather_edges([top_left, top_right, bottom_left]) == {'left': overlap, 'top': overlap}
+
+def test_feather_diagonal_corner():
+    top_left, top_right, bottom_left, bottom_right = Tile.plan(900, 900, 512, 64)
+    overlap = top_left.x + top_left.w - top_right.x
+    # Only the diagonal neighbour is on the layer, so just that corner fades
+    assert bottom_right.feather_edges([top_left]) == {'top_left': (overlap, overlap)}
+    assert top_left.feather_edges([bottom_right]) == {'bottom_right': (overlap, overlap)}
+    # Once an edge next to the corner fades, it covers the corner too
+    assert bottom_right.feather_edges([top_left, top_right]) == {'top': overlap}
+
+class FakeKritaController():
+    # The part of KritaController the upload splitting uses
+    def qimage_to_b64_str(self, image, upload_format='PNG', quality=95):
+        ba = QByteArray()
+        buffer = QBuffer(ba)
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        image.save(buffer, 'PNG')
+        return ba.toBase64().data().decode()
+
+def canvas(w, h):
+    # Every pixel's colour says where it came from
+    image = QImage(w, h, QImage.Format_RGB32)
+    for y in range(0, h):
+        for x in range(0, w):
+            image.setPixel(x, y, qRgb(x, y, 0))
+    return FakeKritaController().qimage_to_b64_str(image)
+
+def came_from(b64_str):
+    image = QImage.fromData(base64.b64decode(b64_str))
+    pixel = image.pixel(0, 0)
+    return ((pixel >> 16) & 0xff, (pixel >> 8) & 0xff, image.width(), image.height())
+
+def controlnet_data(images):
+    return {
+        'prompt': 'cat',
+        'alwayson_scripts': {
+            'controlnet': {'args': [{'module': 'canny', 'image': images}, {'module': 'depth', 'image': None}]},
+            'ADetailer': {'args': [True]},
+        },
+    }
+
+def test_split_controlnet_uploads():
+    data = controlnet_data({'image': canvas(200, 120), 'mask': None})
+    tiles = Tile.split_uploads(data, Tile.plan(200, 120, 64, 16), 200, 120, FakeKritaController())
+    assert len(tiles) > 1
+    for tile in tiles:
+        scripts = tile.data['alwayson_scripts']
+        assert scripts['ADetailer'] == {'args': [True]}
+        unit, other_unit = scripts['controlnet']['args']
+        assert unit['module'] == 'canny' and unit['image']['mask'] is None
+        assert came_from(unit['image']['image']) == (tile.x, tile.y, tile.w, tile.h)
+        assert other_unit == {'module': 'depth', 'image': None}
+    assert data['alwayson_scripts']['controlnet']['args'][0]['image'] is None
+
+def test_crop_controlnet_uploads():
+    upload = canvas(100, 80)
+    data = controlnet_data({'image': canvas(200, 120), 'mask': upload})
+    Tile.crop_controlnet_uploads(data, 30, 20, 64, 48, 200, 120, FakeKritaController())
+    images = data['alwayson_scripts']['controlnet']['args'][0]['image']
+    assert came_from(images['image']) == (30, 20, 64, 48)
+    assert images['mask'] == upload # Not the region's size, so it wasn't taken from the canvas